@@ -0,0 +1,178 @@
+import logging
+from array import array
+from time import time
+from enums import DataType
+logger = logging.getLogger(__name__)
+
+"""
+    Edge aggregation:
+    Registers with an aggregation window (ServerOptions.aggregate_windows, keyed by register name or
+    device_class like poll_intervals) can be polled far faster than HA should record them. Their
+    samples go into a fixed-size array of doubles per register. When a window closes, min, max and
+    mean are computed by C-level builtins over the whole array rather than per sample in Python.
+    They are published together with the last sample instead of every sample: the last sample to
+    the register's own state topic, the statistics to derived sensors "<register> min/ max/ mean".
+    Power registers can be integrated into a derived "<register> energy" counter (trapezoidal rule)
+    for HA's energy dashboard. Only positive power counts towards it, negative power of signed registers
+    (e.g. export of a bidirectional meter) goes to "<register> reverse energy", so both only increase.
+    Samples further apart than the window, e.g. around an outage, are not integrated.
+
+    Windows are aligned to the wall clock, so all registers of a window length close together. A window
+    is closed by the first sample after its end, or by Aggregator.flush, which async_engine calls every
+    WINDOW_TICK seconds, if no sample follows. Windows of a server that becomes unavailable are closed
+    at once. A ring holds at most `capacity` samples, when a window receives more the oldest are
+    overwritten, so memory is constant per register.
+"""
+
+STATS = ("min", "max", "mean")
+ENERGY_UNITS = {"W": "Wh", "kW": "kWh"}                        # power unit -> unit of the integrated energy
+DEFAULT_CAPACITY = 1024                                         # samples per register and window
+UNSIGNED = (DataType.U16, DataType.U32, DataType.U64)           # registers without reverse energy
+
+
+class WindowRing:
+    """ Samples of one register in the current window """
+    __slots__ = ("window", "samples", "n", "last", "window_end", "energy", "reverse_energy", "_prev")
+
+    def __init__(self, window: float, capacity: int = DEFAULT_CAPACITY, integrate: bool = False, reverse: bool = False):
+        self.window = window
+        self.samples = array("d", bytes(8 * capacity))
+        self.n = 0                                              # samples added in this window, may exceed capacity
+        self.last = None
+        self.window_end = 0.0
+        self.energy: float | None = 0.0 if integrate else None  # unit-hours of positive power since start
+        self.reverse_energy: float | None = 0.0 if integrate and reverse else None  # unit-hours of negative power
+        self._prev: tuple[float, float] | None = None           # (timestamp, value) of the previous sample
+
+    def add(self, value: float, t: float):
+        self.samples[self.n % len(self.samples)] = value
+        self.n += 1
+        self.last = value
+        if self.energy is not None:
+            prev = self._prev
+            if prev is not None and t - prev[0] <= self.window:
+                if value >= 0 and prev[1] >= 0: self.energy += (t - prev[0]) * (value + prev[1]) / 7200
+                else: self._integrate(t - prev[0], prev[1], value)
+            self._prev = (t, value)
+
+    def _integrate(self, dt: float, a: float, b: float):
+        """ Add the trapezoid between two samples dt seconds apart, split where the power crosses zero """
+        if (a < 0) != (b < 0):
+            t0 = dt * a / (a - b)                               # seconds until the zero crossing
+            forward = (a * t0 if a > 0 else b * (dt - t0)) / 2
+            reverse = -(a * t0 if a < 0 else b * (dt - t0)) / 2
+        elif a >= 0: forward, reverse = dt * (a + b) / 2, 0.0
+        else: forward, reverse = 0.0, -dt * (a + b) / 2
+        self.energy += forward / 3600
+        if self.reverse_energy is not None: self.reverse_energy += reverse / 3600
+
+    def close(self) -> tuple[float, float, float] | None:
+        """ (min, max, mean) of the window, None if it got no samples. Starts the next window. """
+        k = min(self.n, len(self.samples))
+        if not k: return None
+        # sorted() converts every double once and runs in C, cheaper than separate min() and max() passes
+        ordered = sorted(self.samples if k == len(self.samples) else self.samples[:k])
+        self.n = 0
+        return ordered[0], ordered[-1], sum(ordered) / k
+
+
+class Aggregator:
+    """ Aggregation windows of all servers, see MqttClient.publish_values """
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.rings: dict[str, dict[str, WindowRing]] = {}       # server nickname -> register name -> ring
+        self.derived: dict[str, dict[str, dict]] = {}           # server nickname -> derived sensor -> register info
+        self.servers: dict[str, object] = {}                    # server nickname -> server, for flush
+
+    def configure(self, server) -> dict[str, dict]:
+        """ (Re)build the rings of a server from its registers and aggregate_windows, keeping the rings
+            of registers whose window did not change. Returns the register info of the derived sensors.
+        """
+        windows = server.aggregate_windows
+        previous = self.rings.get(server.nickname, {})
+        rings, derived = {}, {}
+        for register_name, details in server.registers.items() if windows else ():
+            window = windows.get(register_name, windows.get(details.get("device_class")))
+            if not window: continue
+
+            integrate = server.aggregate_energy and details.get("device_class") == "power" and details.get("unit") in ENERGY_UNITS
+            reverse = integrate and details.get("dtype") not in UNSIGNED
+            ring = previous.get(register_name)
+            if ring is None or ring.window != window or (ring.energy is not None) != integrate \
+                    or (ring.reverse_energy is not None) != reverse:
+                ring = WindowRing(window, self.capacity, integrate, reverse)
+            rings[register_name] = ring
+
+            for stat in STATS:
+                derived[f"{register_name} {stat}"] = {"unit": details.get("unit"), "device_class": details.get("device_class"),
+                                                      "state_class": "measurement"}
+            if integrate:
+                derived[f"{register_name} energy"] = {"unit": ENERGY_UNITS[details["unit"]], "device_class": "energy",
+                                                      "state_class": "total_increasing"}
+            if reverse:
+                derived[f"{register_name} reverse energy"] = {"unit": ENERGY_UNITS[details["unit"]], "device_class": "energy",
+                                                              "state_class": "total_increasing"}
+
+        self.rings[server.nickname], self.derived[server.nickname] = rings, derived
+        self.servers[server.nickname] = server
+        if rings: logger.info(f"Aggregating {len(rings)} registers of server {server.nickname}")
+        return derived
+
+    def add(self, server, values: dict, t: float | None = None) -> dict:
+        """ Add a poll's values. Returns the values to publish now: those of registers without a window,
+            and the last value and statistics of every window that closed.
+        """
+        rings = self.rings.get(server.nickname)
+        if rings is None:
+            self.configure(server)
+            rings = self.rings[server.nickname]
+        if not rings: return values
+
+        t = time() if t is None else t
+        publish = {}
+        for register_name, value in values.items():
+            ring = rings.get(register_name)
+            if ring is None or not isinstance(value, (int, float)):
+                publish[register_name] = value
+                continue
+            if t >= ring.window_end:
+                if ring.n: self._close(register_name, ring, publish)
+                ring.window_end = (t // ring.window + 1) * ring.window
+            ring.add(value, t)
+        return publish
+
+    def flush(self, t: float | None = None) -> list[tuple[object, dict]]:
+        """ Close the windows that ended by t (now if None) without a sample after their end to close them.
+            Returns (server, values to publish) of every server with a closed window.
+        """
+        t = time() if t is None else t
+        flushed = []
+        for nickname, rings in self.rings.items():
+            publish = {}
+            for register_name, ring in rings.items():
+                if ring.n and t >= ring.window_end: self._close(register_name, ring, publish)
+            if publish: flushed.append((self.servers[nickname], publish))
+        return flushed
+
+    def close_all(self, server) -> dict:
+        """ Close the open windows of a server before their end, e.g. when it becomes unavailable """
+        publish = {}
+        for register_name, ring in self.rings.get(server.nickname, {}).items():
+            if ring.n: self._close(register_name, ring, publish)
+        return publish
+
+    def forget(self, nickname: str):
+        """ Drop the rings and derived sensors of a server """
+        self.rings.pop(nickname, None)
+        self.derived.pop(nickname, None)
+        self.servers.pop(nickname, None)
+
+    @staticmethod
+    def _close(register_name: str, ring: WindowRing, publish: dict):
+        lo, hi, mean = ring.close()
+        publish[register_name] = ring.last
+        publish[f"{register_name} min"] = lo
+        publish[f"{register_name} max"] = hi
+        publish[f"{register_name} mean"] = round(mean, 2)
+        if ring.energy is not None: publish[f"{register_name} energy"] = round(ring.energy, 3)
+        if ring.reverse_energy is not None: publish[f"{register_name} reverse energy"] = round(ring.reverse_energy, 3)
@@ -0,0 +1,247 @@
+from pymodbus.client import AsyncModbusSerialClient, AsyncModbusTcpClient
+from enums import RegisterTypes
+from pymodbus.exceptions import ModbusException
+import asyncio
+import logging
+from time import perf_counter
+from metrics import METRICS
+from client import Client, _warn_register_info
+from read_planner import ReadBlock
+from server import Server
+from loader import ModbusTCPOptions, ModbusRTUOptions
+from tcp_pool import TCP_POOL, PipelinedTcpConnection
+from frame_log import AsyncReplayClient
+from hot_log import EventLogger
+logger = logging.getLogger(__name__)
+hot_logger = EventLogger(__name__)
+
+
+def inter_frame_silence(baudrate: int | None) -> float:
+    """ Modbus RTU t3.5 in seconds: 3.5 characters of 11 bits, fixed at 1.75 ms above 19200 baud.
+        0 for TCP (baudrate None).
+    """
+    if not baudrate: return 0
+    if baudrate > 19200: return 0.00175
+    return 3.5 * 11 / baudrate
+
+
+class AsyncClient(Client):
+    """ asyncio variant of Client built on pymodbus' async TCP and serial clients.
+
+        Read planning, decoding and hole learning are shared with Client. All methods that
+        talk to the bus are coroutines with the same names and parameters as in Client.
+        Must be instantiated inside a running event loop, as required by pymodbus.
+        On a serial bus consecutive frames are separated by the RTU inter-frame silence.
+    """
+    tcp_client_class = AsyncModbusTcpClient
+    serial_client_class = AsyncModbusSerialClient
+    replay_client_class = AsyncReplayClient
+
+    def __init__(self, cl_options: ModbusTCPOptions | ModbusRTUOptions):
+        super().__init__(cl_options)
+        self.silence = inter_frame_silence(self.baudrate)
+        self._last_frame_end = 0.0
+
+    def _create_client(self, cl_options: ModbusTCPOptions | ModbusRTUOptions):
+        if isinstance(cl_options, ModbusTCPOptions) and cl_options.pipeline_depth > 0 and not cl_options.replay_path:
+            return TCP_POOL.acquire(cl_options.host, cl_options.port, cl_options.pipeline_depth)
+        return super()._create_client(cl_options)
+
+    @property
+    def pipelined(self) -> bool:
+        """ True if block reads can be issued concurrently """
+        return isinstance(self.client, PipelinedTcpConnection) and self.client.depth > 1
+
+    async def _request(self, method, **kwargs):
+        """ Issue a request, waiting out the inter-frame silence after the previous frame first """
+        if not self.silence: return await method(**kwargs)
+        remaining = self._last_frame_end + self.silence - perf_counter()
+        if remaining > 0: await asyncio.sleep(remaining)
+        try:
+            return await method(**kwargs)
+        finally:
+            self._last_frame_end = perf_counter()
+
+    async def _read(self, address, count, slave_id, register_type):
+        if register_type == RegisterTypes.HOLDING_REGISTER:
+            result = await self._request(self.client.read_holding_registers,   address=    address-1,
+                                                                                count=      count,
+                                                                                slave=      slave_id)
+        elif register_type == RegisterTypes.INPUT_REGISTER:
+            result = await self._request(self.client.read_input_registers,     address=    address-1,
+                                                                                count=      count,
+                                                                                slave=      slave_id)
+        else:
+            logger.info(f"unsupported register type {register_type}")
+            raise ValueError(f"unsupported register type {register_type}")
+        if self.capture is not None: self._capture_read(address, count, slave_id, register_type, result)
+        return result
+
+    async def _timed_read(self, server:Server, group:str, address, count, slave_id, register_type):
+        start = perf_counter()
+        try:
+            result = await self._read(address, count, slave_id, register_type)
+        except ModbusException:
+            METRICS.count_timeout(self.nickname)
+            if self.capture is not None: self._capture_read(address, count, slave_id, register_type)
+            raise
+        METRICS.observe_request(self.nickname, server.nickname, group, perf_counter() - start)
+        return result
+
+    async def read_registers(self, server:Server, register_name:str, register_info:dict | None = None):
+        """ Read a group of registers, see Client.read_registers """
+        if register_info is not None:
+            _warn_register_info()
+            result = await self._timed_read(server, register_name, register_info["addr"], register_info["count"],
+                                            server.device_addr, register_info["register_type"])
+            if result.isError():
+                self._handle_error_response(result)
+                raise Exception(f"Error reading register {register_name}")
+            return self._scaled_value(server, result.registers, register_info)
+
+        table = server.table
+        i = table.index[register_name]
+        address = table.addresses[i]
+        count = table.counts[i]
+        register_type = table.register_types[i]
+
+        result = await self._timed_read(server, register_name, address, count, server.device_addr, register_type)
+
+        if result.isError():
+            self._handle_error_response(result)
+            raise Exception(f"Error reading register {register_name}")
+
+        val = self._register_value(server, i, result.registers)
+        hot_logger.debug("register_read", "Read %s (%s) of %s from address=%d, count=%d, slave_id=%s: value=%s",
+                         register_name, register_type, server, address, count, server.device_addr, val)
+        return val
+
+    async def read_server_registers(self, server:Server, register_names:frozenset | None = None) -> dict:
+        """ Read all registers of a server using coalesced block reads, see Client.read_server_registers """
+        cycle_start = perf_counter()
+        plan = self._read_plan(server, register_names)
+        read = lambda block: self._timed_read(server, block.label, block.address, block.count, block.slave_id, block.register_type)
+
+        if self.pipelined: results = await asyncio.gather(*(read(block) for block, _, _ in plan))
+        else: results = [await read(block) for block, _, _ in plan]
+
+        values = {}
+        for (block, layout, positions), result in zip(plan, results):
+            if result.isError():
+                if self._split_on_error(result, block):
+                    values.update(await self._read_block_members(server, block))
+                continue
+
+            values.update(self._decode_block(server, block, layout, positions, result.registers))
+
+        elapsed = perf_counter() - cycle_start
+        METRICS.observe_cycle(self.nickname, server.nickname, elapsed)
+        hot_logger.debug("server_cycle", "Read %d values of %s in %d blocks, %.1f ms", len(values), server, len(plan), elapsed * 1000)
+        return values
+
+    async def _read_block_members(self, server:Server, block:ReadBlock) -> dict:
+        values = {}
+        illegal = set()
+        for register_name, offset, count in block.members:
+            address = block.address + offset
+            result = await self._timed_read(server, register_name, address, count, block.slave_id, block.register_type)
+            if result.isError():
+                if self._handle_error_response(result) == 2: illegal.update(range(address, address+count))
+                hot_logger.error("read_error", "Error reading register %s", register_name, key=(self.nickname, block.slave_id))
+                continue
+            values[register_name] = self._register_value(server, server.table.index[register_name], result.registers)
+
+        self._learn_holes(block, illegal, all_ok=len(values) == len(block.members))
+        return values
+
+    async def write_registers(self, value:float, server:Server, register_name: str, register_info:dict):
+        """ Write to an individual register, see Client.write_registers """
+        address, values, slave_id = self._prepare_write(value, server, register_name, register_info)
+        result = await self._request(self.client.write_registers, address=address-1, values=values, slave=slave_id)
+        if self.capture is not None: self._capture_write(address, values, slave_id, result)
+        if result.isError():
+            self._handle_error_response(result)
+            raise Exception(f"Error writing register {register_name}")
+        return result
+
+    async def write_server_registers(self, server:Server, values:dict) -> dict:
+        """ Write several write_parameters in batches and read them back, see Client.write_server_registers """
+        readback = {}
+        for batch in self._plan_writes(server, values):
+            logger.info(f"Writing {len(batch.members)} parameters to {batch.count} registers at address={batch.address}, slave_id={batch.slave_id}")
+            start = perf_counter()
+            result = await self._request(self.client.write_registers, address=batch.address-1, values=batch.values, slave=batch.slave_id)
+            METRICS.observe_request(self.nickname, server.nickname, "write", perf_counter() - start)
+            if self.capture is not None: self._capture_write(batch.address, batch.values, batch.slave_id, result)
+            if result.isError():
+                self._handle_error_response(result)
+                logger.error(f"Error writing registers {[m[0] for m in batch.members]}")
+                continue
+
+            result = await self._timed_read(server, "write", batch.address, batch.count, batch.slave_id, batch.register_type)
+            if result.isError():
+                self._handle_error_response(result)
+                logger.error(f"Error reading back registers {[m[0] for m in batch.members]}")
+                continue
+            readback.update(self._decode_write_batch(server, batch, result.registers))
+        return readback
+
+    async def is_available(self, server:Server, register_name="Device type code") -> bool:
+        """ Async counterpart of Server.is_available, reads a single register.
+            Falls back to the first register if the server has no register_name.
+        """
+        table = server.table
+        i = table.index.get(register_name, 0)
+        try:
+            response = await self._timed_read(server, "probe", table.addresses[i], table.counts[i],
+                                              server.device_addr, table.register_types[i])
+        except ModbusException as e:
+            logger.info(f"Server {server} unavailable: {e}")
+            return False
+        if response.isError():
+            self._handle_error_response(response)
+            return False
+        return True
+
+    async def read_modelcode(self, server:Server, register_info:dict):
+        """ Read the device type code described by register_info, which need not be in server.registers,
+            e.g. to revalidate a model restored from model_cache.ModelCache.
+        """
+        result = await self._timed_read(server, "probe", register_info["addr"], register_info["count"],
+                                        server.device_addr, register_info["register_type"])
+        if result.isError():
+            self._handle_error_response(result)
+            raise Exception(f"Error reading device type code of {server}")
+        return self._scaled_value(server, result.registers, register_info)
+
+    async def read_model(self, server:Server, device_type_code_param_key="Device type code"):
+        """ Async counterpart of Server.read_model """
+        logger.info(f"Reading model for server {server}")
+        modelcode = await self.read_registers(server, device_type_code_param_key)
+        server.set_model(modelcode)
+
+    async def connect(self, num_retries=2, sleep_interval=None):
+        """ Connect, see Client.connect """
+        logger.info(f"Connecting to client {self}")
+
+        for i in range(num_retries):
+            connected: bool = await self.client.connect()
+            if connected: break
+
+            self.breaker.record_failure()
+            delay = sleep_interval if sleep_interval is not None else self.breaker.retry_delay()
+            logger.info(f"Couldn't connect to {self}. Retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+        if not connected:
+            logger.error(f"Client Connection Issue after {num_retries} attempts.")
+            raise ConnectionError(f"Client {self} Connection Issue")
+
+        self.breaker.record_success()
+        logger.info(f"Sucessfully connected to {self}")
+
+    def close(self):
+        logger.info(f"Closing connection to {self}")
+        if isinstance(self.client, PipelinedTcpConnection): TCP_POOL.release(self.client)
+        else: self.client.close()
+        if self.capture is not None: self.capture.close()
@@ -0,0 +1,309 @@
+import asyncio
+import logging
+import os
+import signal
+import hot_log
+from time import perf_counter
+from typing import Callable
+from async_client import AsyncClient
+from bus_scheduler import BusScheduler
+from loader import Options, diff_options, load_options
+from model_cache import ModelCache
+from write_worker import WriteWorker
+from modbus_mqtt import MqttClient
+from server import Server
+logger = logging.getLogger(__name__)
+
+"""
+    asyncio polling engine:
+    Every AsyncClient (one bus or gateway) is driven by its own BusScheduler coroutine, so servers
+    on different buses are read concurrently and a slow or unreachable gateway only delays its own
+    servers. Servers sharing a client are read one after another, as they share the bus.
+    Decoded values are handed to a single publisher coroutine through an asyncio.Queue.
+
+    Live reload:
+    With an options file, run() watches it (or reloads at once on SIGHUP) and Engine.reload applies
+    changes while polling goes on. Only clients and servers that were added, removed or changed are
+    stopped or started, the other connections, their cached models and read plans and the MQTT
+    session are kept. Poll intervals and aggregation windows of a server are changed in place.
+    Changes that need a restart (MQTT connection, cache paths, see loader.LIVE_FIELDS) are
+    logged and not applied.
+"""
+
+PUBLISH_QUEUE_SIZE = 10000
+DRAIN_TICK = 0.1                                # seconds between batches of the store-and-forward drain
+RELOAD_CHECK_INTERVAL = 0.25                    # seconds between checks of the options file for changes
+WINDOW_TICK = 1.0                               # seconds between closing aggregation windows no sample closed
+
+
+async def connect_client(client: AsyncClient):
+    """ Connect the client, retrying with the backoff of its circuit breaker without blocking
+        the other clients until the connection succeeds.
+        Model reads and discovery of its servers are SetupJobs of the BusScheduler.
+    """
+    while True:
+        try:
+            await client.connect(num_retries=1)
+            return
+        except ConnectionError:
+            delay = client.breaker.retry_delay()
+            logger.error(f"Client {client} unreachable, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def publish_worker(mqtt_client: MqttClient, publish_q: asyncio.Queue):
+    """ Publish decoded values from the queue. paho's publish only enqueues, so this never blocks. """
+    while True:
+        server, values = await publish_q.get()
+        mqtt_client.publish_values(server, values)
+        publish_q.task_done()
+
+
+async def metrics_worker(mqtt_client: MqttClient, interval: float):
+    """ Periodically publish metrics to the diagnostics topic """
+    while True:
+        await asyncio.sleep(interval)
+        mqtt_client.publish_metrics()
+
+
+async def drain_worker(mqtt_client: MqttClient):
+    """ Publish messages buffered during a broker outage, so a reconnect does not flood the broker.
+        Each tick drains the live messages that were queued behind the backlog since the last tick plus
+        mqtt_client.drain_rate per second, so the backlog shrinks at drain_rate even under heavy live load.
+    """
+    last = mqtt_client.state_messages
+    while True:
+        await asyncio.sleep(DRAIN_TICK)
+        live, last = mqtt_client.state_messages - last, mqtt_client.state_messages
+        mqtt_client.drain_buffer(live + max(1, round(mqtt_client.drain_rate * DRAIN_TICK)))
+
+
+async def window_worker(mqtt_client: MqttClient):
+    """ Close aggregation windows that ended without a later sample, e.g. of a slow or failing server """
+    while True:
+        await asyncio.sleep(WINDOW_TICK)
+        mqtt_client.flush_windows()
+
+
+def _mtime(path: str) -> float | None:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+async def options_watcher(engine: "Engine", path: str, interval: float = RELOAD_CHECK_INTERVAL):
+    """ Reload the options file whenever its modification time changes, or at once on SIGHUP.
+        Options failing validation are logged and the running configuration is kept.
+    """
+    loop = asyncio.get_running_loop()
+    hangup = asyncio.Event()
+    try:
+        loop.add_signal_handler(signal.SIGHUP, hangup.set)
+    except (AttributeError, NotImplementedError, ValueError, RuntimeError):    # no SIGHUP on Windows or outside the main thread
+        hangup = None
+
+    mtime = _mtime(path)
+    try:
+        while True:
+            if hangup is None: await asyncio.sleep(interval)
+            else:
+                try:
+                    await asyncio.wait_for(hangup.wait(), interval)
+                except asyncio.TimeoutError:
+                    pass
+            current = _mtime(path)
+            if current == mtime and not (hangup is not None and hangup.is_set()): continue
+            if hangup is not None: hangup.clear()
+            mtime = current
+            try:
+                await engine.reload(load_options(path))
+            except Exception as e:
+                logger.error(f"Could not reload options from {path}: {e}")
+    finally:
+        if hangup is not None: loop.remove_signal_handler(signal.SIGHUP)
+
+
+class Engine:
+    """ The clients, servers and BusSchedulers of run(), see module docstring.
+
+        Parameters:
+        -----------
+            - clients: list[AsyncClient]: clients to poll
+            - servers: list[Server]: servers of the clients
+            - mqtt_client: MqttClient: connected MQTT client
+            - poll_interval: float: default for registers without an interval in ServerOptions.poll_intervals
+            - write_debounce: float: seconds MQTT /set messages are collected before they are written
+            - model_cache_path: str: models and register maps cache ("" disables)
+            - options: Options | None: the options clients and servers were built from, required by reload
+            - server_factory: Callable: (ServerOptions, clients) -> Server for reloaded servers, sharding.build_server if None
+    """
+    def __init__(self, clients: list[AsyncClient], servers: list[Server], mqtt_client: MqttClient, poll_interval: float = 5,
+                 write_debounce: float = 0.5, model_cache_path: str = "", options: Options | None = None,
+                 server_factory: Callable | None = None):
+        if server_factory is None:
+            from sharding import build_server
+            server_factory = build_server
+        self.clients = list(clients)
+        self.servers = list(servers)
+        self.mqtt_client = mqtt_client
+        self.poll_interval = poll_interval
+        self.options = options
+        self.server_factory = server_factory
+        self.model_cache = ModelCache(model_cache_path)
+        self.publish_q: asyncio.Queue = asyncio.Queue(maxsize=PUBLISH_QUEUE_SIZE)
+        self.schedulers: dict[AsyncClient, BusScheduler] = {}      # shared with the WriteWorker
+        self.write_worker = WriteWorker(mqtt_client, self.schedulers, write_debounce)
+
+        self._tasks: dict[AsyncClient, asyncio.Task] = {}           # polling task per client
+        self._failed: asyncio.Future | None = None                  # set to the error of the first task that fails
+
+    def _start_client(self, client: AsyncClient):
+        scheduler = BusScheduler(client, [s for s in self.servers if s.connected_client is client], self.poll_interval,
+                                 on_ready=self.mqtt_client.publish_discovery_topics,
+                                 on_availability=self.mqtt_client.publish_availability,
+                                 model_cache=self.model_cache)
+        self.schedulers[client] = scheduler
+        self._tasks[client] = self._watch(asyncio.create_task(self._client_task(scheduler), name=f"poll {client}"))
+
+    async def _client_task(self, scheduler: BusScheduler):
+        await connect_client(scheduler.client)
+        await scheduler.run(self.publish_q)
+
+    async def _stop_client(self, client: AsyncClient):
+        task = self._tasks.pop(client)
+        self.schedulers[client].stop()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        del self.schedulers[client]
+        client.close()
+
+    def _watch(self, task: asyncio.Task) -> asyncio.Task:
+        """ An error in any task ends run(), as with asyncio.gather over all tasks """
+        def done(task):
+            if not task.cancelled() and task.exception() is not None and not self._failed.done():
+                self._failed.set_exception(task.exception())
+        task.add_done_callback(done)
+        return task
+
+    async def run(self, metrics_interval: float = 60, metrics_ha_sensors: bool = False, options_path: str = ""):
+        """ Poll all clients until a task fails or this coroutine is cancelled, see async_engine.run """
+        self._failed = asyncio.get_running_loop().create_future()
+        self.mqtt_client.event_loop = asyncio.get_running_loop()
+        self.mqtt_client.remove_stale_discovery_topics(self.servers)
+        self.write_worker.attach(self.servers)
+        for client in self.clients: self._start_client(client)
+
+        tasks = [asyncio.create_task(publish_worker(self.mqtt_client, self.publish_q), name="mqtt publish"),
+                 asyncio.create_task(window_worker(self.mqtt_client), name="aggregation windows")]
+        if self.mqtt_client.buffer is not None:
+            tasks.append(asyncio.create_task(drain_worker(self.mqtt_client), name="mqtt drain"))
+        if metrics_interval > 0:
+            if metrics_ha_sensors: self.mqtt_client.publish_metrics_discovery(self.clients)
+            tasks.append(asyncio.create_task(metrics_worker(self.mqtt_client, metrics_interval), name="metrics"))
+        if options_path and self.options is not None:
+            tasks.append(asyncio.create_task(options_watcher(self, options_path), name="options watcher"))
+        for task in tasks: self._watch(task)
+
+        try:
+            await self._failed
+        finally:
+            for scheduler in self.schedulers.values(): scheduler.stop()
+            for task in [*tasks, *self._tasks.values()]: task.cancel()
+            for client in self.clients: client.close()
+            self.mqtt_client.event_loop = None
+
+    async def reload(self, options: Options) -> bool:
+        """ Apply newly loaded options to the running engine.
+            Returns False without changing anything if a field that needs a restart changed,
+            raises without changing anything if a new client or server cannot be created.
+        """
+        if self.options is None: raise ValueError("Engine was created without the options it runs, cannot reload")
+        diff = diff_options(self.options, options)
+        if diff.restart_required:
+            logger.warning(f"Not reloading options, restart to apply changes of {diff.restart_required}")
+            return False
+        if not diff:
+            logger.info(f"Options unchanged")
+            return True
+        start = perf_counter()
+        # build the new clients and servers before changing anything, so options that fail to load keep the running ones
+        replaced = {cl_options.name for cl_options in diff.clients_removed + diff.clients_changed}
+        new_clients: list[AsyncClient] = []
+        try:
+            for cl_options in diff.clients_added + diff.clients_changed: new_clients.append(AsyncClient(cl_options))
+            clients = [client for client in self.clients if client.name not in replaced] + new_clients
+            new_servers = [self.server_factory(sr_options, clients) for sr_options in diff.servers_added + diff.servers_changed]
+        except Exception:
+            for client in new_clients: client.close()
+            raise
+
+        self._apply_settings(options)
+        servers = {server.name: server for server in self.servers}
+        # the servers of a removed or changed client are in servers_removed or servers_changed
+        for sr_options in diff.servers_removed + diff.servers_changed:
+            server = servers[sr_options.name]
+            self.servers.remove(server)
+            self.schedulers[server.connected_client].remove_server(server)
+            self.mqtt_client.forget_server(server)
+        for client in [client for client in self.clients if client.name in replaced]:
+            await self._stop_client(client)
+        self.clients = clients
+
+        for server in new_servers:
+            self.servers.append(server)
+            # servers of new clients are passed to their scheduler when it starts
+            if server.connected_client in self.schedulers: self.schedulers[server.connected_client].add_server(server)
+        for client in new_clients: self._start_client(client)
+
+        for sr_options in diff.servers_updated:
+            server = servers[sr_options.name]
+            server.poll_intervals = sr_options.poll_intervals
+            server.aggregate_windows = sr_options.aggregate_windows
+            server.aggregate_energy = sr_options.aggregate_energy
+            self.schedulers[server.connected_client].reschedule(server)
+            # add or remove the sensors of changed aggregation windows, unchanged discovery configs are not sent
+            if server.model is not None: self.mqtt_client.publish_discovery_topics(server)
+
+        self.write_worker.attach(self.servers)
+        self.mqtt_client.remove_stale_discovery_topics(self.servers)
+        self.options = options
+        logger.info(f"Reloaded options in {(perf_counter() - start) * 1000:.1f} ms: "
+                    f"clients +{len(diff.clients_added)} -{len(diff.clients_removed)} ~{len(diff.clients_changed)}, "
+                    f"servers +{len(diff.servers_added)} -{len(diff.servers_removed)} ~{len(diff.servers_changed)}, "
+                    f"{len(diff.servers_updated)} updated in place, settings {list(diff.settings)}")
+        return True
+
+    def _apply_settings(self, options: Options):
+        """ Apply the loader.LIVE_FIELDS of options """
+        change_filter = self.mqtt_client.change_filter
+        change_filter.deadband, change_filter.deadband_rel = options.mqtt_deadband, options.mqtt_deadband_rel
+        change_filter.heartbeat_interval = options.mqtt_heartbeat_interval
+        self.mqtt_client.drain_rate = options.mqtt_drain_rate
+        self.write_worker.debounce = options.mqtt_write_debounce
+        hot_log.configure(options.log_rate_limits, options.log_sampling)
+
+        if options.poll_interval != self.poll_interval:
+            self.poll_interval = options.poll_interval
+            for scheduler in self.schedulers.values():
+                scheduler.default_interval = options.poll_interval
+                for server in scheduler.servers: scheduler.reschedule(server)
+
+
+async def run(clients: list[AsyncClient], servers: list[Server], mqtt_client: MqttClient, poll_interval: float = 5,
+              write_debounce: float = 0.5, metrics_interval: float = 60, metrics_ha_sensors: bool = False,
+              model_cache_path: str = "", log_rate_limits: dict | None = None, log_sampling: dict | None = None,
+              options: Options | None = None, options_path: str = "", server_factory: Callable | None = None):
+    """ Set up and poll all clients concurrently. Cycle time is bounded by the slowest bus.
+
+        poll_interval is the default for registers without an interval in ServerOptions.poll_intervals.
+        MQTT /set messages are collected for write_debounce seconds before they are written.
+        Metrics are published every metrics_interval seconds (0 disables), optionally as HA sensors.
+        Models and register maps are cached in model_cache_path ("" disables) for fast restarts.
+        log_rate_limits and log_sampling set the policies of the per-cycle log records, see hot_log.
+        With the options clients and servers were built from and their options_path, changes of the
+        file are applied without a restart, see Engine.reload. server_factory builds added servers.
+    """
+    hot_log.configure(log_rate_limits, log_sampling)
+    engine = Engine(clients, servers, mqtt_client, poll_interval, write_debounce, model_cache_path, options, server_factory)
+    await engine.run(metrics_interval, metrics_ha_sensors, options_path)
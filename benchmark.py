@@ -0,0 +1,699 @@
+import argparse
+import logging
+import os
+import struct
+from time import perf_counter
+from enums import DataType, Endian
+from codec import BlockLayout
+logger = logging.getLogger(__name__)
+
+"""
+    Micro-benchmarks for the hot paths of the add-on. Run e.g.
+        python benchmark.py decode
+"""
+
+BENCH_DTYPES = [DataType.U16, DataType.I16, DataType.U32, DataType.I32, DataType.U64,
+                DataType.I64, DataType.F32, DataType.F64, DataType.UTF8]
+UTF8_REGISTERS = 10
+
+
+def _legacy_decoded(registers, dtype):
+    """ Per-register decoding as hand-rolled in Server subclasses before DataType.decode existed """
+    if dtype == DataType.U16: return registers[0]
+    if dtype == DataType.I16: return registers[0] - 0x10000 if registers[0] & 0x8000 else registers[0]
+    if dtype in (DataType.U32, DataType.I32, DataType.U64, DataType.I64):
+        val = 0
+        for r in registers: val = (val << 16) | r
+        bits = 16*len(registers)
+        if dtype in (DataType.I32, DataType.I64) and val & (1 << (bits-1)): val -= 1 << bits
+        return val
+    if dtype == DataType.F32: return struct.unpack(">f", struct.pack(">HH", *registers))[0]
+    if dtype == DataType.F64: return struct.unpack(">d", struct.pack(">HHHH", *registers))[0]
+    if dtype == DataType.UTF8:
+        return "".join(chr(r >> 8) + chr(r & 0xFF) for r in registers).strip("\x00 ")
+    raise NotImplementedError(f"Unsupported dtype {dtype}")
+
+
+def _synthetic_block(repeats):
+    """ Returns fields [(name, offset, count, dtype)] and raw registers covering all benchmarked dtypes """
+    fields, registers = [], []
+    for i in range(repeats):
+        for dtype in BENCH_DTYPES:
+            value = "SN-0123456789" if dtype is DataType.UTF8 else (1.5 if dtype.value[0] == "F" else 1234)
+            regs = dtype.encode_registers(value)
+            if dtype is DataType.UTF8: regs += [0]*(UTF8_REGISTERS - len(regs))
+            fields.append((f"{dtype.value} {i}", len(registers), len(regs), dtype))
+            registers += regs
+    return fields, registers
+
+
+def _timeit(fn, iterations):
+    start = perf_counter()
+    for _ in range(iterations): fn()
+    return (perf_counter() - start) / iterations
+
+
+def bench_decode(iterations=2000, repeats=10):
+    """ Compare the legacy per-register _decoded path with DataType.decode and the batched BlockLayout """
+    from server import Server
+
+    fields, registers = _synthetic_block(repeats)
+    layout = BlockLayout(fields, len(registers))
+
+    def legacy():
+        for name, offset, count, dtype in fields: _legacy_decoded(registers[offset:offset+count], dtype)
+
+    def per_register():
+        for name, offset, count, dtype in fields: Server._decoded(registers[offset:offset+count], dtype)
+
+    def batched():
+        layout.decode(registers)
+
+    print(f"Decoding {len(fields)} values ({len(registers)} registers) per iteration")
+    results = {}
+    for label, fn in (("legacy _decoded", legacy), ("DataType.decode", per_register), ("BlockLayout.decode", batched)):
+        t = _timeit(fn, iterations)
+        results[label] = t
+        print(f"{label:<22}{t*1e6:10.1f} us/block{t*1e9/len(fields):10.0f} ns/value")
+
+    print("\nPer dtype, legacy vs DataType.decode (ns/value)")
+    for dtype in BENCH_DTYPES:
+        offset, count = next((o, c) for _, o, c, d in fields if d is dtype)
+        regs = registers[offset:offset+count]
+        t_legacy = _timeit(lambda: _legacy_decoded(regs, dtype), iterations*10)
+        t_new = _timeit(lambda: Server._decoded(regs, dtype), iterations*10)
+        print(f"{dtype.value:<6}{t_legacy*1e9:10.0f}{t_new*1e9:10.0f}")
+    return results
+
+
+def _counting_publish(counter: list):
+    """ Stand-in for paho's publish that counts messages and reports them accepted, as MqttClient checks rc """
+    from paho.mqtt.client import MQTTMessageInfo
+    accepted = MQTTMessageInfo(0)
+    def publish(topic, payload=None, qos=0, retain=False):
+        counter[0] += 1
+        return accepted
+    return publish
+
+
+def _bench_mqtt_client(**overrides):
+    """ MqttClient with publish replaced by a no-op, so only the client-side overhead is measured """
+    from types import SimpleNamespace
+    from modbus_mqtt import MqttClient
+
+    options = SimpleNamespace(mqtt_user="user", mqtt_password="pw", mqtt_base_topic="modbus",
+                              mwtt_ha_discovery_topic="homeassistant", mqtt_deadband=0, mqtt_deadband_rel=0,
+                              mqtt_heartbeat_interval=0, discovery_cache_path="", mqtt_aggregate_state=False,
+                              mqtt_buffer_path="", mqtt_buffer_max_bytes=0, mqtt_drain_rate=0)
+    for k, v in overrides.items(): setattr(options, k, v)
+    mqtt_client = MqttClient(options)
+    mqtt_client.publish = _counting_publish([0])
+    return mqtt_client
+
+
+def _bench_server(n_registers):
+    from types import SimpleNamespace
+    registers = {f"Phase A power (W) {i}": {"addr": i, "count": 1, "dtype": DataType.U16, "multiplier": 1,
+                                            "unit": "W", "device_class": "power", "register_type": None}
+                 for i in range(n_registers)}
+    return SimpleNamespace(nickname="Inverter1", registers=registers, write_parameters={}, aggregate_windows={},
+                           aggregate_energy=False)
+
+
+def bench_topics(iterations=20, n_registers=200):
+    """ Per-publish overhead of building topics with slugify/ f-strings vs the compiled topic table """
+    from modbus_mqtt import slugify
+
+    mqtt_client = _bench_mqtt_client()
+    server = _bench_server(n_registers)
+    mqtt_client.compile_topics(server)
+    names = list(server.registers)
+    base = mqtt_client.base_topic
+
+    def legacy_topic():
+        for name in names: mqtt_client.publish(f"{base}/{server.nickname}/{slugify(name)}/state", 1)
+
+    def lookup_topic():
+        state = mqtt_client.topics[server.nickname].state
+        for name in names: mqtt_client.publish(state[name], 1)
+
+    def legacy_publish_to_ha():
+        for name in names:
+            if not mqtt_client.change_filter.should_publish(server.nickname, name, 1, server.registers.get(name)): continue
+            mqtt_client.publish(f"{base}/{server.nickname}/{slugify(name)}/state", 1)
+
+    def publish_to_ha():
+        for name in names: mqtt_client.publish_to_ha(name, 1, server)
+
+    results = {}
+    for label, fn in (("topic: f-string/slugify", legacy_topic), ("topic: compiled lookup", lookup_topic),
+                      ("publish_to_ha: before", legacy_publish_to_ha), ("publish_to_ha: after", publish_to_ha)):
+        t = _timeit(fn, iterations*100) / n_registers
+        results[label] = t
+        print(f"{label:<26}{t*1e9:10.0f} ns/publish")
+    return results
+
+
+def bench_registers(iterations=2000, n_registers=100):
+    """ Memory and per-read overhead of the dict-of-dicts register map vs the compiled RegisterTable """
+    import tracemalloc
+    from client import Client
+    from read_planner import plan_reads
+    from register_table import RegisterTable
+    from server import Server
+    from simulator import synthetic_register_map, register_values
+
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    registers = synthetic_register_map(n_registers)
+    dict_bytes = tracemalloc.get_traced_memory()[0] - start
+    table = RegisterTable(registers)
+    table_bytes = tracemalloc.get_traced_memory()[0] - start - dict_bytes
+    tracemalloc.stop()
+    print(f"{n_registers} registers: dict-of-dicts {dict_bytes/1024:.1f} KiB, RegisterTable {table_bytes/1024:.1f} KiB")
+
+    raw = register_values(registers)                                # index = 1-indexed address
+    blocks = plan_reads(registers, 1)
+    layouts = [BlockLayout([(name, offset, count, registers[name]["dtype"]) for name, offset, count in block.members],
+                           block.count) for block in blocks]
+    positions = [tuple(table.index[name] for name in layout.order) for layout in layouts]
+    block_registers = [raw[block.address:block.end] for block in blocks]
+
+    def single_dict():
+        for info in registers.values():
+            address, count, _ = info["addr"], info["count"], info["register_type"]
+            Client._scale(Server._decoded(raw[address:address+count], info["dtype"]), info)
+
+    def single_table():
+        for i in range(len(table)):
+            address, count, _ = table.addresses[i], table.counts[i], table.register_types[i]
+            table.scale(i, Server._decoded(raw[address:address+count], table.dtypes[i]))
+
+    def blocks_dict():
+        for layout, regs in zip(layouts, block_registers):
+            {name: Client._scale(val, registers[name]) for name, val in layout.decode(regs).items()}
+
+    def blocks_table():
+        names, scale = table.names, table.scale
+        for layout, pos, regs in zip(layouts, positions, block_registers):
+            {names[i]: scale(i, val) for i, val in zip(pos, layout.decode_values(regs))}
+
+    results = {"dict_bytes": dict_bytes, "table_bytes": table_bytes}
+    for label, fn in (("per register: dict", single_dict), ("per register: table", single_table),
+                      ("block decode: dict", blocks_dict), ("block decode: table", blocks_table)):
+        t = _timeit(fn, iterations) / n_registers
+        results[label] = t
+        print(f"{label:<24}{t*1e9:10.0f} ns/register")
+    return results
+
+
+class SimulatedGateway:
+    """ Minimal Modbus TCP gateway answering function codes 3 and 4 after a fixed latency.
+        Requests on one connection are processed concurrently, like a gateway forwarding to several devices.
+    """
+    def __init__(self, latency=0.005, host="127.0.0.1"):
+        self.latency = latency
+        self.host = host
+        self.port = None
+        self._server = None
+
+    async def start(self):
+        import asyncio
+        self._server = await asyncio.start_server(self._handle, self.host, 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        import asyncio
+        from tcp_pool import MBAP_HEADER, READ_REQUEST
+
+        async def respond(tid, slave, pdu):
+            await asyncio.sleep(self.latency)
+            function_code, address, count = READ_REQUEST.unpack(pdu)
+            body = struct.pack(f">BB{count}H", function_code, 2*count, *[(address + i) & 0xFFFF for i in range(count)])
+            writer.write(MBAP_HEADER.pack(tid, 0, len(body) + 1, slave) + body)
+
+        try:
+            while True:
+                tid, _, length, slave = MBAP_HEADER.unpack(await reader.readexactly(MBAP_HEADER.size))
+                asyncio.create_task(respond(tid, slave, await reader.readexactly(length - 1)))
+        except asyncio.IncompleteReadError:
+            writer.close()
+
+
+def bench_pipeline(n_requests=400, latency=0.005, depths=(1, 4, 8)):
+    """ Throughput of one pipelined TCP connection against a simulated gateway at different depths """
+    import asyncio
+    from tcp_pool import PipelinedTcpConnection
+
+    async def run():
+        gateway = SimulatedGateway(latency)
+        await gateway.start()
+        results = {}
+        for depth in depths:
+            connection = PipelinedTcpConnection(gateway.host, gateway.port, depth)
+            await connection.connect()
+            start = perf_counter()
+            responses = await asyncio.gather(*(connection.read_holding_registers(i, 10, 1) for i in range(n_requests)))
+            elapsed = perf_counter() - start
+            connection.close()
+
+            assert all(r.registers[0] == i for i, r in enumerate(responses)), "responses matched to wrong requests"
+            results[depth] = n_requests / elapsed
+            print(f"depth {depth:<3}{n_requests/elapsed:10.0f} requests/s")
+        await asyncio.sleep(0.05)                                   # let the gateway see the connections close
+        await gateway.stop()
+        return results
+
+    print(f"{n_requests} requests, simulated gateway latency {latency*1e3:.1f} ms")
+    return asyncio.run(run())
+
+
+def _percentiles(samples: list, qs=(0.5, 0.9, 0.99)) -> dict:
+    ordered = sorted(samples)
+    if not ordered: return {f"p{int(q*100)}": None for q in qs}
+    return {f"p{int(q*100)}": ordered[min(len(ordered)-1, int(q*len(ordered)))] for q in qs}
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def run_e2e_scenario(n_servers=10, n_registers=100, latency=0.0, transport="tcp", duration=5.0, pipeline_depth=0,
+                     model_cache_path="", aggregate_state=False):
+    """ Poll n_servers simulated servers through the async engine and publish to a stand-in MQTT client.
+
+        TCP: one client per server, all to the same simulator. RTU: all servers on one virtual serial bus.
+        Returns a dict with throughput, poll-cycle latency percentiles, memory and startup time.
+    """
+    import asyncio
+    import async_engine
+    from async_client import AsyncClient
+    from loader import ModbusTCPOptions, ModbusRTUOptions, ServerOptions
+    from simulator import ModbusSimulator, SimServer
+
+    cycle_times = []
+    first_cycle_done = {}
+
+    class TimedClient(AsyncClient):
+        async def read_server_registers(self, server, register_names=None):
+            start = perf_counter()
+            values = await super().read_server_registers(server, register_names)
+            cycle_times.append(perf_counter() - start)
+            first_cycle_done.setdefault(server.nickname, perf_counter())
+            return values
+
+    mqtt_client = _bench_mqtt_client(mqtt_aggregate_state=aggregate_state)
+    mqtt_client.subscribe = lambda *args, **kwargs: None
+    published = [0]
+    mqtt_client.publish = _counting_publish(published)
+
+    async def scenario():
+        simulator = ModbusSimulator(n_servers, n_registers, latency, transport)
+        await simulator.start()
+        rss_before = _rss_mb()
+        start = perf_counter()
+
+        n_clients = n_servers if transport == "tcp" else 1
+        options_class = ModbusTCPOptions if transport == "tcp" else ModbusRTUOptions
+        extra = {"pipeline_depth": pipeline_depth} if transport == "tcp" else {}
+        clients = [TimedClient(options_class(name=f"bus{i}", ha_display_name=f"bus{i}", **simulator.client_options(), **extra))
+                   for i in range(n_clients)]
+        servers = [SimServer(ServerOptions(name=f"sim{i}", ha_display_name=f"sim{i}", serialnum=f"SN{i}", server_type="SimServer",
+                                           connected_client=f"bus{i if transport == 'tcp' else 0}",
+                                           modbus_id=i + 1 if transport == "rtu" else 1), clients, n_registers)
+                   for i in range(n_servers)]
+
+        try:
+            await asyncio.wait_for(async_engine.run(clients, servers, mqtt_client, poll_interval=0, metrics_interval=0,
+                                                    model_cache_path=model_cache_path), duration)
+        except asyncio.TimeoutError:
+            pass
+        elapsed = perf_counter() - start
+        await simulator.stop()
+
+        startup = max(first_cycle_done.values()) - start if len(first_cycle_done) == n_servers else None
+        return {
+            "transport": transport,
+            "servers": n_servers,
+            "registers_per_server": n_registers,
+            "latency_s": latency,
+            "pipeline_depth": pipeline_depth,
+            "duration_s": elapsed,
+            "cycles": len(cycle_times),
+            "registers_per_s": len(cycle_times) * n_registers / elapsed,
+            "aggregate_state": aggregate_state,
+            "publishes_per_s": published[0] / elapsed,
+            "messages_per_cycle": published[0] / len(cycle_times) if cycle_times else None,
+            "cycle_latency_s": _percentiles(cycle_times),
+            "startup_s": startup,
+            "rss_mb": _rss_mb(),
+            "rss_delta_mb": _rss_mb() - rss_before,
+        }
+
+    return asyncio.run(scenario())
+
+
+def bench_e2e(servers=(1, 10, 50), n_registers=100, latency=0.0, transports=("tcp", "rtu"), duration=5.0,
+              pipeline_depth=0, output=None, aggregate_state=False):
+    """ End-to-end Client -> Server._decoded -> MqttClient.publish_to_ha throughput across scenarios, as JSON """
+    import json
+    import platform
+    from metrics import METRICS
+
+    results = []
+    for transport in transports:
+        for n_servers in servers:
+            METRICS.reset()
+            result = run_e2e_scenario(n_servers, n_registers, latency, transport, duration, pipeline_depth,
+                                      aggregate_state=aggregate_state)
+            logger.warning(f"{transport} {n_servers} servers: {result['registers_per_s']:.0f} registers/s")
+            results.append(result)
+
+    report = json.dumps({"python": platform.python_version(), "scenarios": results}, indent=2)
+    if output:
+        with open(output, "w") as f: f.write(report)
+    print(report)
+    return results
+
+
+def bench_startup(n_servers=10, n_registers=100, latency=0.02, transport="rtu", duration=3.0):
+    """ Time until every server completed its first poll cycle, without (cold) and with (warm) the model cache """
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_path = os.path.join(tmp, "model_cache.json")
+        results = {}
+        for label in ("cold", "warm"):
+            result = run_e2e_scenario(n_servers, n_registers, latency, transport, duration, model_cache_path=cache_path)
+            results[label] = result["startup_s"]
+            print(f"{label} start, {n_servers} servers ({transport}, {latency*1e3:.0f} ms latency): {result['startup_s']:.3f} s")
+    return results
+
+
+def _simulator_process(n_slaves, n_registers, latency, conn):
+    """ Run a TCP ModbusSimulator in its own process and send its port through conn """
+    import asyncio
+    from simulator import ModbusSimulator
+
+    async def serve():
+        simulator = ModbusSimulator(n_slaves, n_registers, latency, "tcp")
+        await simulator.start()
+        conn.send(simulator.port)
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+
+def bench_shards(workers=(1, 2, 4), n_servers=16, n_registers=100, n_gateways=4, duration=5.0):
+    """ Readings per second published by a ShardSupervisor for each worker count.
+
+        n_servers TCP servers are spread over n_gateways simulator processes, so the simulators do
+        not share a core with the supervisor. Scaling is bounded by the number of CPU cores.
+    """
+    import asyncio
+    import multiprocessing
+    from loader import ModbusTCPOptions, ServerOptions
+    from sharding import ShardSupervisor, WorkerSettings
+    from simulator import sim_server_factory
+
+    context = multiprocessing.get_context("spawn")
+    ports, simulators = [], []
+    for _ in range(n_gateways):
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(target=_simulator_process, args=(n_servers, n_registers, 0.0, child_conn), daemon=True)
+        process.start()
+        simulators.append(process)
+        ports.append(parent_conn.recv())
+
+    client_options = [ModbusTCPOptions(name=f"bus{i}", ha_display_name=f"bus{i}", type="TCP", host="127.0.0.1",
+                                       port=ports[i % n_gateways]) for i in range(n_servers)]
+    server_options = [ServerOptions(name=f"sim{i}", ha_display_name=f"sim{i}", serialnum=f"SN{i}", server_type="SimServer",
+                                    connected_client=f"bus{i}", modbus_id=i // n_gateways + 1) for i in range(n_servers)]
+    settings = WorkerSettings(poll_interval=0, metrics_interval=0, server_factory=sim_server_factory, log_level=logging.WARNING)
+
+    results = {}
+    for n_workers in workers:
+        mqtt_client = _bench_mqtt_client()
+        mqtt_client.subscribe = lambda *args, **kwargs: None
+        readings = [0]
+        publish_values = mqtt_client.publish_values
+        def count(server, values, publish_values=publish_values, readings=readings):
+            readings[0] += len(values)
+            publish_values(server, values)
+        mqtt_client.publish_values = count
+
+        supervisor = ShardSupervisor(mqtt_client, client_options, server_options, n_workers, settings)
+
+        async def run():
+            task = asyncio.create_task(supervisor.run())
+            await asyncio.sleep(duration / 2)                       # worker startup and model reads
+            start, before = perf_counter(), readings[0]
+            await asyncio.sleep(duration / 2)
+            rate = (readings[0] - before) / (perf_counter() - start)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return rate
+
+        results[n_workers] = asyncio.run(run())
+        print(f"{n_workers} workers: {results[n_workers]:10.0f} readings/s")
+
+    for process in simulators: process.terminate()
+    print(f"({os.cpu_count()} CPU cores)")
+    if (os.cpu_count() or 1) < max(workers) + n_gateways:
+        print("Fewer cores than workers and simulators: these numbers do not show how throughput scales with workers")
+    return results
+
+
+def bench_aggregate(n_registers=100, sample_interval=0.2, window=10.0, windows=20):
+    """ Messages and client-side cost of publishing every sample vs publishing per aggregation window.
+        Samples are fed with synthetic timestamps, so the benchmark does not wait for the windows.
+    """
+    from aggregation import WindowRing
+
+    results = {}
+    for label, windows_option in (("every sample", {}), ("aggregated", {"power": window})):
+        mqtt_client = _bench_mqtt_client()
+        published = [0]
+        mqtt_client.publish = _counting_publish(published)
+        server = _bench_server(n_registers)
+        server.aggregate_windows, server.aggregate_energy = windows_option, True
+        mqtt_client.compile_topics(server)
+        names = list(server.registers)
+        n_samples = int(windows * window / sample_interval)
+        samples = [{name: (i * 7 + j) % 1000 for j, name in enumerate(names)} for i in range(n_samples)]
+
+        start = perf_counter()
+        for i, values in enumerate(samples): mqtt_client.publish_values(server, values, i * sample_interval)
+        elapsed = perf_counter() - start
+        results[label] = {"us_per_sample": elapsed / (n_samples * n_registers) * 1e6, "messages": published[0]}
+        print(f"{label:<14}{results[label]['us_per_sample']:8.2f} us/sample{published[0]:10d} messages")
+
+    for capacity in (50, 300, 1024):
+        ring = WindowRing(window, capacity)
+        def close():
+            ring.n = capacity
+            return ring.close()
+        t = _timeit(close, 2000)
+        results[f"close {capacity}"] = t
+        print(f"window close, {capacity:>4} samples{t*1e6:8.2f} us")
+    return results
+
+
+def _legacy_read_registers(client, server, register_name):
+    """ Client.read_registers with the f-string info lines it had before hot_log """
+    client_logger = logging.getLogger("client")
+    table = server.table
+    i = table.index[register_name]
+    address, count, slave_id, register_type = table.addresses[i], table.counts[i], server.device_addr, table.register_types[i]
+    client_logger.info(f"Reading param {register_name} ({register_type}) of dtype={table.dtypes[i]} from {address=}, multiplier={table.multipliers[i]}, {count=}, {slave_id=}")
+    result = client._timed_read(server, register_name, address, count, slave_id, register_type)
+    if result.isError(): raise Exception(f"Error reading register {register_name}")
+    client_logger.info(f"Raw register begin value: {result.registers[0]}")
+    val = client._register_value(server, i, result.registers)
+    client_logger.info(f"Decoded Value = {val}")
+    return val
+
+
+def bench_logging(n_servers=50, n_registers=100, iterations=5, duration=5.0):
+    """ CPU cost of hot path logging at n_servers servers, with INFO disabled and with INFO written to /dev/null:
+        per-register reads with the former f-string lines vs hot_log records, and the async engine per reading.
+    """
+    from time import process_time
+    from pymodbus.pdu.register_read_message import ReadHoldingRegistersResponse
+    from client import Client
+    from loader import ModbusTCPOptions, ServerOptions
+    from simulator import SimServer, synthetic_register_map, register_values
+
+    raw = register_values(synthetic_register_map(n_registers))
+    responses = {}
+
+    class InstantModbus:
+        """ Answers from precomputed responses, so only the client-side cost is measured """
+        def __init__(self, **kwargs): pass
+        def read_holding_registers(self, address, count=1, slave=1):
+            key = (address, count)
+            if key not in responses: responses[key] = ReadHoldingRegistersResponse(raw[address+1:address+1+count], slave=slave)
+            return responses[key]
+
+    class BenchClient(Client):
+        tcp_client_class = InstantModbus
+
+    client = BenchClient(ModbusTCPOptions(name="bus", ha_display_name="bus", type="TCP", host="127.0.0.1", port=502))
+    servers = [SimServer(ServerOptions(name=f"sim{i}", ha_display_name=f"sim{i}", serialnum=f"SN{i}", server_type="SimServer",
+                                       connected_client="bus", modbus_id=i + 1), [client], n_registers) for i in range(n_servers)]
+    names = [list(server.registers) for server in servers]
+
+    class CountingHandler(logging.StreamHandler):
+        records = 0
+        def emit(self, record):
+            CountingHandler.records += 1
+            super().emit(record)
+
+    root = logging.getLogger()
+    devnull = open(os.devnull, "w")
+    handler = CountingHandler(devnull)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    saved_level, saved_handlers = root.level, root.handlers[:]
+    root.handlers = [handler]
+
+    def cpu(fn, reads):
+        start = process_time()
+        fn()
+        return (process_time() - start) / reads
+
+    results = {}
+    try:
+        for level in (logging.WARNING, logging.INFO):
+            root.setLevel(level)
+            for label, read in (("f-strings", _legacy_read_registers), ("hot_log", Client.read_registers)):
+                def per_register():
+                    for _ in range(iterations):
+                        for server, register_names in zip(servers, names):
+                            for register_name in register_names: read(client, server, register_name)
+                t = cpu(per_register, iterations * n_servers * n_registers)
+                results[f"read_registers {label} {logging.getLevelName(level)}"] = t
+                print(f"read_registers, {label:<10}{logging.getLevelName(level):<8}{t*1e6:8.2f} us/register")
+
+            before, records = process_time(), CountingHandler.records
+            scenario = run_e2e_scenario(n_servers, n_registers, duration=duration)
+            readings = scenario["cycles"] * n_registers
+            t = (process_time() - before) / readings
+            results[f"e2e {logging.getLevelName(level)}"] = t
+            print(f"async engine, {n_servers} servers, {logging.getLevelName(level):<8}{t*1e6:8.2f} us CPU/reading, "
+                  f"{CountingHandler.records - records} log records in {scenario['cycles']} server cycles")
+    finally:
+        root.setLevel(saved_level)
+        root.handlers = saved_handlers
+        devnull.close()
+    return results
+
+
+def bench_reload(n_servers=200, n_registers=100, poll_interval=0.5):
+    """ Time for single-server edits of a running engine to take effect, compared with a full start """
+    import asyncio
+    import dataclasses
+    import async_engine
+    from async_client import AsyncClient
+    from loader import ModbusTCPOptions, Options, ServerOptions
+    from simulator import ModbusSimulator, sim_server_factory
+
+    first_publish = {}                                              # server -> time its values were first published
+    mqtt_client = _bench_mqtt_client()
+    mqtt_client.subscribe = mqtt_client.unsubscribe = lambda *args, **kwargs: None
+    publish_values = mqtt_client.publish_values
+    def timed_publish_values(server, values, t=None):
+        first_publish.setdefault(server, perf_counter())
+        publish_values(server, values, t)
+    mqtt_client.publish_values = timed_publish_values
+
+    async def scenario():
+        simulator = ModbusSimulator(n_servers + 1, n_registers)
+        await simulator.start()
+        options = Options(
+            servers=[ServerOptions(f"sim{i}", f"sim{i}", f"SN{i}", "SimServer", f"bus{i}", 1) for i in range(n_servers)],
+            clients=[ModbusTCPOptions(f"bus{i}", f"bus{i}", **simulator.client_options()) for i in range(n_servers)],
+            mqtt_host="", mqtt_port=0, mqtt_user="", mqtt_password="", mwtt_ha_discovery_topic="homeassistant",
+            mqtt_base_topic="modbus", poll_interval=poll_interval, mqtt_buffer_path="", discovery_cache_path="",
+            model_cache_path="")
+        clients = [AsyncClient(cl) for cl in options.clients]
+        engine = async_engine.Engine(clients, [sim_server_factory(sr, clients) for sr in options.servers], mqtt_client,
+                                     poll_interval, options=options, server_factory=sim_server_factory)
+        start = perf_counter()
+        task = asyncio.create_task(engine.run(metrics_interval=0))
+        while len(first_publish) < n_servers: await asyncio.sleep(0.01)
+        results = {"full start": perf_counter() - start}
+        print(f"full start, {n_servers} servers: {results['full start']*1e3:.0f} ms until every server was published")
+
+        async def edit(label, options, target):
+            before = set(engine.clients)
+            start = perf_counter()
+            await engine.reload(options)
+            reloaded = perf_counter() - start
+            server = next(s for s in engine.servers if s.name == target)
+            first_publish.pop(server, None)
+            while server not in first_publish: await asyncio.sleep(0.001)
+            kept = sum(client in before for client in engine.clients)
+            results[label] = {"reload_s": reloaded, "published_s": first_publish[server] - start, "clients_kept": kept}
+            print(f"{label:<25}reload {reloaded*1e3:6.1f} ms, edited server published after "
+                  f"{results[label]['published_s']*1e3:6.1f} ms, {kept}/{len(engine.clients)} connections kept")
+            return options
+
+        servers = list(options.servers)
+        servers[1] = dataclasses.replace(servers[1], poll_intervals={"power": poll_interval / 2})
+        options = await edit("poll interval (live)", dataclasses.replace(options, servers=list(servers)), "sim1")
+        servers[2] = dataclasses.replace(servers[2], serialnum="SN2b")
+        options = await edit("serialnum (re-create)", dataclasses.replace(options, servers=list(servers)), "sim2")
+        new_client = ModbusTCPOptions(f"bus{n_servers}", f"bus{n_servers}", **simulator.client_options())
+        new_server = ServerOptions(f"sim{n_servers}", f"sim{n_servers}", f"SN{n_servers}", "SimServer", f"bus{n_servers}", 1)
+        await edit("server and client added", dataclasses.replace(options, servers=[*servers, new_server],
+                                                                  clients=[*options.clients, new_client]), new_server.name)
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await simulator.stop()
+        return results
+
+    return asyncio.run(scenario())
+
+
+BENCHMARKS = {
+    "decode": bench_decode,
+    "topics": bench_topics,
+    "registers": bench_registers,
+    "pipeline": bench_pipeline,
+    "e2e": bench_e2e,
+    "startup": bench_startup,
+    "shards": bench_shards,
+    "aggregate": bench_aggregate,
+    "logging": bench_logging,
+    "reload": bench_reload,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="modbus-mqtt benchmarks")
+    parser.add_argument("benchmark", choices=BENCHMARKS.keys())
+    e2e = parser.add_argument_group("e2e options")
+    e2e.add_argument("--servers", default="1,10,50", help="comma separated server counts, one scenario each")
+    e2e.add_argument("--registers", type=int, default=100, help="registers per server")
+    e2e.add_argument("--latency", type=float, default=0.0, help="simulated response latency in seconds")
+    e2e.add_argument("--transports", default="tcp,rtu")
+    e2e.add_argument("--duration", type=float, default=5.0, help="seconds per scenario")
+    e2e.add_argument("--pipeline-depth", type=int, default=0)
+    e2e.add_argument("--output", help="also write the JSON report to this file")
+    e2e.add_argument("--aggregate-state", action="store_true", help="publish one JSON state document per server and cycle")
+    args = parser.parse_args()
+
+    if args.benchmark == "e2e":
+        bench_e2e(tuple(int(n) for n in args.servers.split(",")), args.registers, args.latency,
+                  tuple(args.transports.split(",")), args.duration, args.pipeline_depth, args.output, args.aggregate_state)
+    else:
+        BENCHMARKS[args.benchmark]()
@@ -0,0 +1,314 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from dataclasses import dataclass, field
+from time import monotonic, perf_counter
+from typing import Callable
+from async_client import AsyncClient
+from enums import BreakerState
+from hot_log import EventLogger
+from model_cache import ModelCache
+from server import Server
+logger = logging.getLogger(__name__)
+hot_logger = EventLogger(__name__)
+
+"""
+    Per-bus scheduling:
+    Each bus (AsyncClient) is owned by one BusScheduler, which is the only coroutine issuing
+    requests on it. Registers are grouped by poll interval per server, each group is read as
+    coalesced block reads whenever it is due. Writes from MQTT /set messages always go first.
+    Consecutive frames on a serial bus, including the block reads of one group, are separated
+    by the Modbus RTU inter-frame silence, see AsyncClient.
+    Servers found in the model cache are polled right away and their model is confirmed by a
+    single background read. Each server has a circuit breaker: while a server is unreachable its reads are skipped and
+    only one probe is sent per backoff window, so a dead device does not slow down the bus.
+"""
+
+WRITE_PRIORITY = 0
+READ_PRIORITY = 1
+
+
+def group_registers(server: Server, default_interval: float) -> dict[float, frozenset]:
+    """ Group the registers of a server by poll interval.
+
+        The interval of a register is taken from, in order: server.poll_intervals keyed by register
+        name, server.poll_intervals keyed by device_class, a "poll_interval" key in the register
+        definition, default_interval.
+    """
+    groups: dict[float, set] = {}
+    for register_name, register_info in server.registers.items():
+        interval = server.poll_intervals.get(register_name,
+                        server.poll_intervals.get(register_info.get("device_class"),
+                            register_info.get("poll_interval", default_interval)))
+        groups.setdefault(interval, set()).add(register_name)
+    return {interval: frozenset(names) for interval, names in groups.items()}
+
+
+@dataclass
+class ReadGroup:
+    server: Server
+    register_names: frozenset
+    interval: float
+    cancelled: bool = False                                         # dropped while being read, not queued again
+
+
+@dataclass
+class SetupJob:
+    server: Server                                                  # read model and publish discovery
+    revalidate: bool = False                                        # only confirm a model restored from cache
+
+
+@dataclass
+class WriteRequest:
+    server: Server
+    values: dict[str, float]                                        # write parameter name -> value
+    future: asyncio.Future = field(repr=False)
+
+
+class BusScheduler:
+    """ Priority queue of reads and writes for a single bus.
+
+        Queue entries are (priority, due, seq, job): pending writes come before any read,
+        reads run in order of their due time.
+
+        on_ready(server) is called once a server's model is read, on_availability(available, server)
+        whenever the availability of a server changes. Servers can be added, removed and rescheduled
+        while the scheduler runs.
+    """
+    def __init__(self, client: AsyncClient, servers: list[Server], default_interval: float,
+                 on_ready: Callable[[Server], None] | None = None,
+                 on_availability: Callable[[bool, Server], None] | None = None,
+                 model_cache: ModelCache | None = None):
+        self.client = client
+        self.servers = servers
+        self.default_interval = default_interval
+        self.on_ready = on_ready
+        self.on_availability = on_availability
+        self.model_cache = model_cache
+
+        self._queue: list[tuple[int, float, int, ReadGroup | SetupJob | WriteRequest]] = []
+        self._seq = itertools.count()
+        self._groups: dict[Server, list[ReadGroup]] = {}            # scheduled read groups per server
+        self._wakeup = asyncio.Event()
+        self._stopped = False
+        self._summary = [0, 0, 0, 0.0, monotonic()]                # cycles, values, failed cycles, seconds reading, since
+
+    def _push(self, priority, due, job):
+        if job.server not in self.servers:                          # removed while the job was running
+            if isinstance(job, WriteRequest) and not job.future.done(): job.future.cancel()
+            return
+        heapq.heappush(self._queue, (priority, due, next(self._seq), job))
+        self._wakeup.set()
+
+    def stop(self):
+        """ End run() after the current job. Cancelling run() alone is not enough: pymodbus turns a
+            cancelled request into a ModbusException, which the error handling of reads swallows.
+        """
+        self._stopped = True
+        self._wakeup.set()
+
+    def submit_writes(self, server: Server, values: dict[str, float]) -> asyncio.Future:
+        """ Queue writes of write parameters ahead of all routine reads.
+            The returned future resolves to the read-back values, see Client.write_server_registers.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._push(WRITE_PRIORITY, loop.time(), WriteRequest(server, values, future))
+        return future
+
+    def schedule_reads(self):
+        """ (Re)create the read groups of all servers, all due immediately.
+            Servers without a model are restored from the model cache or get a SetupJob first.
+        """
+        self._queue = [entry for entry in self._queue if entry[0] == WRITE_PRIORITY]
+        heapq.heapify(self._queue)
+
+        for groups in self._groups.values():
+            for group in groups: group.cancelled = True
+        self._groups = {}
+
+        now = asyncio.get_running_loop().time()
+        restored = [server for server in self.servers if self._start(server, now)]
+
+        # revalidate once every server had its first read
+        for server in restored: self._push(READ_PRIORITY, now, SetupJob(server, revalidate=True))
+
+    def _start(self, server: Server, now: float) -> bool:
+        """ Schedule the reads of a server or its setup. Returns True if its model was restored from the cache. """
+        if server.model is None and self.model_cache is not None and self.model_cache.restore(server):
+            self._ready(server, now)
+            return True
+        if server.model is None: self._push(READ_PRIORITY, now, SetupJob(server))
+        else: self._schedule_server(server, now)
+        return False
+
+    def add_server(self, server: Server):
+        """ Start polling a server of this bus, set up like in schedule_reads """
+        self.servers.append(server)
+        now = asyncio.get_running_loop().time()
+        if self._start(server, now): self._push(READ_PRIORITY, now, SetupJob(server, revalidate=True))
+
+    def remove_server(self, server: Server):
+        """ Stop polling a server. Its pending writes are cancelled, a job running for it is not queued again. """
+        self.servers.remove(server)
+        self._drop_reads(server)
+        for entry in self._queue:
+            if isinstance(entry[3], WriteRequest) and entry[3].server is server and not entry[3].future.done():
+                entry[3].future.cancel()
+        self._queue = [entry for entry in self._queue if entry[3].server is not server]
+        heapq.heapify(self._queue)
+        self.client.forget_plans(server)
+
+    def reschedule(self, server: Server):
+        """ Regroup the reads of a server after its poll_intervals changed """
+        if server not in self._groups: return                       # not set up yet, grouped when it is
+        self._drop_reads(server)
+        self._schedule_server(server, asyncio.get_running_loop().time())
+
+    def _ready(self, server: Server, now: float):
+        if server not in self.servers: return                       # removed during setup
+        if self.on_ready is not None: self.on_ready(server)
+        self._schedule_server(server, now)
+
+    def _drop_reads(self, server: Server):
+        for group in self._groups.pop(server, ()): group.cancelled = True
+        self._queue = [entry for entry in self._queue if not (isinstance(entry[3], ReadGroup) and entry[3].server is server)]
+        heapq.heapify(self._queue)
+
+    def _schedule_server(self, server: Server, now: float):
+        groups = self._groups[server] = []
+        for interval, register_names in group_registers(server, self.default_interval).items():
+            logger.info(f"Polling {len(register_names)} registers of {server} every {interval}s")
+            groups.append(ReadGroup(server, register_names, interval))
+            self._push(READ_PRIORITY, now, groups[-1])
+
+    def _retry_time(self, loop, server: Server) -> float:
+        """ Loop time at which the server's breaker allows the next attempt """
+        return loop.time() + max(0, server.breaker.retry_at - monotonic())
+
+    async def run(self, publish_q: asyncio.Queue):
+        """ Execute queued jobs until stop() is called. Decoded values are put on publish_q as (server, values). """
+        loop = asyncio.get_running_loop()
+        self.schedule_reads()
+
+        while not self._stopped:
+            now = loop.time()
+            if not self._queue or self._queue[0][1] > now:
+                timeout = self._queue[0][1] - now if self._queue else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            priority, due, _, job = heapq.heappop(self._queue)
+
+            if isinstance(job, WriteRequest):
+                await self._write(job)
+            elif isinstance(job, SetupJob):
+                await self._setup(job, loop)
+            else:
+                await self._read(job, publish_q)
+                # keep the cadence, but never queue up a burst of missed cycles
+                if not job.cancelled: self._push(READ_PRIORITY, max(due + job.interval, loop.time()), job)
+
+    def _record(self, server: Server, ok: bool):
+        changed = server.breaker.record_success() if ok else server.breaker.record_failure()
+        if changed and self.on_availability is not None: self.on_availability(ok, server)
+
+    async def _setup(self, job: SetupJob, loop):
+        server = job.server
+        # check before allow(), which may leave the breaker half-open waiting for an outcome
+        register_info = self.model_cache.modelcode_register(server) if job.revalidate else None
+        if job.revalidate and register_info is None: return        # nothing to confirm the model with
+        if not server.breaker.allow():
+            self._push(READ_PRIORITY, self._retry_time(loop, server), job)
+            return
+        if job.revalidate:
+            await self._revalidate(job, register_info, loop)
+            return
+
+        fingerprint = self.model_cache.fingerprint(server) if self.model_cache is not None else None
+        try:
+            await self.client.read_model(server)
+            server.setup_valid_registers_for_model()
+            server.compile_registers()
+        except NotImplementedError as e:
+            logger.error(f"Not polling server {server}: {e}")
+            return
+        except Exception as e:
+            logger.error(f"Error reading model of server {server}: {e}")
+            self._record(server, False)
+            self._push(READ_PRIORITY, self._retry_time(loop, server), job)
+            return
+
+        self._record(server, True)
+        if self.model_cache is not None: self.model_cache.store(server, fingerprint)
+        self._ready(server, loop.time())
+
+    async def _revalidate(self, job: SetupJob, register_info: dict, loop):
+        """ Confirm the model of a server restored from the cache, set it up from scratch if it changed """
+        server = job.server
+        try:
+            modelcode = await self.client.read_modelcode(server, register_info)
+        except Exception as e:
+            logger.error(f"Error revalidating cached model of server {server}: {e}")
+            self._record(server, False)
+            self._push(READ_PRIORITY, self._retry_time(loop, server), job)
+            return
+
+        self._record(server, True)
+        if modelcode == server.modelcode:
+            logger.info(f"Cached model {server.model} of server {server} confirmed")
+            return
+
+        logger.warning(f"Server {server} reports device type code {modelcode}, cached {server.modelcode}. Setting up again")
+        self._drop_reads(server)
+        self.model_cache.reset(server)
+        self._push(READ_PRIORITY, loop.time(), SetupJob(server))
+
+    async def _read(self, job: ReadGroup, publish_q: asyncio.Queue):
+        server = job.server
+        if not server.breaker.allow(): return
+
+        if server.breaker.state is BreakerState.HALF_OPEN and not await self.client.is_available(server):
+            self._record(server, False)
+            return
+
+        start = perf_counter()
+        try:
+            values = await self.client.read_server_registers(server, job.register_names)
+        except Exception as e:
+            if self._stopped: return                                # a cancelled request, see stop()
+            hot_logger.error("poll_error", "Error polling server %s: %s", server, e, key=server.nickname)
+            self._record(server, False)
+            self._summarize(0, perf_counter() - start)
+            return
+
+        # a read where every block failed returns nothing
+        self._record(server, bool(values))
+        self._summarize(len(values), perf_counter() - start)
+        if values: await publish_q.put((server, values))
+
+    def _summarize(self, n_values: int, seconds: float):
+        """ Count a read cycle and log the totals as one record per "cycle_summary" rate limit """
+        summary = self._summary
+        summary[0] += 1
+        summary[1] += n_values
+        summary[2] += not n_values
+        summary[3] += seconds
+        if hot_logger.info("cycle_summary", "Bus %s: %d read cycles of %d servers in %.0fs, %d values, %d failed, %.1f ms per cycle",
+                           self.client, summary[0], len(self.servers), monotonic() - summary[4], summary[1], summary[2],
+                           summary[3] / summary[0] * 1000, key=self.client.nickname):
+            self._summary = [0, 0, 0, 0.0, monotonic()]
+
+    async def _write(self, job: WriteRequest):
+        try:
+            result = await self.client.write_server_registers(job.server, job.values)
+        except Exception as e:
+            logger.error(f"Error writing {list(job.values)} of server {job.server}: {e}")
+            if not job.future.done(): job.future.set_exception(e)
+            return
+        if not job.future.done(): job.future.set_result(result)
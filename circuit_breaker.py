@@ -0,0 +1,72 @@
+import logging
+import random
+from time import monotonic
+from enums import BreakerState
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """ Circuit breaker with exponential backoff, jitter and half-open probing.
+
+        After `failure_threshold` consecutive failures the breaker opens and requests are skipped
+        for base_delay * 2**n seconds (n = failures beyond the threshold, capped at max_delay,
+        randomised by +-jitter). Once the backoff expires allow() lets a single probe through;
+        its outcome closes the breaker or reopens it with a longer backoff.
+    """
+    def __init__(self, name: str, base_delay: float = 5, max_delay: float = 300, jitter: float = 0.2,
+                 failure_threshold: int = 3):
+        self.name = name
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.failure_threshold = failure_threshold
+
+        self.state = BreakerState.CLOSED
+        self.failures = 0                                           # consecutive failures
+        self.retry_at = 0.0
+
+    @property
+    def available(self) -> bool:
+        return self.state is BreakerState.CLOSED
+
+    def allow(self) -> bool:
+        """ True if a request may be issued now. Moves an expired open breaker to half-open. """
+        if self.state is BreakerState.CLOSED: return True
+        if self.state is BreakerState.OPEN and monotonic() >= self.retry_at:
+            self.state = BreakerState.HALF_OPEN
+            logger.info(f"Probing {self.name}")
+            return True
+        return False
+
+    def backoff(self) -> float:
+        """ Seconds until the next attempt after the current number of failures """
+        exponent = max(0, self.failures - self.failure_threshold)
+        delay = min(self.max_delay, self.base_delay * 2**exponent)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def retry_delay(self) -> float:
+        """ Seconds to wait before retrying a failed request: the remaining backoff while open,
+            base_delay while the failures are still below the threshold
+        """
+        if self.state is BreakerState.CLOSED: return self.base_delay
+        return max(0, self.retry_at - monotonic())
+
+    def record_success(self) -> bool:
+        """ Returns True if the breaker closed, i.e. availability changed """
+        changed = self.state is not BreakerState.CLOSED
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        if changed: logger.info(f"{self.name} available again")
+        return changed
+
+    def record_failure(self) -> bool:
+        """ Returns True if the breaker opened from closed, i.e. availability changed """
+        self.failures += 1
+        if self.state is BreakerState.CLOSED and self.failures < self.failure_threshold: return False
+
+        changed = self.state is BreakerState.CLOSED
+        self.state = BreakerState.OPEN
+        delay = self.backoff()
+        self.retry_at = monotonic() + delay
+        logger.warning(f"{self.name} unavailable after {self.failures} failures, next attempt in {delay:.1f}s")
+        return changed
@@ -1,24 +1,55 @@
 from pymodbus.client import ModbusSerialClient, ModbusTcpClient
 from pymodbus.pdu import ExceptionResponse
+from pymodbus.exceptions import ModbusException
 from enums import RegisterTypes, DataType
 import logging
+import warnings
 from loader import ModbusTCPOptions, ModbusRTUOptions
-from time import sleep
+from time import sleep, perf_counter
+from circuit_breaker import CircuitBreaker
+from metrics import METRICS
+from read_planner import ReadBlock, WriteBatch, plan_reads, MODBUS_MAX_WRITE_COUNT
+from codec import BlockLayout
+from frame_log import FrameWriter, ReplayClient, READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS, WRITE_MULTIPLE_REGISTERS, STATUS_NO_RESPONSE
+from hot_log import EventLogger
 logger = logging.getLogger(__name__)
+hot_logger = EventLogger(__name__)                                  # per-cycle records, see hot_log
 
 from server import Server
 
 
+def _warn_register_info():
+    warnings.warn("The register_info argument of read_registers is deprecated, registers are looked up in "
+                  "server.table by name", DeprecationWarning, stacklevel=3)
+
+
 class Client:
+    tcp_client_class = ModbusTcpClient
+    serial_client_class = ModbusSerialClient
+    replay_client_class = ReplayClient
+
     def __init__(self, cl_options: ModbusTCPOptions | ModbusRTUOptions):
         self.name = cl_options.name
         self.nickname = cl_options.ha_display_name
-        self.client: ModbusSerialClient | ModbusTcpClient
+        self.client: ModbusSerialClient | ModbusTcpClient = self._create_client(cl_options)
+        self.baudrate: int | None = getattr(cl_options, "baudrate", None)  # None for TCP
+        self.breaker = CircuitBreaker(f"client {self.nickname}", cl_options.backoff_base, cl_options.backoff_max,
+                                      failure_threshold=cl_options.failure_threshold)
+        self.capture: FrameWriter | None = FrameWriter(cl_options.capture_path, cl_options.capture_max_bytes) \
+                                           if cl_options.capture_path else None
+
+        self.read_gap_tolerance = cl_options.read_gap_tolerance
+        self.read_max_count = cl_options.read_max_count
+        self.holes: dict[tuple[int, RegisterTypes], set[int]] = {}  # (slave_id, register_type) -> addresses returning Illegal Data Address
+        self._read_plans: dict[tuple, list[tuple[ReadBlock, BlockLayout | None, tuple]]] = {}  # (server name, register group) -> planned block reads
 
+    def _create_client(self, cl_options: ModbusTCPOptions | ModbusRTUOptions):
+        if cl_options.replay_path:
+            return self.replay_client_class(cl_options.replay_path, cl_options.replay_speed)
         if isinstance(cl_options, ModbusTCPOptions):
-            self.client = ModbusTcpClient(host=cl_options.host, port=cl_options.port)
+            return self.tcp_client_class(host=cl_options.host, port=cl_options.port)
         elif isinstance(cl_options, ModbusRTUOptions):
-            self.client = ModbusSerialClient(port=cl_options.port, baudrate=cl_options.baudrate, 
+            return self.serial_client_class(port=cl_options.port, baudrate=cl_options.baudrate, 
                                                 bytesize=cl_options.bytesize, parity='Y' if cl_options.parity else 'N', 
                                                 stopbits=cl_options.stopbits)
 
@@ -34,9 +65,31 @@ class Client:
         else: 
             logger.info(f"unsupported register type {register_type}") # will maybe never happen?
             raise ValueError(f"unsupported register type {register_type}")
+        if self.capture is not None: self._capture_read(address, count, slave_id, register_type, result)
+        return result
+
+    def _capture_read(self, address, count, slave_id, register_type, result=None):
+        """ Append a read request and its response (None if there was none) to the frame capture """
+        function_code = READ_HOLDING_REGISTERS if register_type == RegisterTypes.HOLDING_REGISTER else READ_INPUT_REGISTERS
+        if result is None: self.capture.append(function_code, slave_id, address-1, count, status=STATUS_NO_RESPONSE)
+        else: self.capture.append_response(function_code, slave_id, address-1, count, result)
+
+    def _capture_write(self, address, values, slave_id, result):
+        self.capture.append_response(WRITE_MULTIPLE_REGISTERS, slave_id, address-1, len(values), result, registers=values)
+
+    def _timed_read(self, server:Server, group:str, address, count, slave_id, register_type):
+        """ _read, recording the request latency under (client, server, group) """
+        start = perf_counter()
+        try:
+            result = self._read(address, count, slave_id, register_type)
+        except ModbusException:
+            METRICS.count_timeout(self.nickname)
+            if self.capture is not None: self._capture_read(address, count, slave_id, register_type)
+            raise
+        METRICS.observe_request(self.nickname, server.nickname, group, perf_counter() - start)
         return result
 
-    def read_registers(self, server:Server, register_name:str, register_info:dict):
+    def read_registers(self, server:Server, register_name:str, register_info:dict | None = None):
         """ Read a group of registers using pymodbus 
         
             Reuires implementation of the abstract method 'Server._decoded()'
@@ -44,39 +97,235 @@ class Client:
             Parameters:
             -----------
 
-                - address: int: 1-indexed slave register address
+                - register_name: str: name of a register in server.registers
+                - register_info: dict: deprecated, the register is looked up in server.table.
+                  If given, the register it describes is read as before.
         """
+        if register_info is not None:
+            _warn_register_info()
+            result = self._timed_read(server, register_name, register_info["addr"], register_info["count"],
+                                      server.device_addr, register_info["register_type"])
+            if result.isError():
+                self._handle_error_response(result)
+                raise Exception(f"Error reading register {register_name}")
+            return self._scaled_value(server, result.registers, register_info)
 
-        address = register_info["addr"]
-        dtype =  register_info["dtype"]
-        multiplier = register_info["multiplier"]
-        count = register_info["count"]
-        unit = register_info["unit"]
+        table = server.table
+        i = table.index[register_name]
+        address = table.addresses[i]
+        count = table.counts[i]
         slave_id = server.device_addr
-        register_type = register_info['register_type']
-
-        logger.info(f"Reading param {register_name} ({register_type}) of {dtype=} from {address=}, {multiplier=}, {count=}, {slave_id=}")
+        register_type = table.register_types[i]
 
-        result = self._read(address, count, slave_id, register_type)
+        result = self._timed_read(server, register_name, address, count, slave_id, register_type)
 
         if result.isError(): 
             self._handle_error_response(result)
             raise Exception(f"Error reading register {register_name}")
 
-        logger.info(f"Raw register begin value: {result.registers[0]}")
-        val = server._decoded(result.registers, dtype)
+        val = self._register_value(server, i, result.registers)
+        hot_logger.debug("register_read", "Read %s (%s, %s) of %s from address=%d, count=%d, slave_id=%s: raw=%s, value=%s",
+                         register_name, register_type, table.dtypes[i], server, address, count, slave_id, result.registers, val)
+        return val
+
+    @staticmethod
+    def _register_value(server:Server, position:int, registers:list):
+        """ Decode and scale the raw registers of the register at position in server.table """
+        table = server.table
+        return table.scale(position, server._decoded(registers, table.dtypes[position]))
+
+    def _scaled_value(self, server:Server, registers:list, register_info:dict):
+        return self._scale(server._decoded(registers, register_info["dtype"]), register_info)
+
+    @staticmethod
+    def _scale(val, register_info:dict):
+        multiplier = register_info["multiplier"]
         if multiplier != 1: val*=multiplier
         if isinstance(val, int) or isinstance(val, float): val = round(val, 2)
-        logger.info(f"Decoded Value = {val} {unit}")
-
         return val
 
+    def read_server_registers(self, server:Server, register_names:frozenset | None = None) -> dict:
+        """ Read all registers of a server using coalesced block reads.
+
+            Registers are grouped by register_type into spans (see read_planner.plan_reads),
+            one request is issued per span and the values are sliced back out per register.
+            Addresses returning Illegal Data Address are learned and split around.
+
+            Parameters:
+            -----------
+                - register_names: frozenset: only read this group of registers, all if None
+
+            Returns:
+            --------
+                - dict: register_name -> decoded value, for every register read successfully
+        """
+        cycle_start = perf_counter()
+        values = {}
+        for block, layout, positions in self._read_plan(server, register_names):
+            hot_logger.debug("block_read", "Reading block of %d registers (%s) from address=%d, slave_id=%s",
+                             block.count, block.register_type, block.address, block.slave_id)
+            result = self._timed_read(server, block.label, block.address, block.count, block.slave_id, block.register_type)
+
+            if result.isError():
+                if self._split_on_error(result, block):
+                    values.update(self._read_block_members(server, block))
+                continue
+
+            values.update(self._decode_block(server, block, layout, positions, result.registers))
+
+        METRICS.observe_cycle(self.nickname, server.nickname, perf_counter() - cycle_start)
+        return values
+
+    def _read_plan(self, server:Server, register_names:frozenset | None = None) -> list[tuple[ReadBlock, BlockLayout | None, tuple]]:
+        """ Planned block reads of a server with their decoders and the server.table positions
+            of the decoded values, in the order the decoder returns them.
+        """
+        plan = self._read_plans.get((server.name, register_names))
+        if plan is None:
+            registers = server.registers if register_names is None else \
+                        {name: info for name, info in server.registers.items() if name in register_names}
+            blocks = plan_reads(registers, server.device_addr, self.read_gap_tolerance,
+                                self.read_max_count, {register_type: holes for (slave_id, register_type), holes in self.holes.items()
+                                                      if slave_id == server.device_addr})
+            index = server.table.index
+            plan = []
+            for block in blocks:
+                layout = server.compile_layout(block)
+                names = layout.order if layout is not None else [m[0] for m in block.members]
+                plan.append((block, layout, tuple(index[name] for name in names)))
+            self._read_plans[(server.name, register_names)] = plan
+        return plan
+
+    def forget_plans(self, server:Server):
+        """ Drop the cached read plans of a server, e.g. after its registers changed """
+        for key in [k for k in self._read_plans if k[0] == server.name]: del self._read_plans[key]
+
+    def _split_on_error(self, result, block:ReadBlock) -> bool:
+        """ Log an error response for a block and return True if its members should be read one by one """
+        exception_code = self._handle_error_response(result)
+        if exception_code == 2 and len(block.members) > 1: return True
+
+        hot_logger.error("read_error", "Error reading registers %s", [m[0] for m in block.members], key=(self.nickname, block.slave_id))
+        return False
+
+    def _decode_block(self, server:Server, block:ReadBlock, layout:BlockLayout | None, positions:tuple, registers:list) -> dict:
+        table = server.table
+        names, scale = table.names, table.scale
+        if layout is not None:
+            return {names[i]: scale(i, val) for i, val in zip(positions, layout.decode_values(registers))}
+
+        return {names[i]: scale(i, server._decoded(registers[offset:offset+count], table.dtypes[i]))
+                for i, (_, offset, count) in zip(positions, block.members)}
+
+    def _read_block_members(self, server:Server, block:ReadBlock) -> dict:
+        """ Fall back to reading the members of a block that returned Illegal Data Address
+            one by one and learn which addresses are holes, so the next plan splits around them.
+        """
+        values = {}
+        illegal = set()
+        for register_name, offset, count in block.members:
+            address = block.address + offset
+            result = self._timed_read(server, register_name, address, count, block.slave_id, block.register_type)
+            if result.isError():
+                if self._handle_error_response(result) == 2: illegal.update(range(address, address+count))
+                hot_logger.error("read_error", "Error reading register %s", register_name, key=(self.nickname, block.slave_id))
+                continue
+            values[register_name] = self._register_value(server, server.table.index[register_name], result.registers)
+
+        self._learn_holes(block, illegal, all_ok=len(values) == len(block.members))
+        return values
+
+    def _learn_holes(self, block:ReadBlock, illegal:set[int], all_ok:bool):
+        holes = self.holes.setdefault((block.slave_id, block.register_type), set())
+        holes.update(illegal)
+
+        # every register is readable on its own, so the bridged gap addresses are the culprit
+        if all_ok: holes.update(block.gap_addresses())
+        logger.info(f"Learned {len(holes)} hole addresses of {block.register_type.name} for slave {block.slave_id}")
+
+        # replan every server on this slave id
+        for name in [n for n, p in self._read_plans.items() if p and p[0][0].slave_id == block.slave_id]:
+            del self._read_plans[name]
+
     def write_registers(self, value:float, server:Server, register_name: str, register_info:dict):
         """ Write to an individual register using pymodbus.
 
             Reuires implementation of the abstract methods 
             'Server._validate_write_val()' and 'Server._encode()'
         """
+        address, values, slave_id = self._prepare_write(value, server, register_name, register_info)
+        
+        result = self.client.write_registers( address=address-1,
+                                              values=values,
+                                              slave=slave_id)
+        if self.capture is not None: self._capture_write(address, values, slave_id, result)
+        if result.isError():
+            self._handle_error_response(result)
+            raise Exception(f"Error writing register {register_name}")
+        return result
+
+    def write_server_registers(self, server:Server, values:dict) -> dict:
+        """ Write several write_parameters of a server, batching adjacent registers into one request,
+            and read the written registers back.
+
+            Parameters:
+            -----------
+                - values: dict: write parameter name -> value
+
+            Returns:
+            --------
+                - dict: write parameter name -> read-back value, for every parameter written successfully
+        """
+        readback = {}
+        for batch in self._plan_writes(server, values):
+            logger.info(f"Writing {len(batch.members)} parameters to {batch.count} registers at address={batch.address}, slave_id={batch.slave_id}")
+            start = perf_counter()
+            result = self.client.write_registers(address=batch.address-1, values=batch.values, slave=batch.slave_id)
+            METRICS.observe_request(self.nickname, server.nickname, "write", perf_counter() - start)
+            if self.capture is not None: self._capture_write(batch.address, batch.values, batch.slave_id, result)
+            if result.isError():
+                self._handle_error_response(result)
+                logger.error(f"Error writing registers {[m[0] for m in batch.members]}")
+                continue
+
+            result = self._timed_read(server, "write", batch.address, batch.count, batch.slave_id, batch.register_type)
+            if result.isError():
+                self._handle_error_response(result)
+                logger.error(f"Error reading back registers {[m[0] for m in batch.members]}")
+                continue
+            readback.update(self._decode_write_batch(server, batch, result.registers))
+        return readback
+
+    def _plan_writes(self, server:Server, values:dict) -> list[WriteBatch]:
+        """ Encode write values and merge writes to adjacent registers into batches """
+        encoded = []
+        for register_name, value in values.items():
+            register_info = server.write_parameters[register_name]
+            try:
+                address, registers, slave_id = self._prepare_write(value, server, register_name, register_info)
+            except Exception as e:
+                logger.error(f"Invalid value {value} for {register_name} of server {server}: {e}")
+                continue
+            encoded.append((address, register_name, list(registers), slave_id))
+
+        batches: list[WriteBatch] = []
+        for address, register_name, registers, slave_id in sorted(encoded, key=lambda e: e[0]):
+            batch = batches[-1] if batches else None
+            if batch is not None and batch.end == address and batch.count + len(registers) <= MODBUS_MAX_WRITE_COUNT:
+                batch.members.append((register_name, batch.count, len(registers)))
+                batch.values += registers
+                batch.count += len(registers)
+                continue
+            batches.append(WriteBatch(RegisterTypes.HOLDING_REGISTER, slave_id, address, len(registers),
+                                      [(register_name, 0, len(registers))], registers))
+        return batches
+
+    def _decode_write_batch(self, server:Server, batch:WriteBatch, registers:list) -> dict:
+        return {register_name: self._scaled_value(server, registers[offset:offset+count], server.write_parameters[register_name])
+                for register_name, offset, count in batch.members}
+
+    def _prepare_write(self, value:float, server:Server, register_name: str, register_info:dict) -> tuple[int, list, int]:
+        """ Validate, scale and encode a write value. Returns (address, values, slave_id) """
         logger.info(f"Validating write message")
         server._validate_write_val(register_name, value)
 
@@ -92,35 +341,40 @@ class Client:
         values = server._encoded(value)
         
         logger.info(f"Writing {value=} {unit=} to param {register_name} at {address=}, {dtype=}, {multiplier=}, {count=}, {register_type=}, {slave_id=}")
-        
-        self.client.write_registers( address=address-1,
-                                    value=values,
-                                    slave=slave_id)
+        return address, values, slave_id
 
-    def connect(self, num_retries=2, sleep_interval=3):
+    def connect(self, num_retries=2, sleep_interval=None):
+        """ Connect, retrying with the exponential backoff of the client's circuit breaker
+            unless a fixed sleep_interval is given.
+        """
         logger.info(f"Connecting to client {self}")
 
         for i in range(num_retries):
             connected: bool = self.client.connect()
             if connected: break
 
-            logging.info(f"Couldn't connect to {self}. Retrying")
-            sleep(sleep_interval)
+            self.breaker.record_failure()
+            delay = sleep_interval if sleep_interval is not None else self.breaker.retry_delay()
+            logging.info(f"Couldn't connect to {self}. Retrying in {delay:.1f}s")
+            sleep(delay)
 
         if not connected: 
             logger.error(f"Client Connection Issue after {num_retries} attempts.")
             raise ConnectionError(f"Client {self} Connection Issue")
 
+        self.breaker.record_success()
         logger.info(f"Sucessfully connected to {self}")
 
     def close(self):
         logger.info(f"Closing connection to {self}")
         self.client.close()
+        if self.capture is not None: self.capture.close()
 
     def __str__(self):
         return f"{self.nickname}"
 
-    def _handle_error_response(self, result):
+    def _handle_error_response(self, result) -> int | None:
+        """ Log the modbus exception of an error response and return its exception code, if any """
         if isinstance(result, ExceptionResponse):
             exception_code = result.exception_code
 
@@ -139,5 +393,10 @@ class Client:
             }
 
             error_message = exception_messages.get(exception_code, "Unknown Exception")
-            logger.error(f"Modbus Exception Code {exception_code}: {error_message}")
-        else: logger.error(f"Non Standard Modbus Exception. Cannot Decode Response")
+            hot_logger.error("modbus_exception", "Modbus Exception Code %d: %s", exception_code, error_message,
+                             key=(self.nickname, exception_code))
+            METRICS.count_exception(self.nickname, exception_code)
+            return exception_code
+        else: hot_logger.error("modbus_exception", "Non Standard Modbus Exception. Cannot Decode Response", key=(self.nickname, None))
+        METRICS.count_timeout(self.nickname)                        # pymodbus returns ModbusIOException on timeouts
+        return None
@@ -0,0 +1,82 @@
+import struct
+import logging
+from enums import DataType, Endian
+logger = logging.getLogger(__name__)
+
+"""
+    Batched register decoding:
+    A BlockLayout is compiled once per planned block read and decodes all values of the
+    block from the raw pymodbus register list with a single struct.unpack call.
+"""
+
+
+class BlockLayout:
+    """ Precompiled decoder for a block of raw 16-bit registers.
+
+        Parameters:
+        -----------
+            - fields: list of (register_name, offset, count, dtype), offset and count in registers
+            - count: int: number of registers in the block
+            - byte_order: Endian: order of the bytes within each register
+            - word_order: Endian: order of the registers of multi-register types
+    """
+    __slots__ = ("names", "order", "count", "_raw", "_struct", "_permutation", "_utf8_idx", "_overlapping", "_word_order")
+
+    def __init__(self, fields: list[tuple[str, int, int, DataType]], count: int,
+                 byte_order: Endian = Endian.BIG, word_order: Endian = Endian.BIG):
+        self.count = count
+        self._raw = struct.Struct(f"{byte_order.value}{count}H")    # normalises byte order while packing
+
+        fmt = ">"
+        pos = 0                                                     # next unparsed register
+        names = []
+        self._utf8_idx = []
+        self._overlapping = []                                      # (name, offset, count, dtype) decoded separately
+        permutation = list(range(count))
+
+        for name, offset, n, dtype in sorted(fields, key=lambda f: f[1]):
+            if offset < pos:
+                self._overlapping.append((name, offset, n, dtype))
+                continue
+            if offset > pos: fmt += f"{(offset-pos)*2}x"
+
+            if dtype is DataType.UTF8:
+                fmt += f"{n*2}s"
+                self._utf8_idx.append(len(names))
+            else:
+                width = dtype.size // 2
+                if n < width:                                       # decoded on its own, raises like the per-register path
+                    logger.warning(f"Register {name} has count {n}, {dtype.value} needs {width}")
+                    self._overlapping.append((name, offset, n, dtype))
+                    continue
+                fmt += dtype.struct_format
+                if n > width:                                       # registers beyond the dtype are skipped
+                    logger.warning(f"Register {name} has count {n}, decoding the first {width} as {dtype.value}")
+                    fmt += f"{(n-width)*2}x"
+                if word_order is Endian.LITTLE: permutation[offset:offset+width] = reversed(permutation[offset:offset+width])
+
+            names.append(name)
+            pos = offset + n
+
+        self.names = tuple(names)
+        self.order = self.names + tuple(f[0] for f in self._overlapping)    # register names in the order of decode_values
+        self._struct = struct.Struct(fmt)
+        self._permutation = None if permutation == list(range(count)) else permutation
+        self._word_order = word_order
+
+    def decode_values(self, registers: list) -> list:
+        """ Decode all fields of the block in one pass. Returns the values in the order of self.order """
+        ordered = registers if self._permutation is None else [registers[i] for i in self._permutation]
+        values = list(self._struct.unpack_from(self._raw.pack(*ordered[:self.count])))
+        for i in self._utf8_idx:
+            values[i] = values[i].decode("utf-8", errors="ignore").strip("\x00 ")
+
+        if self._overlapping:
+            data = self._raw.pack(*registers[:self.count])
+            values += [dtype.decode(data[offset*2:(offset+n)*2], word_order=self._word_order)
+                       for _, offset, n, dtype in self._overlapping]
+        return values
+
+    def decode(self, registers: list) -> dict:
+        """ Returns register_name -> value, see decode_values """
+        return dict(zip(self.order, self.decode_values(registers)))
@@ -1,4 +1,5 @@
 import enum
+import struct
 from typing import Optional, Any
 
 
@@ -11,6 +12,17 @@ class RegisterTypes(enum.Enum):
 #     RTU
 
 
+class BreakerState(enum.Enum):
+    CLOSED = "closed"           # healthy, requests pass
+    OPEN = "open"               # failing, requests are skipped until the backoff expires
+    HALF_OPEN = "half_open"     # backoff expired, a single probe decides
+
+
+class Endian(enum.Enum):
+    BIG = ">"                   # most significant byte/ word first (Modbus default)
+    LITTLE = "<"
+
+
 class DataType(enum.Enum):
     # Unsigned integers
     U16 = "U16"
@@ -41,7 +53,7 @@ class DataType(enum.Enum):
             DataType.U32: 4,
             DataType.I32: 4,
             DataType.F32: 4,
-            DataType.F32: 4,
+            DataType.F64: 8,
             DataType.U64: 8,
             DataType.I64: 8,
             DataType.UTF8: None
@@ -57,7 +69,9 @@ class DataType(enum.Enum):
             DataType.I16: -32768,  # -2^15
             DataType.I32: -2147483648,  # -2^31
             DataType.U64: 0,
-            DataType.I64: -18446744073709551616,
+            DataType.I64: -9223372036854775808,  # -2^63
+            DataType.F32: None,
+            DataType.F64: None,
             DataType.UTF8: None
         }
         return ranges[self]
@@ -72,16 +86,25 @@ class DataType(enum.Enum):
             DataType.I32: 2147483647,  # 2^31 - 1
             DataType.U64: 18446744073709551615,
             DataType.I64: 9223372036854775807,
+            DataType.F32: None,
+            DataType.F64: None,
             DataType.UTF8: None
         }
         return ranges[self]
 
-    def encode(self, value: Any) -> bytes:
+    @property
+    def struct_format(self) -> Optional[str]:
+        """ struct format character, None for UTF8 """
+        return _STRUCT_FORMATS[self]
+
+    def encode(self, value: Any, byte_order: Endian = Endian.BIG, word_order: Endian = Endian.BIG) -> bytes:
         """
         Encode a Python value to bytes according to the data type.
         
         Args:
             value: The value to encode
+            byte_order: Order of the two bytes within each 16-bit register
+            word_order: Order of the registers of multi-register types
             
         Returns:
             bytes: The encoded value
@@ -89,15 +112,28 @@ class DataType(enum.Enum):
         Raises:
             ValueError: If the value is out of range for the type
         """
-        # TODO: Implement encoding logic
-        raise NotImplementedError
+        if self is DataType.UTF8:
+            data = str(value).encode("utf-8")
+            if len(data) % 2: data += b"\x00"
+            word_order = Endian.BIG                 # strings are always stored first character first
+        else:
+            if self.min_value is not None and not self.min_value <= value <= self.max_value:
+                raise ValueError(f"Value {value} out of range for {self.value}")
+            try:
+                data = _STRUCTS[self].pack(value)
+            except struct.error as e:
+                raise ValueError(f"Cannot encode {value} as {self.value}: {e}")
+
+        return _reorder(data, byte_order, word_order)
 
-    def decode(self, data: bytes) -> Any:
+    def decode(self, data: bytes, byte_order: Endian = Endian.BIG, word_order: Endian = Endian.BIG) -> Any:
         """
         Decode bytes to a Python value according to the data type.
         
         Args:
             data: The bytes to decode
+            byte_order: Order of the two bytes within each 16-bit register
+            word_order: Order of the registers of multi-register types
             
         Returns:
             The decoded value
@@ -105,8 +141,54 @@ class DataType(enum.Enum):
         Raises:
             ValueError: If the data cannot be decoded
         """
-        # TODO: Implement decoding logic
-        raise NotImplementedError
+        compiled = _STRUCTS.get(self)
+        if compiled is None:                        # UTF8
+            return _reorder(data, byte_order, Endian.BIG).decode("utf-8", errors="ignore").strip("\x00 ")
+
+        if byte_order is not Endian.BIG or word_order is not Endian.BIG: data = _reorder(data, byte_order, word_order)
+        try:
+            return compiled.unpack(data)[0]
+        except struct.error as e:
+            raise ValueError(f"Cannot decode {data!r} as {self.value}: {e}")
+
+    def encode_registers(self, value: Any, word_order: Endian = Endian.BIG) -> list[int]:
+        """ Encode a Python value to a list of 16-bit register values """
+        data = self.encode(value, word_order=word_order)
+        return list(struct.unpack(f">{len(data)//2}H", data))
+
+    def decode_registers(self, registers: list, word_order: Endian = Endian.BIG) -> Any:
+        """ Decode a list of 16-bit register values as read by pymodbus """
+        if self is DataType.U16: return registers[0]
+        if self is DataType.I16: return registers[0] - 0x10000 if registers[0] & 0x8000 else registers[0]
+        return self.decode(struct.pack(f">{len(registers)}H", *registers), word_order=word_order)
+
+
+_STRUCT_FORMATS = {
+    DataType.U16: "H",
+    DataType.I16: "h",
+    DataType.U32: "I",
+    DataType.I32: "i",
+    DataType.U64: "Q",
+    DataType.I64: "q",
+    DataType.F32: "f",
+    DataType.F64: "d",
+    DataType.UTF8: None,
+}
+
+# precompiled big endian structs, data is normalised to big byte and word order first
+_STRUCTS = {dtype: struct.Struct(f">{fmt}") for dtype, fmt in _STRUCT_FORMATS.items() if fmt}
+
+
+def _reorder(data: bytes, byte_order: Endian, word_order: Endian) -> bytes:
+    """ Convert between big byte/ word order and the given order. The operation is its own inverse. """
+    if byte_order is Endian.LITTLE:
+        swapped = bytearray(len(data))
+        swapped[0::2] = data[1::2]
+        swapped[1::2] = data[0::2]
+        data = bytes(swapped)
+    if word_order is Endian.LITTLE and len(data) > 2:
+        data = b"".join(data[i:i+2] for i in range(len(data)-2, -1, -2))
+    return data
 
 
 if __name__ == "__main__":
@@ -0,0 +1,243 @@
+import asyncio
+import mmap
+import os
+import struct
+import logging
+from collections import deque
+from dataclasses import dataclass
+from time import time, monotonic, sleep
+from pymodbus.exceptions import ModbusIOException
+from pymodbus.pdu import ExceptionResponse
+from pymodbus.pdu.register_read_message import ReadHoldingRegistersResponse, ReadInputRegistersResponse
+from pymodbus.pdu.register_write_message import WriteMultipleRegistersResponse
+logger = logging.getLogger(__name__)
+
+"""
+    Raw frame capture and replay:
+    With capture enabled a Client appends every request and the registers of its response
+    (or the values written) to a memory-mapped binary log, rotated by size. ReplayClient stands
+    in for the pymodbus client and answers requests from such a log, at the original pace or as
+    fast as possible, so decoding and publishing can be profiled on field data without hardware.
+
+    File layout: FILE_MAGIC, then records of a 4 byte length followed by RECORD and the registers
+    as big-endian uint16. A zero length ends the file (the mapped file is preallocated with zeros).
+    Rotated files are named <path>.1 (newest) to <path>.<backups>.
+
+    Replay answers each request with the next captured response for the same function code,
+    slave, address and count, so the client must plan the same block reads as during capture.
+"""
+
+FILE_MAGIC = b"MBFL\x01"
+LENGTH = struct.Struct(">I")
+RECORD = struct.Struct(">dBBBBHH")          # timestamp, function code, status, exception code, slave, address, count
+
+READ_HOLDING_REGISTERS = 3
+READ_INPUT_REGISTERS = 4
+WRITE_MULTIPLE_REGISTERS = 16
+
+STATUS_OK = 0
+STATUS_EXCEPTION = 1
+STATUS_NO_RESPONSE = 2
+
+
+@dataclass(slots=True)
+class Frame:
+    timestamp: float
+    function_code: int
+    status: int
+    exception_code: int
+    slave: int
+    address: int                            # 0-indexed, as sent on the wire
+    count: int
+    registers: tuple                        # response registers of reads, values of writes
+
+
+class FrameWriter:
+    """ Appends frames to a memory-mapped log of max_bytes, keeping `backups` rotated files """
+    def __init__(self, path: str, max_bytes: int = 16*2**20, backups: int = 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._file = None
+        self._mmap: mmap.mmap | None = None
+        self._pos = 0
+
+        if os.path.exists(path): self._shift_backups()          # never overwrite an earlier capture
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, "w+b")
+        self._file.truncate(self.max_bytes)
+        self._mmap = mmap.mmap(self._file.fileno(), self.max_bytes)
+        self._mmap[:len(FILE_MAGIC)] = FILE_MAGIC
+        self._pos = len(FILE_MAGIC)
+
+    def _shift_backups(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"): os.replace(f"{self.path}.{i}", f"{self.path}.{i+1}")
+        if self.backups: os.replace(self.path, f"{self.path}.1")
+        else: os.remove(self.path)
+
+    def _rotate(self):
+        self.close()
+        self._shift_backups()
+        self._open()
+        logger.info(f"Rotated frame capture {self.path}")
+
+    def append(self, function_code: int, slave: int, address: int, count: int, registers=(),
+               status: int = STATUS_OK, exception_code: int = 0):
+        registers = tuple(registers)
+        size = LENGTH.size + RECORD.size + 2*len(registers)
+        if self._pos + size + LENGTH.size > self.max_bytes: self._rotate()
+
+        pos = self._pos
+        LENGTH.pack_into(self._mmap, pos, size - LENGTH.size)
+        RECORD.pack_into(self._mmap, pos + LENGTH.size, time(), function_code, status, exception_code, slave, address, count)
+        struct.pack_into(f">{len(registers)}H", self._mmap, pos + LENGTH.size + RECORD.size, *registers)
+        self._pos = pos + size
+
+    def append_response(self, function_code: int, slave: int, address: int, count: int, result, registers=None):
+        """ Append a request and its pymodbus response. registers defaults to result.registers. """
+        if result.isError():
+            exception_code = getattr(result, "exception_code", 0)
+            self.append(function_code, slave, address, count, (), STATUS_EXCEPTION if exception_code else STATUS_NO_RESPONSE,
+                        exception_code)
+        else:
+            self.append(function_code, slave, address, count, result.registers if registers is None else registers)
+
+    def close(self):
+        if self._mmap is None: return
+        self._mmap.flush()
+        self._mmap.close()
+        self._file.truncate(self._pos)
+        self._file.close()
+        self._mmap = None
+
+
+def read_frames(path: str):
+    """ Yield the frames of a single log file """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= len(FILE_MAGIC): return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(FILE_MAGIC)] != FILE_MAGIC: raise ValueError(f"{path} is not a frame capture")
+            pos = len(FILE_MAGIC)
+            while pos + LENGTH.size <= len(data):
+                (length,) = LENGTH.unpack_from(data, pos)
+                if length == 0 or pos + LENGTH.size + length > len(data): break
+                fields = RECORD.unpack_from(data, pos + LENGTH.size)
+                n = (length - RECORD.size) // 2
+                registers = struct.unpack_from(f">{n}H", data, pos + LENGTH.size + RECORD.size)
+                yield Frame(*fields, registers)
+                pos += LENGTH.size + length
+
+
+def read_capture(path: str) -> list[Frame]:
+    """ All frames of a capture in chronological order, including rotated files """
+    paths = []
+    i = 1
+    while os.path.exists(f"{path}.{i}"):
+        paths.insert(0, f"{path}.{i}")
+        i += 1
+    if os.path.exists(path): paths.append(path)
+    return [frame for p in paths for frame in read_frames(p)]
+
+
+class ReplayClient:
+    """ Stands in for ModbusTcpClient/ ModbusSerialClient and answers from a frame capture.
+
+        Parameters:
+        -----------
+            - path: str: capture written by FrameWriter
+            - speed: float: 1 replays at the captured pace, 2 twice as fast, 0 without any delay
+            - loop: bool: start over once the frames of a request are used up, keeping the captured pace
+    """
+    def __init__(self, path: str, speed: float = 1, loop: bool = True):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        frames = read_capture(path)
+        self._t0 = frames[0].timestamp if frames else 0.0
+        self._start: float | None = None
+        self._frames: dict[tuple, deque] = {}                      # (function code, slave, address, count) -> frames
+        for frame in frames:
+            self._frames.setdefault((frame.function_code, frame.slave, frame.address, frame.count), deque()).append(frame)
+        self._used: dict[tuple, list] = {}
+        self._period: dict[tuple, float] = {key: self._loop_period(frames) for key, frames in self._frames.items()}
+        self._offset: dict[tuple, float] = {}                       # key -> captured seconds of the passes done
+        logger.info(f"Replaying {len(frames)} frames from {path}")
+
+    @property
+    def connected(self) -> bool:
+        return True
+
+    def connect(self) -> bool:
+        return True
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def _loop_period(frames: deque) -> float:
+        """ Captured seconds of one pass over the frames of a request, their span plus one mean interval """
+        if len(frames) < 2: return 0.0
+        span = frames[-1].timestamp - frames[0].timestamp
+        return span + span / (len(frames) - 1)
+
+    def _next(self, key: tuple) -> tuple[Frame | None, float]:
+        """ Next frame for a request and the seconds to wait before answering it """
+        frames = self._frames.get(key)
+        if frames is not None and not frames and self.loop:
+            frames.extend(self._used.pop(key, []))
+            self._offset[key] = self._offset.get(key, 0.0) + self._period[key]
+        if not frames:
+            return None, 0.0
+
+        frame = frames.popleft()
+        self._used.setdefault(key, []).append(frame)
+        if self._start is None: self._start = monotonic()
+        if not self.speed: return frame, 0.0
+        captured = frame.timestamp - self._t0 + self._offset.get(key, 0.0)
+        return frame, max(0.0, captured / self.speed - (monotonic() - self._start))
+
+    @staticmethod
+    def _response(frame: Frame | None, key: tuple):
+        function_code, slave, address, count = key
+        if frame is None:
+            if function_code == WRITE_MULTIPLE_REGISTERS: return WriteMultipleRegistersResponse(address, count, slave=slave)
+            raise ModbusIOException(f"No captured response for function code {function_code}, slave {slave}, address {address}, count {count}")
+        if frame.status == STATUS_NO_RESPONSE: raise ModbusIOException("No response (captured)")
+        if frame.status == STATUS_EXCEPTION: return ExceptionResponse(function_code, frame.exception_code, slave=slave)
+        if function_code == WRITE_MULTIPLE_REGISTERS: return WriteMultipleRegistersResponse(address, count, slave=slave)
+        response_class = ReadHoldingRegistersResponse if function_code == READ_HOLDING_REGISTERS else ReadInputRegistersResponse
+        return response_class(list(frame.registers), slave=slave)
+
+    def _execute(self, key: tuple):
+        frame, delay = self._next(key)
+        if delay: sleep(delay)
+        return self._response(frame, key)
+
+    def read_holding_registers(self, address: int, count: int = 1, slave: int = 1):
+        return self._execute((READ_HOLDING_REGISTERS, slave, address, count))
+
+    def read_input_registers(self, address: int, count: int = 1, slave: int = 1):
+        return self._execute((READ_INPUT_REGISTERS, slave, address, count))
+
+    def write_registers(self, address: int, values: list[int], slave: int = 1):
+        return self._execute((WRITE_MULTIPLE_REGISTERS, slave, address, len(values)))
+
+
+class AsyncReplayClient(ReplayClient):
+    """ ReplayClient for AsyncClient, waits with asyncio.sleep """
+    async def connect(self) -> bool:
+        return True
+
+    async def _execute(self, key: tuple):
+        frame, delay = self._next(key)
+        if delay: await asyncio.sleep(delay)
+        return self._response(frame, key)
+
+
+if __name__ == "__main__":
+    import sys
+    for frame in read_capture(sys.argv[1]):
+        print(frame)
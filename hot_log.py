@@ -0,0 +1,91 @@
+import logging
+from dataclasses import dataclass
+from time import monotonic
+
+"""
+    Logging for code that runs every poll cycle:
+    EventLogger wraps a logging.Logger. Every record has an event name and structured fields
+    (record.event, record.fields), for handlers that emit JSON or filter by event. The level is
+    checked before anything else is done, and messages use %-style arguments, so nothing is
+    formatted unless a handler emits the record.
+
+    Each event has a policy, set with configure():
+        sample: keep one record in N
+        rate_limit: at most one record per key (e.g. per server) every rate_limit seconds.
+    The next record that passes has the number suppressed in fields["suppressed"], warnings and
+    errors also in the message.
+    Per-register and per-block lines are debug records. At INFO, BusScheduler logs one summary of
+    all cycles of a bus every rate_limit seconds of the "cycle_summary" policy instead.
+"""
+
+
+@dataclass
+class EventPolicy:
+    sample: int = 1                                                 # keep one record in N
+    rate_limit: float = 0                                           # min seconds between records of a key, 0 for no limit
+
+
+DEFAULT_POLICIES = {
+    "cycle_summary": EventPolicy(rate_limit=60),
+    "read_error": EventPolicy(rate_limit=60),
+    "poll_error": EventPolicy(rate_limit=60),
+    "modbus_exception": EventPolicy(rate_limit=60),
+}
+POLICIES: dict[str, EventPolicy] = dict(DEFAULT_POLICIES)
+NO_POLICY = EventPolicy()
+
+
+def configure(rate_limits: dict[str, float] | None = None, sampling: dict[str, int] | None = None):
+    """ Set the event policies, on top of DEFAULT_POLICIES. Applies to every EventLogger of the process. """
+    POLICIES.clear()
+    POLICIES.update({event: EventPolicy(policy.sample, policy.rate_limit) for event, policy in DEFAULT_POLICIES.items()})
+    for event, seconds in (rate_limits or {}).items(): POLICIES.setdefault(event, EventPolicy()).rate_limit = seconds
+    for event, n in (sampling or {}).items(): POLICIES.setdefault(event, EventPolicy()).sample = max(1, int(n))
+    _state.clear()
+
+
+_state: dict[tuple, list] = {}                                      # (event, key) -> [records seen, suppressed, last emitted]
+
+
+class EventLogger:
+    """ Guarded, sampled and rate limited structured logging, see module docstring """
+    def __init__(self, name: str):
+        self.logger = logging.getLogger(name)
+
+    def log(self, level: int, event: str, msg: str, *args, key=None, **fields) -> bool:
+        """ Log msg % args as event if the level is enabled and the event's policy lets it pass.
+            key separates the rate limits of e.g. servers. Returns whether the record was emitted.
+        """
+        return self._log(level, event, msg, args, key, fields)
+
+    def debug(self, event: str, msg: str, *args, key=None, **fields) -> bool:
+        return self._log(logging.DEBUG, event, msg, args, key, fields)
+
+    def info(self, event: str, msg: str, *args, key=None, **fields) -> bool:
+        return self._log(logging.INFO, event, msg, args, key, fields)
+
+    def warning(self, event: str, msg: str, *args, key=None, **fields) -> bool:
+        return self._log(logging.WARNING, event, msg, args, key, fields)
+
+    def error(self, event: str, msg: str, *args, key=None, **fields) -> bool:
+        return self._log(logging.ERROR, event, msg, args, key, fields)
+
+    def _log(self, level: int, event: str, msg: str, args: tuple, key, fields: dict) -> bool:
+        if not self.logger.isEnabledFor(level): return False
+
+        policy = POLICIES.get(event, NO_POLICY)
+        if policy.sample > 1 or policy.rate_limit:
+            state = _state.get((event, key))
+            if state is None: state = _state[(event, key)] = [0, 0, float("-inf")]
+            state[0] += 1
+            now = monotonic()
+            if (state[0] - 1) % policy.sample or now - state[2] < policy.rate_limit:
+                state[1] += 1
+                return False
+            if state[1]:
+                fields["suppressed"] = state[1]
+                if level >= logging.WARNING: msg, args = f"{msg} (%d similar suppressed)", (*args, state[1])
+            state[1], state[2] = 0, now
+
+        self.logger.log(level, msg, *args, extra={"event": event, "fields": fields}, stacklevel=3)
+        return True
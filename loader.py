@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import json
 import os
 import logging
@@ -15,7 +15,7 @@ logger = logging.getLogger(__name__)
 
     requires validation:
     x unique ha_display_name
-    - connected client exists done in server constructer at the moment
+    x connected client exists
     x case connection type TCP: specs(name, host, port)
     x case connection type RTU: specs(name, baudrate: int, bytesize: int, parity: bool, stopbits: int
 """
@@ -28,6 +28,9 @@ class ServerOptions:
     server_type: str
     connected_client: str
     modbus_id: int
+    poll_intervals: dict[str, float] = field(default_factory=dict)  # register name or device_class -> seconds
+    aggregate_windows: dict[str, float] = field(default_factory=dict)   # register name or device_class -> seconds, see aggregation
+    aggregate_energy: bool = False                                  # also publish the integrated energy of aggregated power registers
 
 @dataclass
 class ClientOptions:
@@ -35,10 +38,26 @@ class ClientOptions:
     ha_display_name: str
     type: str
 
+    # block read planning, keyword-only so subclasses can add required fields
+    read_gap_tolerance: int = field(default=8, kw_only=True)       # max unused registers bridged in one request
+    read_max_count: int = field(default=100, kw_only=True)         # max registers per request
+
+    # circuit breaker of the client and its servers
+    backoff_base: float = field(default=5, kw_only=True)           # seconds before the first retry of a dead device
+    backoff_max: float = field(default=300, kw_only=True)          # cap of the exponential backoff
+    failure_threshold: int = field(default=3, kw_only=True)        # consecutive failures before a device counts as dead
+
+    # raw frame capture and replay, see frame_log
+    capture_path: str = field(default="", kw_only=True)            # append requests and responses to this log, "" to disable
+    capture_max_bytes: int = field(default=16*2**20, kw_only=True) # size at which the capture is rotated
+    replay_path: str = field(default="", kw_only=True)             # answer requests from this capture instead of the device
+    replay_speed: float = field(default=1, kw_only=True)           # 1 at the captured pace, 0 as fast as possible
+
 @dataclass
 class ModbusTCPOptions(ClientOptions):
     host: str
     port: int
+    pipeline_depth: int = 0                                         # >0: share one pipelined connection per host:port (async mode)
 
 @dataclass
 class ModbusRTUOptions(ClientOptions):
@@ -61,6 +80,31 @@ class Options:
     mwtt_ha_discovery_topic: str
     mqtt_base_topic: str
 
+    poll_interval: float = 5                                        # default seconds between reads of a register
+
+    # publish-on-change, per register overrides via "deadband"/ "deadband_rel" in the register definition
+    mqtt_deadband: float = 0                                        # absolute change required to publish
+    mqtt_deadband_rel: float = 0                                    # relative change required to publish, e.g. 0.01
+    mqtt_heartbeat_interval: float = 300                            # seconds after which unchanged values are republished
+
+    mqtt_write_debounce: float = 0.5                                # seconds /set messages are collected before writing
+    mqtt_aggregate_state: bool = False                              # one JSON state message per server and cycle instead of one per register
+
+    # store-and-forward of state messages during broker outages, see store_forward
+    mqtt_buffer_path: str = "/data/mqtt_buffer.bin"                 # ring buffer file, "" to disable
+    mqtt_buffer_max_bytes: int = 8*2**20                            # fixed size of the buffer, the oldest messages are dropped when full
+    mqtt_drain_rate: float = 200                                    # buffered messages per second after reconnecting, on top of the live ones
+
+    discovery_cache_path: str = "/data/discovery_cache.json"        # hashes of published discovery configs, "" to disable
+    model_cache_path: str = "/data/model_cache.json"                # models and register maps per serialnum, "" to disable
+
+    metrics_interval: float = 60                                    # seconds between diagnostics publishes, 0 to disable
+    metrics_ha_sensors: bool = False                                # expose per-client metrics as HA diagnostic sensors
+
+    # per-event policies of the hot path log records, see hot_log
+    log_rate_limits: dict[str, float] = field(default_factory=dict) # event -> min seconds between records, e.g. {"cycle_summary": 300}
+    log_sampling: dict[str, int] = field(default_factory=dict)      # event -> keep one record in N, e.g. {"register_read": 100}
+
 def validate_nicknames(opts: Options):
     """
     Verify unique names for clients and servers of options.
@@ -78,6 +122,12 @@ def validate_server_implemented(opts: Options):
         if server.server_type not in [t.name for t in ServerTypes]:
             raise ValueError(f"Server type {server.server_type} not defined in implemented_servers.ServerTypes")
 
+def validate_connected_clients(opts: Options):
+    clients = {c.ha_display_name for c in opts.clients}
+    for server in opts.servers:
+        if server.connected_client not in clients:
+            raise ValueError(f"Client {server.connected_client} from server {server.ha_display_name} config not defined in client list")
+
 def load_options(json_rel_path="/data/options.json") -> tuple[dict, dict]:
     """ Load server, client configurations and connection specs as dicts from options json. """
     converter = Converter()
@@ -102,11 +152,67 @@ def load_options(json_rel_path="/data/options.json") -> tuple[dict, dict]:
     opts = converter.structure(data, Options)
     validate_nicknames(opts)
     validate_server_implemented(opts)
+    validate_connected_clients(opts)
     logger.info("Successfully read configuration")
 
     return opts
 
 
+# Options applied by async_engine.Engine.reload without a restart, other changed fields need one
+LIVE_FIELDS = ("poll_interval", "mqtt_deadband", "mqtt_deadband_rel", "mqtt_heartbeat_interval", "mqtt_write_debounce",
+               "mqtt_drain_rate", "log_rate_limits", "log_sampling")
+LIVE_SERVER_FIELDS = ("poll_intervals", "aggregate_windows", "aggregate_energy")   # other changes re-create the server
+
+@dataclass
+class OptionsDiff:
+    """ Changes between two Options, clients and servers matched by name """
+    clients_added: list = field(default_factory=list)              # ClientOptions
+    clients_removed: list = field(default_factory=list)            # ClientOptions
+    clients_changed: list = field(default_factory=list)            # new ClientOptions, the client is re-created
+    servers_added: list[ServerOptions] = field(default_factory=list)
+    servers_removed: list[ServerOptions] = field(default_factory=list)
+    servers_changed: list[ServerOptions] = field(default_factory=list)  # new options, the server is re-created
+    servers_updated: list[ServerOptions] = field(default_factory=list)  # new options, only LIVE_SERVER_FIELDS changed
+    settings: dict[str, tuple] = field(default_factory=dict)       # Options field -> (old, new)
+
+    @property
+    def restart_required(self) -> list[str]:
+        """ Changed Options fields that cannot be applied to a running engine """
+        return [name for name in self.settings if name not in LIVE_FIELDS]
+
+    def __bool__(self):
+        return any((self.clients_added, self.clients_removed, self.clients_changed, self.servers_added,
+                    self.servers_removed, self.servers_changed, self.servers_updated, self.settings))
+
+def diff_options(old: Options, new: Options) -> OptionsDiff:
+    """ Compare the running options with newly loaded ones. The servers of a re-created or removed client are re-created. """
+    diff = OptionsDiff()
+    old_clients = {c.name: c for c in old.clients}
+    new_clients = {c.name: c for c in new.clients}
+    diff.clients_added = [c for name, c in new_clients.items() if name not in old_clients]
+    diff.clients_removed = [c for name, c in old_clients.items() if name not in new_clients]
+    diff.clients_changed = [c for name, c in new_clients.items() if name in old_clients and old_clients[name] != c]
+    recreated = {c.ha_display_name for c in diff.clients_changed + diff.clients_removed}
+
+    old_servers = {s.name: s for s in old.servers}
+    new_servers = {s.name: s for s in new.servers}
+    diff.servers_added = [s for name, s in new_servers.items() if name not in old_servers]
+    diff.servers_removed = [s for name, s in old_servers.items() if name not in new_servers]
+    for name, server in new_servers.items():
+        previous = old_servers.get(name)
+        if previous is None: continue
+        changed = {f for f in ServerOptions.__dataclass_fields__ if getattr(previous, f) != getattr(server, f)}
+        if not changed.issubset(LIVE_SERVER_FIELDS) or server.connected_client in recreated:
+            diff.servers_changed.append(server)
+        elif changed:
+            diff.servers_updated.append(server)
+
+    for name in Options.__dataclass_fields__:
+        if name in ("servers", "clients"): continue
+        if getattr(old, name) != getattr(new, name): diff.settings[name] = (getattr(old, name), getattr(new, name))
+    return diff
+
+
 if __name__ == "__main__":
     import pprint
     opts = load_options()
@@ -0,0 +1,101 @@
+import bisect
+import logging
+logger = logging.getLogger(__name__)
+
+"""
+    Runtime metrics:
+    Request latency histograms per client, server and register group, Modbus exceptions by code,
+    timeouts, poll-cycle durations and MQTT publish overhead. Recorded into the module-level
+    METRICS registry and published periodically as JSON, see MqttClient.publish_metrics.
+"""
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))   # seconds
+PUBLISH_BUCKETS = (1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 1e-3, float("inf"))
+
+
+class Histogram:
+    """ Fixed-bucket histogram. Percentiles are reported as the upper bound of the containing bucket. """
+    __slots__ = ("buckets", "counts", "count", "sum", "max")
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max: self.max = value
+
+    def percentile(self, q: float) -> float:
+        if not self.count: return 0.0
+        target = q * self.count
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            if cumulative >= target: return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "max": self.max,
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.latency: dict[tuple[str, str, str], Histogram] = {}    # (client, server, register group) -> request latency
+        self.cycles: dict[tuple[str, str], Histogram] = {}          # (client, server) -> read_server_registers duration
+        self.exceptions: dict[tuple[str, int], int] = {}            # (client, modbus exception code) -> count
+        self.timeouts: dict[str, int] = {}                          # client -> requests without (valid) response
+        self.publish = Histogram(PUBLISH_BUCKETS)                   # MqttClient.publish_to_ha overhead
+
+    def observe_request(self, client: str, server: str, group: str, seconds: float):
+        histogram = self.latency.get((client, server, group))
+        if histogram is None: histogram = self.latency[(client, server, group)] = Histogram()
+        histogram.observe(seconds)
+
+    def observe_cycle(self, client: str, server: str, seconds: float):
+        histogram = self.cycles.get((client, server))
+        if histogram is None: histogram = self.cycles[(client, server)] = Histogram()
+        histogram.observe(seconds)
+
+    def count_exception(self, client: str, exception_code: int):
+        self.exceptions[(client, exception_code)] = self.exceptions.get((client, exception_code), 0) + 1
+
+    def count_timeout(self, client: str):
+        self.timeouts[client] = self.timeouts.get(client, 0) + 1
+
+    def snapshot(self) -> dict:
+        """ JSON-serialisable summary, nested by client and server """
+        clients: dict[str, dict] = {}
+
+        def client_entry(client):
+            return clients.setdefault(client, {"requests": 0, "timeouts": self.timeouts.get(client, 0),
+                                               "exceptions": {}, "servers": {}})
+
+        for (client, server, group), histogram in self.latency.items():
+            entry = client_entry(client)
+            entry["requests"] += histogram.count
+            entry["servers"].setdefault(server, {"groups": {}})["groups"][group] = histogram.summary()
+        for (client, server), histogram in self.cycles.items():
+            client_entry(client)["servers"].setdefault(server, {"groups": {}})["cycle"] = histogram.summary()
+        for (client, code), n in self.exceptions.items():
+            client_entry(client)["exceptions"][str(code)] = n
+        for client in self.timeouts:
+            client_entry(client)
+
+        return {"clients": clients, "mqtt": {"publish": self.publish.summary()}}
+
+
+METRICS = Metrics()
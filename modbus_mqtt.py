@@ -1,11 +1,19 @@
+import asyncio
 import paho.mqtt.client as mqtt
 from paho.mqtt.enums import CallbackAPIVersion
 import json
+import hashlib
+import os
 import logging
+from dataclasses import dataclass
+from typing import Callable
 from loader import Options
+from metrics import METRICS
+from store_forward import RingBuffer
+from aggregation import Aggregator
 
 from random import getrandbits
-from time import time, sleep
+from time import time, monotonic, perf_counter
 from queue import Queue
 
 logger = logging.getLogger(__name__)
@@ -14,6 +22,118 @@ RECV_Q = Queue()
 def slugify(text):
     return text.replace(' ', '_').replace('(', '').replace(')', '').replace('/', 'OR').replace('&', ' ').replace(':', '').replace('.', '').lower()
 
+AVAILABILITY_PAYLOADS = {True: b"online", False: b"offline"}
+
+
+@dataclass(slots=True)
+class TopicTable:
+    """ Topics of one server, compiled once so the publish path only does lookups """
+    availability: str
+    state: dict[str, str]                   # register or write parameter name -> state topic
+    server_state: str                       # JSON document of all register values in aggregated mode
+    state_key: dict[str, str]               # register_name -> key in the JSON document
+    command: dict[str, str]                 # write parameter name -> command topic
+    unique_id: dict[str, str]               # register or write parameter name -> HA unique_id
+    sensor_config: dict[str, str]           # register_name -> discovery config topic
+    number_config: dict[str, str]           # write parameter name -> discovery config topic
+
+
+class DiscoveryCache:
+    """ Content hashes of the retained discovery configs published per server, persisted across restarts
+        so only added, changed or removed configs are sent to the broker.
+
+        Delete the file to force a full republish, e.g. after the broker lost its retained messages.
+        An empty path disables persistence, so everything is published on every start.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.hashes: dict[str, dict[str, str]] = {}                 # server nickname -> discovery topic -> hash
+
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.hashes = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not read discovery cache {path}, republishing all discovery topics: {e}")
+
+    @staticmethod
+    def _hash(payload: str) -> str:
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def diff(self, nickname: str, payloads: dict[str, str]) -> tuple[dict[str, str], list[str]]:
+        """ Returns the payloads that were added or changed and the topics that were removed """
+        previous = self.hashes.get(nickname, {})
+        changed = {topic: payload for topic, payload in payloads.items() if previous.get(topic) != self._hash(payload)}
+        removed = [topic for topic in previous if topic not in payloads]
+        return changed, removed
+
+    def record(self, nickname: str, sent: dict[str, str | bytes]):
+        """ Record discovery messages of a server that were handed to the broker connection, b"" for a deleted
+            config. Topics that were not sent keep their previous hash, so the next diff sends them again.
+        """
+        hashes = self.hashes.setdefault(nickname, {})
+        for topic, payload in sent.items():
+            if payload == b"": hashes.pop(topic, None)
+            else: hashes[topic] = self._hash(payload)
+        if not hashes: del self.hashes[nickname]
+        self.save()
+
+    def save(self):
+        if not self.path: return
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.hashes, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not write discovery cache {self.path}: {e}")
+
+
+class ChangeFilter:
+    """ Last-value cache keyed by server and register deciding which readings to publish.
+
+        A reading is published if it moved beyond the absolute or relative deadband since the last
+        published value, or if it was last published more than heartbeat_interval seconds ago.
+        Deadbands can be overridden per register with the "deadband" and "deadband_rel" keys.
+    """
+    def __init__(self, deadband: float = 0, deadband_rel: float = 0, heartbeat_interval: float = 300):
+        self.deadband = deadband
+        self.deadband_rel = deadband_rel
+        self.heartbeat_interval = heartbeat_interval
+        self._last: dict[tuple[str, str], tuple[object, float]] = {}  # (server, register) -> (value, publish time)
+
+        self.published = 0
+        self.suppressed = 0
+
+    def should_publish(self, server_name: str, register_name: str, value, register_info: dict | None = None) -> bool:
+        now = monotonic()
+        key = (server_name, register_name)
+        last = self._last.get(key)
+
+        if last is not None and now - last[1] < self.heartbeat_interval and not self._changed(last[0], value, register_info):
+            self.suppressed += 1
+            return False
+
+        self._last[key] = (value, now)
+        self.published += 1
+        return True
+
+    def _changed(self, last, value, register_info: dict | None) -> bool:
+        if not isinstance(value, (int, float)) or not isinstance(last, (int, float)): return value != last
+
+        register_info = register_info or {}
+        deadband = register_info.get("deadband", self.deadband)
+        deadband_rel = register_info.get("deadband_rel", self.deadband_rel)
+        delta = abs(value - last)
+        if delta == 0: return False
+        return delta > deadband and delta > deadband_rel*abs(last)
+
+    def invalidate(self, server_name: str | None = None):
+        """ Forget last values, so the next reading of the server (or every server if None) is published """
+        if server_name is None: self._last.clear()
+        else: self._last = {k: v for k, v in self._last.items() if k[0] != server_name}
+
+
 class MqttClient(mqtt.Client):
     def __init__(self, options: Options):
         def generate_uuid():
@@ -29,25 +149,86 @@ class MqttClient(mqtt.Client):
         self.username_pw_set(options.mqtt_user, options.mqtt_password)
         self.base_topic = options.mqtt_base_topic
         self.ha_discovery_topic = options.mwtt_ha_discovery_topic
+        self.change_filter = ChangeFilter(options.mqtt_deadband, options.mqtt_deadband_rel, options.mqtt_heartbeat_interval)
+        self.topics: dict[str, TopicTable] = {}                     # server nickname -> compiled topics
+        self.discovery_cache = DiscoveryCache(options.discovery_cache_path)
+        self._unsent_discovery: dict[str, dict[str, str | bytes]] = {}    # server nickname -> topic -> discovery message not sent
+        self.command_handler: Callable[[mqtt.MQTTMessage], None] | None = None   # called on the network thread, RECV_Q if None
+        self.on_topics_changed: Callable[[], None] | None = None    # called after a topic table is compiled or dropped
+        self.event_loop: asyncio.AbstractEventLoop | None = None    # set by the engine, on_connect hands its work to it
+        self.aggregate_state: bool = options.mqtt_aggregate_state
+        self._state_documents: dict[str, dict] = {}                # server nickname -> last values by state_key, aggregated mode
+        self.aggregator = Aggregator()                              # windowed min/max/mean of fast sampled registers
+
+        # store-and-forward of state messages while the broker is unreachable, see store_forward
+        self.online: bool = False                                   # set by on_connect/ on_disconnect on the network thread
+        self.buffer: RingBuffer | None = None
+        self.drain_rate: float = options.mqtt_drain_rate            # buffered messages per second on top of the live ones
+        self.state_messages: int = 0                                # state messages since start, for the live rate
+        if options.mqtt_buffer_path:
+            try:
+                self.buffer = RingBuffer(options.mqtt_buffer_path, options.mqtt_buffer_max_bytes)
+            except OSError as e:
+                logger.warning(f"Could not open store-and-forward buffer {options.mqtt_buffer_path}, "
+                               f"state messages are lost while disconnected: {e}")
 
         def on_connect(client, userdata, connect_flags, reason_code, properties):
             if reason_code == 0:
                 logger.info(f"Connected to MQTT broker.")
+                self.online = True
+                if self.buffer: logger.info(f"Draining {len(self.buffer)} buffered messages at {self.drain_rate}/s")
+                # the filter, discovery cache and topic tables belong to the event loop, not the network thread
+                if self.event_loop is not None and not self.event_loop.is_closed():
+                    self.event_loop.call_soon_threadsafe(self._on_connected)
+                else: self._on_connected()
             else:
                 logger.info(f"Not connected to MQTT broker.\nReturn code: {reason_code=}")
 
-        def on_disconnect(client, userdata, message):
-            logger.info("Disconnected from MQTT broker")
+        def on_disconnect(client, userdata, disconnect_flags, reason_code, properties):
+            self.online = False
+            logger.info(f"Disconnected from MQTT broker{', buffering state messages' if self.buffer is not None else ''}")
 
         def on_message(client, userdata, message):
             logger.info("Received message on MQTT")
-            sleep(0.01)
-            RECV_Q.put(message)                         # thread-safe
+            if self.command_handler is not None: self.command_handler(message)
+            else: RECV_Q.put(message)                   # thread-safe
 
         self.on_connect = on_connect
         self.on_disconnect = on_disconnect
         self.on_message = on_message
 
+    def _on_connected(self):
+        """ Republish everything and resubscribe the command topics after a (re)connect """
+        self.change_filter.invalidate()
+        self.resend_discovery()
+        for topics in self.topics.values():
+            for command_topic in topics.command.values(): self.subscribe(command_topic)
+
+    def compile_topics(self, server) -> TopicTable:
+        """ Build the topic table of a server. Call again whenever server.registers changes. """
+        nickname = server.nickname
+        derived = self.aggregator.configure(server)                 # sensors of the aggregation windows
+        register_slugs = {name: slugify(name) for name in server.registers | derived}
+        write_slugs = {name: slugify(name) for name in server.write_parameters}
+
+        table = TopicTable(
+            availability=f"{self.base_topic}_{nickname}/availability",
+            state={name: f"{self.base_topic}/{nickname}/{slug}/state" for name, slug in (write_slugs | register_slugs).items()},
+            server_state=f"{self.base_topic}/{nickname}/state",
+            state_key=register_slugs,
+            command={name: f"{self.base_topic}/{nickname}/{slug}/set" for name, slug in write_slugs.items()},
+            unique_id={name: f"{nickname}_{slug}" for name, slug in (register_slugs | write_slugs).items()},
+            sensor_config={name: f"{self.ha_discovery_topic}/sensor/{nickname}/{slug}/config" for name, slug in register_slugs.items()},
+            number_config={name: f"{self.ha_discovery_topic}/number/{nickname}/{slug}/config" for name, slug in write_slugs.items()},
+        )
+        self.topics[nickname] = table
+        if self.on_topics_changed is not None: self.on_topics_changed()
+        return table
+
+    def _topic_table(self, server) -> TopicTable:
+        table = self.topics.get(server.nickname)
+        return table if table is not None else self.compile_topics(server)
+
     def publish_discovery_topics(self, server):
         if not server.model or not server.manufacturer or not server.serialnum or not server.nickname or not server.registers:
             logging.info(f"Server not properly configured. Cannot publish MQTT info")
@@ -64,44 +245,197 @@ class MqttClient(mqtt.Client):
 
         # publish discovery topics for legal registers
         # assume registers in server.registers
-        availability_topic = f"{self.base_topic}_{server.nickname}/availability"
+        topics = self.compile_topics(server)
+        payloads: dict[str, str] = {}                               # discovery topic -> config
 
-        for register_name, details in server.registers.items():
-            state_topic = f"{self.base_topic}/{server.nickname}/{slugify(register_name)}/state"
+        for register_name, details in (server.registers | self.aggregator.derived[server.nickname]).items():
             discovery_payload = {
                     "name": register_name,
-                    "unique_id": f"{server.nickname}_{slugify(register_name)}",
-                    "state_topic": state_topic,
-                    "availability_topic": availability_topic,
+                    "unique_id": topics.unique_id[register_name],
+                    "state_topic": topics.state[register_name],
+                    "availability_topic": topics.availability,
                     "device": device,
                     "device_class": details["device_class"],
                     "unit_of_measurement": details["unit"],
                 }
+            if self.aggregate_state:
+                discovery_payload["state_topic"] = topics.server_state
+                discovery_payload["value_template"] = f"{{{{ value_json['{topics.state_key[register_name]}'] }}}}"
             state_class = details.get("state_class", False)
             if state_class: discovery_payload['state_class'] = state_class
-            discovery_topic = f"{self.ha_discovery_topic}/sensor/{server.nickname}/{slugify(register_name)}/config"
-            self.publish(discovery_topic, json.dumps(discovery_payload), retain=True)
-
-        self.publish_availability(True, server)
+            payloads[topics.sensor_config[register_name]] = json.dumps(discovery_payload)
 
-        for register_name, details in server.write_parameters:
+        for register_name, details in server.write_parameters.items():
             discovery_payload = {
                 "name": register_name,
-                "unique_id": f"{server.nickname}_{slugify(register_name)}",
-                "command_topic": f"{self.base_topic}/{server.nickname}/{slugify(register_name)}/set",
+                "unique_id": topics.unique_id[register_name],
+                "command_topic": topics.command[register_name],
+                "state_topic": topics.state[register_name],
                 "unit_of_measurement": details["unit"],
-                "availability_topic": availability_topic,
+                "availability_topic": topics.availability,
                 "device": device
             }
+            payloads[topics.number_config[register_name]] = json.dumps(discovery_payload)
+
+        changed, removed = self.discovery_cache.diff(server.nickname, payloads)
+        logger.info(f"Discovery for {server.nickname}: {len(changed)} added or changed, {len(removed)} removed, "
+                    f"{len(payloads) - len(changed)} unchanged")
+
+        self._send_discovery(server.nickname, changed | {topic: b"" for topic in removed})  # b"" deletes the entity
+
+        self.publish_availability(True, server)
+        for command_topic in topics.command.values(): self.subscribe(command_topic)
+
+    def remove_stale_discovery_topics(self, servers):
+        """ Delete the discovery configs of servers that are no longer configured.
+            Call once all configured servers have published their discovery topics.
+        """
+        active = {server.nickname for server in servers}
+        for nickname in [n for n in self.discovery_cache.hashes if n not in active]:
+            logger.info(f"Removing discovery topics of server {nickname}, which is no longer configured")
+            self._send_discovery(nickname, {discovery_topic: b"" for discovery_topic in self.discovery_cache.hashes[nickname]})
+
+    def _send_discovery(self, nickname: str, messages: dict[str, str | bytes]):
+        """ Publish retained discovery messages of a server and record those paho accepted in the discovery cache.
+            The others, e.g. published before the first connect, are sent again by on_connect.
+        """
+        sent = {topic: payload for topic, payload in messages.items()
+                if self.publish(topic, payload, retain=True).rc == mqtt.MQTT_ERR_SUCCESS}
+        self._unsent_discovery[nickname] = {topic: payload for topic, payload in messages.items() if topic not in sent}
+        if self._unsent_discovery[nickname]:
+            logger.warning(f"{len(self._unsent_discovery[nickname])} discovery messages of {nickname} not sent, "
+                           f"retrying after the next connect")
+        if sent: self.discovery_cache.record(nickname, sent)
+
+    def resend_discovery(self):
+        """ Publish the discovery messages that paho did not accept before """
+        for nickname, messages in list(self._unsent_discovery.items()):
+            if messages: self._send_discovery(nickname, messages)
+
+    def forget_server(self, server):
+        """ Drop the topics, last values and aggregation windows of a server that is removed or re-created.
+            Its discovery configs are kept: a re-created server only republishes what changed,
+            a removed one is cleaned up by remove_stale_discovery_topics.
+        """
+        topics = self.topics.pop(server.nickname, None)
+        if topics is not None:
+            for command_topic in topics.command.values(): self.unsubscribe(command_topic)
+            if self.on_topics_changed is not None: self.on_topics_changed()
+        self.change_filter.invalidate(server.nickname)
+        self._state_documents.pop(server.nickname, None)
+        self._unsent_discovery.pop(server.nickname, None)       # not resent for a removed server
+        self.aggregator.forget(server.nickname)
 
-            discovery_topic = f"{self.ha_discovery_topic}/number/{server.nickname}/{slugify(register_name)}/config"
-            self.publish(discovery_topic, json.dumps(discovery_payload), retain=True)
+    def publish_to_ha(self, register_name, value, server, force=False):
+        """ Publish a register or write parameter state. force bypasses the change filter, e.g. for write read-backs. """
+        start = perf_counter()
+        if not force and not self.change_filter.should_publish(server.nickname, register_name, value, server.registers.get(register_name)):
+            return
+        state_topic = self._topic_table(server).state.get(register_name) or self.compile_topics(server).state[register_name]
+        self.publish_state(state_topic, value)
+        METRICS.publish.observe(perf_counter() - start)
 
-    def publish_to_ha(self, register_name, value, server):
-        state_topic = f"{self.base_topic}/{server.nickname}/{slugify(register_name)}/state"
-        self.publish(state_topic, value) #, retain=True)
+    def publish_values(self, server, values: dict, t: float | None = None):
+        """ Publish the register values of a poll cycle, one message per register or one JSON document per server.
+            Registers with an aggregation window are only published when their window closes.
+            t: time of the reading, now if None
+        """
+        self._publish_values(server, self.aggregator.add(server, values, t))
+
+    def flush_windows(self, t: float | None = None):
+        """ Publish the aggregation windows that ended by t (now if None) with no later sample to close them """
+        for server, values in self.aggregator.flush(t): self._publish_values(server, values)
+
+    def _publish_values(self, server, values: dict):
+        if not values: return
+        if self.aggregate_state:
+            self.publish_state_document(server, values)
+            return
+        for register_name, value in values.items():
+            self.publish_to_ha(register_name, value, server)
+
+    def publish_state_document(self, server, values: dict):
+        """ Aggregated mode: merge values into the server's JSON state document and publish it as a single
+            message, if any of the values passes the change filter. Sensors extract their value with value_template.
+        """
+        start = perf_counter()
+        should_publish = self.change_filter.should_publish
+        publish = False
+        for register_name, value in values.items():
+            if should_publish(server.nickname, register_name, value, server.registers.get(register_name)): publish = True
+        if not publish: return
+
+        topics = self._topic_table(server)
+        if any(register_name not in topics.state_key for register_name in values): topics = self.compile_topics(server)
+        document = self._state_documents.setdefault(server.nickname, {})
+        for register_name, value in values.items():
+            document[topics.state_key[register_name]] = value
+        self.publish_state(topics.server_state, json.dumps(document))
+        METRICS.publish.observe(perf_counter() - start)
+
+    def publish_state(self, topic: str, payload):
+        """ Publish a state message, or append it to the store-and-forward buffer while the broker is unreachable.
+            Messages keep their order: while older ones are still buffered, new ones are buffered behind them
+            and drain_worker drains them on top of drain_rate, so the backlog shrinks whatever the live rate.
+        """
+        self.state_messages += 1
+        if self.buffer is None:
+            self.publish(topic, payload) #, retain=True)
+            return
+        # a publish refused by paho (e.g. disconnected before on_disconnect ran) is buffered too
+        if self.online and not self.buffer and self.publish(topic, payload).rc == mqtt.MQTT_ERR_SUCCESS: return
+        self.buffer.push(topic, payload if isinstance(payload, bytes) else str(payload).encode())
+
+    def drain_buffer(self, max_messages: int) -> int:
+        """ Publish up to max_messages buffered state messages, oldest first. Returns the number published.
+            A message is only removed from the buffer once paho accepted it.
+        """
+        n = 0
+        while n < max_messages and self.online and self.buffer:
+            _, topic, payload = self.buffer.peek()
+            if self.publish(topic, payload).rc != mqtt.MQTT_ERR_SUCCESS: break
+            self.buffer.pop()
+            n += 1
+        if n and not self.buffer: logger.info(f"Store-and-forward buffer drained")
+        return n
 
     def publish_availability(self, avail, server):
-        availability_topic = f"{self.base_topic}_{server.nickname}/availability"
-        self.publish(availability_topic, "online" if avail else "offline", retain=True)
-        
\ No newline at end of file
+        if not avail: self._publish_values(server, self.aggregator.close_all(server))  # the samples before the outage
+        self.publish(self._topic_table(server).availability, AVAILABILITY_PAYLOADS[bool(avail)], retain=True)
+
+    @property
+    def diagnostics_topic(self):
+        return f"{self.base_topic}/diagnostics"
+
+    def publish_metrics(self, clients: dict | None = None):
+        """ Publish a JSON snapshot of metrics.METRICS and the publish counters to the diagnostics topic.
+            clients: per-client snapshots collected in worker processes, see sharding.ShardSupervisor
+        """
+        snapshot = METRICS.snapshot()
+        if clients: snapshot["clients"].update(clients)
+        snapshot["mqtt"]["published"] = self.change_filter.published
+        snapshot["mqtt"]["suppressed"] = self.change_filter.suppressed
+        if self.buffer is not None: snapshot["mqtt"]["buffer"] = self.buffer.stats()
+        self.publish(self.diagnostics_topic, json.dumps(snapshot))
+
+    def publish_metrics_discovery(self, clients):
+        """ Expose per-client metrics from the diagnostics topic as HA diagnostic sensors """
+        device = {"name": "Modbus MQTT", "identifiers": ["modbus_mqtt_diagnostics"], "manufacturer": "modbus-mqtt"}
+        sensors = {
+            "requests": ("Requests", "{{ value_json.clients['%s'].requests }}"),
+            "timeouts": ("Timeouts", "{{ value_json.clients['%s'].timeouts }}"),
+            "exceptions": ("Modbus exceptions", "{{ value_json.clients['%s'].exceptions.values() | sum }}"),
+        }
+        for client in clients:
+            for key, (name, template) in sensors.items():
+                unique_id = f"modbus_mqtt_{client.nickname}_{key}"
+                discovery_payload = {
+                    "name": f"{client.nickname} {name}",
+                    "unique_id": unique_id,
+                    "state_topic": self.diagnostics_topic,
+                    "value_template": template % client.nickname,
+                    "entity_category": "diagnostic",
+                    "state_class": "total_increasing",
+                    "device": device,
+                }
+                self.publish(f"{self.ha_discovery_topic}/sensor/modbus_mqtt/{unique_id}/config", json.dumps(discovery_payload), retain=True)
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import logging
+from enums import DataType, RegisterTypes
+logger = logging.getLogger(__name__)
+
+"""
+    Model cache:
+    The detected model, model_info and the register map left after setup_valid_registers_for_model
+    are persisted per serial number. On the next start a server is set up from the cache without
+    any Modbus traffic, and the device type code is read once in the background to confirm it.
+
+    An entry is only used if the server implementation and its full register definitions are
+    unchanged since it was written, so updating a register map invalidates the cache.
+"""
+
+DEVICE_TYPE_CODE = "Device type code"
+ENUM_KEYS = {"dtype": DataType, "register_type": RegisterTypes}
+
+
+def _dump_registers(registers: dict) -> dict:
+    return {name: {k: v.name if k in ENUM_KEYS else v for k, v in info.items()} for name, info in registers.items()}
+
+
+def _load_registers(registers: dict) -> dict:
+    return {name: {k: ENUM_KEYS[k][v] if k in ENUM_KEYS else v for k, v in info.items()} for name, info in registers.items()}
+
+
+class ModelCache:
+    """ Per serialnum: model code, model, model_info and the pruned registers/ write_parameters.
+        An empty path disables persistence.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: dict[str, dict] = {}                          # serialnum -> cache entry
+        self._originals: dict[str, tuple[dict, dict]] = {}          # server name -> full (registers, write_parameters)
+
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not read model cache {path}, reading models from the servers: {e}")
+
+    @staticmethod
+    def fingerprint(server) -> str:
+        """ Hash of the server implementation and its register definitions as they are now """
+        definitions = [type(server).__name__, _dump_registers(server.registers), _dump_registers(server.write_parameters)]
+        return hashlib.sha1(json.dumps(definitions, sort_keys=True, default=str).encode()).hexdigest()
+
+    def restore(self, server) -> bool:
+        """ Set up the server from its cache entry, returns False if there is no valid entry """
+        entry = self.entries.get(server.serialnum)
+        if entry is None: return False
+        if entry["fingerprint"] != self.fingerprint(server):
+            logger.info(f"Register definitions of {server} changed, ignoring cached model")
+            return False
+
+        self._originals[server.name] = (server.registers, server.write_parameters)
+        server.registers = _load_registers(entry["registers"])
+        server.write_parameters = _load_registers(entry["write_parameters"])
+        server.model = entry["model"]
+        server.model_info = entry["model_info"]
+        server.modelcode = entry["modelcode"]
+        server.compile_registers()
+        logger.info(f"Restored model {server.model} and {len(server.registers)} registers of {server} from cache")
+        return True
+
+    def modelcode_register(self, server) -> dict | None:
+        """ register_info of the device type code in the unpruned register map of a restored server """
+        registers, _ = self._originals.get(server.name, (server.registers, None))
+        return registers.get(DEVICE_TYPE_CODE)
+
+    def reset(self, server):
+        """ Undo restore after the revalidation read returned a different model, and forget the entry """
+        registers, write_parameters = self._originals.pop(server.name)
+        server.registers, server.write_parameters = registers, write_parameters
+        server.model = server.model_info = server.modelcode = None
+        server.compile_registers()
+        self.entries.pop(server.serialnum, None)
+        self.save()
+
+    def store(self, server, fingerprint: str):
+        """ Record a server after setup_valid_registers_for_model, fingerprint as taken before the setup """
+        self.entries[server.serialnum] = {
+            "fingerprint": fingerprint,
+            "modelcode": server.modelcode,
+            "model": server.model,
+            "model_info": server.model_info,
+            "registers": _dump_registers(server.registers),
+            "write_parameters": _dump_registers(server.write_parameters),
+        }
+        self.save()
+
+    def save(self):
+        if not self.path: return
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Could not write model cache {self.path}: {e}")
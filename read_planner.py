@@ -0,0 +1,99 @@
+from dataclasses import dataclass, field
+import logging
+from enums import RegisterTypes
+logger = logging.getLogger(__name__)
+
+"""
+    Read planning:
+    Coalesces the per-register reads of a server into as few block reads as possible.
+    Registers of the same register_type (and therefore the same Modbus function code) on
+    the same slave are merged into one span if the gap between them does not exceed
+    `gap_tolerance` registers and the span stays within `max_count` registers.
+    Known hole addresses (Illegal Data Address) are never bridged. A register overlapping a hole
+    is read on its own and never merged, so its error response cannot fail a whole block.
+"""
+
+MODBUS_MAX_READ_COUNT = 125     # protocol limit for function codes 3 and 4
+MODBUS_MAX_WRITE_COUNT = 123    # protocol limit for function code 16
+
+
+@dataclass
+class ReadBlock:
+    register_type: RegisterTypes
+    slave_id: int
+    address: int                                                        # 1-indexed start address
+    count: int
+    members: list[tuple[str, int, int]] = field(default_factory=list)   # (register_name, offset, count)
+
+    @property
+    def end(self) -> int:
+        """ First address after the block """
+        return self.address + self.count
+
+    @property
+    def label(self) -> str:
+        """ Register group name used in metrics, e.g. 'holding 5000-5039' """
+        return f"{self.register_type.name.split('_')[0].lower()} {self.address}-{self.end-1}"
+
+    def gap_addresses(self) -> set[int]:
+        """ Addresses inside the block that are not covered by any member register """
+        covered = set()
+        for _, offset, count in self.members:
+            covered.update(range(self.address + offset, self.address + offset + count))
+        return set(range(self.address, self.end)) - covered
+
+
+@dataclass
+class WriteBatch(ReadBlock):
+    """ Adjacent write parameters written with one write_registers request """
+    values: list[int] = field(default_factory=list)
+
+
+def plan_reads(registers: dict, slave_id: int, gap_tolerance: int = 8, max_count: int = 100,
+               holes: dict[RegisterTypes, set[int]] | None = None) -> list[ReadBlock]:
+    """ Group the registers of a server into contiguous or nearly contiguous block reads.
+
+        Parameters:
+        -----------
+            - registers: dict: register_name -> register_info as in Server.registers
+            - slave_id: int: modbus slave id of the server
+            - gap_tolerance: int: max number of unused registers bridged between two registers
+            - max_count: int: max number of registers per request
+            - holes: dict: register_type -> 1-indexed addresses known to return Illegal Data Address
+    """
+    max_count = min(max_count, MODBUS_MAX_READ_COUNT)
+    blocks: list[ReadBlock] = []
+
+    by_type: dict[RegisterTypes, list[tuple[int, int, str]]] = {}
+    for register_name, register_info in registers.items():
+        by_type.setdefault(register_info["register_type"], []).append(
+            (register_info["addr"], register_info["count"], register_name))
+
+    for register_type, entries in by_type.items():
+        entries.sort()
+        type_holes = holes.get(register_type, ()) if holes else ()
+        block: ReadBlock | None = None
+
+        for address, count, register_name in entries:
+            if any(a in type_holes for a in range(address, address + count)):
+                blocks.append(ReadBlock(register_type, slave_id, address, count, [(register_name, 0, count)]))
+                block = None
+                continue
+
+            if block is not None:
+                new_end = max(block.end, address + count)
+                gap = range(block.end, address)
+                mergeable = (len(gap) <= gap_tolerance
+                             and new_end - block.address <= max_count
+                             and not any(a in type_holes for a in gap))
+
+                if mergeable:
+                    block.members.append((register_name, address - block.address, count))
+                    block.count = new_end - block.address
+                    continue
+
+            block = ReadBlock(register_type, slave_id, address, count, [(register_name, 0, count)])
+            blocks.append(block)
+
+    logger.info(f"Planned {len(blocks)} block reads for {len(registers)} registers of slave {slave_id}")
+    return blocks
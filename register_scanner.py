@@ -0,0 +1,254 @@
+import argparse
+import logging
+import math
+from dataclasses import dataclass, field
+from time import perf_counter
+from pymodbus.exceptions import ModbusException
+from pymodbus.pdu import ExceptionResponse
+from client import Client
+from enums import DataType, Endian, RegisterTypes
+from loader import ModbusRTUOptions, ModbusTCPOptions
+from read_planner import MODBUS_MAX_READ_COUNT
+logger = logging.getLogger(__name__)
+
+"""
+    Register map scanner:
+    Sweeps the holding and input register space of a slave with the largest block reads the
+    protocol allows, so densely mapped space costs one request per 125 registers. A block answered
+    with Illegal Data Address (or Illegal Data Value) is probed one register every `stride`
+    addresses. From a readable register the edges of its island are found by bisection with block
+    reads, about log2(block size) requests per edge. Empty space thus costs 1 + 125/stride requests
+    per block: a full 1-65536 sweep of one register type with stride 8 is about 9000 requests,
+    minutes even over slow RTU. Islands shorter than stride can fall between the probes, use
+    stride 1 for an exhaustive scan.
+
+    The islands are reported as a draft register map in the format of Server.registers, with a
+    DataType guessed from the values read. Check the guesses against the device documentation:
+    a register that reads 0 looks the same for every type.
+"""
+
+BISECT_EXCEPTION_CODES = (2, 3)             # Illegal Data Address, Illegal Data Value
+
+
+@dataclass
+class Island:
+    register_type: RegisterTypes
+    address: int                            # 1-indexed, as in the register maps
+    values: list[int] = field(default_factory=list)
+
+    @property
+    def end(self) -> int:
+        return self.address + len(self.values)
+
+
+@dataclass
+class ScanResult:
+    islands: list[Island] = field(default_factory=list)
+    unreadable: list[tuple[RegisterTypes, int, int]] = field(default_factory=list)  # (register type, address, count) without response
+    requests: int = 0
+    elapsed: float = 0.0
+
+
+class RegisterScanner:
+    """ Finds the readable registers of a slave with Client._read.
+
+        Parameters:
+        -----------
+            - client: Client: connected client of the bus the slave is on
+            - slave_id: int: modbus address of the slave
+            - block_size: int: registers per request of the sweep, at most 125
+            - stride: int: distance of the single register probes in blocks that contain invalid addresses
+            - retries: int: repeats of a request that got no response before it is given up
+    """
+    def __init__(self, client: Client, slave_id: int, block_size: int = MODBUS_MAX_READ_COUNT, stride: int = 8,
+                 retries: int = 1):
+        self.client = client
+        self.slave_id = slave_id
+        self.block_size = min(block_size, MODBUS_MAX_READ_COUNT)
+        self.stride = max(1, stride)
+        self.retries = retries
+        self.result = ScanResult()
+
+    def scan(self, start: int = 1, end: int = 65536,
+             register_types=(RegisterTypes.HOLDING_REGISTER, RegisterTypes.INPUT_REGISTER)) -> ScanResult:
+        """ Sweep the 1-indexed addresses start..end (inclusive) of every register type """
+        self.result = ScanResult()
+        t0 = perf_counter()
+        for register_type in register_types:
+            self._sweep(register_type, start, end)
+            logger.info(f"Scanned {register_type.name} {start}-{end} of slave {self.slave_id}: "
+                        f"{sum(len(i.values) for i in self.result.islands if i.register_type is register_type)} readable registers, "
+                        f"{self.result.requests} requests so far")
+        self.result.elapsed = perf_counter() - t0
+        return self.result
+
+    def _probe(self, register_type: RegisterTypes, address: int, count: int) -> list[int] | int | None:
+        """ Registers of a block read, the exception code of an error response or None without response """
+        for _ in range(self.retries + 1):
+            self.result.requests += 1
+            try:
+                result = self.client._read(address, count, self.slave_id, register_type)
+            except ModbusException as e:
+                logger.debug(f"No response for {register_type.name} {address}+{count}: {e}")
+                continue
+            if isinstance(result, ExceptionResponse): return result.exception_code
+            if not result.isError(): return list(result.registers)
+        return None
+
+    def _readable(self, register_type: RegisterTypes, address: int, count: int) -> list[int] | None:
+        response = self._probe(register_type, address, count)
+        return response if isinstance(response, list) else None
+
+    def _sweep(self, register_type: RegisterTypes, start: int, end: int):
+        address = start
+        while address <= end:
+            count = min(self.block_size, end + 1 - address)
+            response = self._probe(register_type, address, count)
+            if isinstance(response, list):
+                self._add(register_type, address, response)
+                address += count
+                continue
+            if response == 1:
+                logger.info(f"Slave {self.slave_id} does not support {register_type.name} reads (Illegal Function)")
+                return
+            if response not in BISECT_EXCEPTION_CODES:
+                self.result.unreadable.append((register_type, address, count))
+                address += count
+                continue
+
+            # the last address is probed too, an island starting there may continue into the next block
+            probes = [*range(address, address + count - 1, self.stride), address + count - 1]
+            hit = next((a for a in probes if self._readable(register_type, a, 1)), None)
+            if hit is None:
+                address += count
+                continue
+            # the probe one stride before hit failed, so the island starts within the last stride
+            first = self._left_edge(register_type, max(address, hit - self.stride + 1), hit)
+            values = self._longest_read(register_type, first, min(self.block_size, end + 1 - first))
+            if values: self._add(register_type, first, values)
+            address = max(first + len(values), hit + 1)
+
+    def _left_edge(self, register_type: RegisterTypes, low: int, hit: int) -> int:
+        """ Lowest address in low..hit from which the registers up to hit are readable """
+        while low < hit:
+            mid = (low + hit) // 2
+            if self._readable(register_type, mid, hit - mid + 1): hit = mid
+            else: low = mid + 1
+        return hit
+
+    def _longest_read(self, register_type: RegisterTypes, address: int, max_count: int) -> list[int]:
+        """ Registers of the longest readable block starting at a readable address, by galloping then bisection """
+        best = self._readable(register_type, address, 1) or []
+        good, bad = len(best), max_count + 1
+        count = good
+        while good and count < max_count:
+            count = min(count * 2, max_count)
+            values = self._readable(register_type, address, count)
+            if values is None:
+                bad = count
+                break
+            best, good = values, count
+        while bad - good > 1:
+            mid = (good + bad) // 2
+            values = self._readable(register_type, address, mid)
+            if values is None: bad = mid
+            else: best, good = values, mid
+        return best
+
+    def _add(self, register_type: RegisterTypes, address: int, values: list[int]):
+        """ Record readable registers, merging them with the island they continue """
+        islands = self.result.islands
+        if islands and islands[-1].register_type is register_type and islands[-1].end == address:
+            islands[-1].values.extend(values)
+        else:
+            islands.append(Island(register_type, address, values))
+
+
+def _printable(value: int) -> bool:
+    return all(b == 0 or 0x20 <= b < 0x7f for b in (value >> 8, value & 0xff)) and value != 0
+
+
+def guess_dtype(values: list[int], word_order: Endian = Endian.BIG) -> tuple[DataType, int]:
+    """ Guess the data type of the value starting at values[0], returns (dtype, register count) """
+    n = 0
+    while n < len(values) and _printable(values[n]): n += 1
+    if n >= 2 and any(chr(b).isalpha() for v in values[:n] for b in (v >> 8, v & 0xff)):
+        return DataType.UTF8, n
+
+    if len(values) >= 2:
+        high, low = (values[0], values[1]) if word_order is Endian.BIG else (values[1], values[0])
+        # a small high word followed by a large low word: a 32-bit counter rather than two small integers
+        if high < 0x100 and low >= 0x1000: return DataType.U32, 2
+        if high == 0xffff and low & 0x8000: return DataType.I32, 2
+        as_float = DataType.F32.decode_registers(values[:2], word_order)
+        # magnitude 1e-3..1e7: the high word would be a large integer otherwise
+        if 0x3a80 <= high & 0x7fff < 0x4b20 and math.isfinite(as_float): return DataType.F32, 2
+
+    return (DataType.I16 if values[0] >= 0xff00 else DataType.U16), 1
+
+
+def draft_register_map(islands: list[Island], word_order: Endian = Endian.BIG) -> dict:
+    """ Register definitions in the format of Server.registers, one per guessed value """
+    registers = {}
+    for island in islands:
+        i = 0
+        while i < len(island.values):
+            dtype, count = guess_dtype(island.values[i:], word_order)
+            address = island.address + i
+            registers[f"{island.register_type.name.split('_')[0].capitalize()} {address}"] = {
+                "addr": address, "count": count, "dtype": dtype, "multiplier": 1, "unit": "", "device_class": None,
+                "register_type": island.register_type,
+                "sample": dtype.decode_registers(island.values[i:i+count], word_order),
+            }
+            i += count
+    return registers
+
+
+def format_register_map(registers: dict) -> str:
+    """ Python source of a draft register map, to paste into a Server implementation. Samples become comments. """
+    lines = ["registers = {"]
+    for name, info in registers.items():
+        fields = ", ".join(f'"{k}": {v}' if isinstance(v, (DataType, RegisterTypes)) else
+                           f'"{k}": "{v}"' if isinstance(v, str) else f'"{k}": {v!r}'
+                           for k, v in info.items() if k != "sample")
+        lines.append(f'    "{name}": {{{fields}}},    # {info.get("sample")!r}')
+    lines.append("}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scan the register space of a Modbus slave and print a draft register map")
+    parser.add_argument("--host", help="Modbus TCP host")
+    parser.add_argument("--port", default="502", help="TCP port or serial device, e.g. /dev/ttyUSB0")
+    parser.add_argument("--baudrate", type=int, default=9600, help="RTU baudrate (with a serial --port)")
+    parser.add_argument("--parity", action="store_true", help="RTU even parity")
+    parser.add_argument("--slave", type=int, default=1)
+    parser.add_argument("--start", type=int, default=1, help="first 1-indexed address")
+    parser.add_argument("--end", type=int, default=65536, help="last 1-indexed address")
+    parser.add_argument("--types", default="holding,input", help="register types to scan")
+    parser.add_argument("--block-size", type=int, default=MODBUS_MAX_READ_COUNT)
+    parser.add_argument("--stride", type=int, default=8, help="probe distance in partly invalid blocks, 1 for an exhaustive scan")
+    parser.add_argument("--word-order", choices=["big", "little"], default="big")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("pymodbus").setLevel(logging.CRITICAL)        # every probe of an invalid block logs an exception response
+
+    if args.host:
+        cl_options = ModbusTCPOptions("scanner", "scanner", "TCP", host=args.host, port=int(args.port))
+    else:
+        cl_options = ModbusRTUOptions("scanner", "scanner", "RTU", port=args.port, baudrate=args.baudrate, bytesize=8,
+                                      parity=args.parity, stopbits=1)
+    client = Client(cl_options)
+    client.connect()
+    try:
+        register_types = [RegisterTypes[f"{t.strip().upper()}_REGISTER"] for t in args.types.split(",")]
+        result = RegisterScanner(client, args.slave, args.block_size, args.stride).scan(args.start, args.end, register_types)
+    finally:
+        client.close()
+
+    print(f"{result.requests} requests in {result.elapsed:.1f}s")
+    for island in result.islands:
+        print(f"{island.register_type.name:<18}{island.address:>6}-{island.end - 1:<6}{len(island.values):>5} registers")
+    for register_type, address, count in result.unreadable:
+        print(f"{register_type.name:<18}{address:>6}-{address + count - 1:<6} no response")
+    print(format_register_map(draft_register_map(result.islands, Endian[args.word_order.upper()])))
@@ -0,0 +1,48 @@
+import logging
+from enums import DataType, RegisterTypes
+logger = logging.getLogger(__name__)
+
+"""
+    Compiled register table:
+    Server.registers (register name -> register_info dict) is compiled into parallel tuples once
+    the registers for the model are set up. The read path indexes the tuples by position instead
+    of doing several string-keyed dict lookups per register. Positions are ordered by
+    register_type and address, i.e. in the order of the planned block reads.
+    MQTT topics are not part of the table: they depend on the MQTT options and on derived
+    registers such as aggregation windows, so they are precomputed per server in
+    modbus_mqtt.TopicTable instead.
+"""
+
+
+class RegisterTable:
+    """ Column-wise, read-only copy of a register map.
+
+        Parameters:
+        -----------
+            - registers: dict: register_name -> register_info as in Server.registers
+    """
+    __slots__ = ("names", "index", "addresses", "counts", "dtypes", "register_types", "multipliers", "_scaled")
+
+    def __init__(self, registers: dict):
+        ordered = sorted(registers.items(), key=lambda item: (item[1]["register_type"].value, item[1]["addr"]))
+
+        self.names: tuple[str, ...] = tuple(name for name, _ in ordered)
+        self.index: dict[str, int] = {name: i for i, name in enumerate(self.names)}
+        self.addresses = tuple(info["addr"] for _, info in ordered)
+        self.counts = tuple(info["count"] for _, info in ordered)
+        self.dtypes: tuple[DataType, ...] = tuple(info["dtype"] for _, info in ordered)
+        self.register_types: tuple[RegisterTypes, ...] = tuple(info["register_type"] for _, info in ordered)
+        self.multipliers: tuple[float, ...] = tuple(info["multiplier"] for _, info in ordered)   # ints stay ints
+        self._scaled = bytes(info["multiplier"] != 1 for _, info in ordered)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, register_name):
+        return register_name in self.index
+
+    def scale(self, position: int, val):
+        """ Apply the multiplier of the register at position and round numbers to 2 decimals """
+        if self._scaled[position]: val *= self.multipliers[position]
+        if isinstance(val, (int, float)): val = round(val, 2)
+        return val
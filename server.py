@@ -1,37 +1,93 @@
 import abc
+import functools
+import struct
 import logging
-from enums import DataType
+from enums import DataType, Endian
+from codec import BlockLayout
+from register_table import RegisterTable
+from circuit_breaker import CircuitBreaker
 from dataclasses import dataclass
 # from loader import ServerOptions
 
 logger = logging.getLogger(__name__)
 
+_U16, _I16, _BIG = DataType.U16, DataType.I16, Endian.BIG          # module globals, faster than enum attribute lookups
+
 
 class Server(metaclass=abc.ABCMeta):
+    byte_order: Endian = Endian.BIG                                 # byte order within a register
+    word_order: Endian = Endian.BIG                                 # register order of multi-register values
+
     def __init__(self, sr_options, clients):
         self.name = sr_options.name
         self.nickname = sr_options.ha_display_name
         self.serialnum = sr_options.serialnum
         self.device_addr:int| None = sr_options.modbus_id           # modbus slave_id
+        self.poll_intervals: dict[str, float] = sr_options.poll_intervals   # register name or device_class -> seconds
+        self.aggregate_windows: dict[str, float] = sr_options.aggregate_windows   # register name or device_class -> seconds
+        self.aggregate_energy: bool = sr_options.aggregate_energy
 
         try:
             idx = [str(client) for client in clients].index(sr_options.connected_client)  # TODO ugly
         except:
             raise ValueError(f"Client {sr_options.connected_client} from server {self.nickname} config not defined in client list")
         self.connected_client = clients[idx]
+        self.breaker = CircuitBreaker(f"server {self.nickname}", self.connected_client.breaker.base_delay,
+                                      self.connected_client.breaker.max_delay,
+                                      failure_threshold=self.connected_client.breaker.failure_threshold)
 
         
         self.model:str | None = None                                # model name
+        self.modelcode = None                                       # device type code the model was read from
         self.model_info: dict | None = None                         # additional model-specific info e.g. 'mppt': 3
+        self._table: RegisterTable | None = None                    # compiled self.registers
 
         logger.info(f"Server {self.nickname} set up.")
 
+    def __init_subclass__(cls, **kwargs):
+        """ Drop the compiled table at the end of each setup_valid_registers_for_model, which changes self.registers """
+        super().__init_subclass__(**kwargs)
+        setup = cls.__dict__.get("setup_valid_registers_for_model")
+        if setup is None or getattr(setup, "__isabstractmethod__", False): return
+
+        @functools.wraps(setup)
+        def setup_valid_registers_for_model(self, *args, **kwargs):
+            try:
+                return setup(self, *args, **kwargs)
+            finally:
+                self.invalidate_registers()
+        cls.setup_valid_registers_for_model = setup_valid_registers_for_model
+
     def __str__(self):
         return f"{self.nickname}"
     
+    @property
+    def table(self) -> RegisterTable:
+        """ self.registers compiled for the read path, see compile_registers """
+        if self._table is None: self.compile_registers()
+        return self._table
+
+    def compile_registers(self):
+        """ Compile self.registers into a RegisterTable. Call again, or invalidate_registers, whenever
+            self.registers changes. Done automatically after setup_valid_registers_for_model.
+        """
+        self._table = RegisterTable(self.registers)
+        self.connected_client.forget_plans(self)
+        logger.info(f"Compiled {len(self._table)} registers of server {self.nickname}")
+
+    def invalidate_registers(self):
+        """ Drop the RegisterTable and read plans after self.registers changed, recompiled on next use """
+        self._table = None
+        self.connected_client.forget_plans(self)
+
     def read_model(self, device_type_code_param_key="Device type code"):
         logger.info(f"Reading model for server")
-        modelcode = self.connected_client.read_registers(self, device_type_code_param_key, self.registers[device_type_code_param_key])
+        modelcode = self.connected_client.read_registers(self, device_type_code_param_key)
+        self.set_model(modelcode)
+
+    def set_model(self, modelcode):
+        """ Set model and model_info from a device type code as read from the server """
+        self.modelcode = modelcode
         self.model = self.device_info[modelcode]['model']
         self.model_info = self.device_info[modelcode]
         logger.info(f"Model read as {self.model}")
@@ -44,23 +100,21 @@ class Server(metaclass=abc.ABCMeta):
 
         available = True
 
-        address = self.registers[register_name]["addr"]
-        count = self.registers[register_name]["count"]
-        slave_id = self.device_addr
-        register_type = self.registers[register_name]['register_type']
-        response = self.connected_client._read(address, count, slave_id, register_type)
+        table = self.table
+        i = table.index[register_name]
+        response = self.connected_client._read(table.addresses[i], table.counts[i], self.device_addr, table.register_types[i])
 
         if response.isError(): 
-            self.sonnected_client._handle_error_response(response)
+            self.connected_client._handle_error_response(response)
             available = False
 
         return available
     
     @classmethod
-    @abc.abstractmethod
     def _decoded(cls, registers: list, dtype: DataType):
         """
-        Server-specific decoding must be implemented.
+        Decode a single value. Defaults to DataType.decode with the byte and word order of the server,
+        override for server-specific decoding.
 
         Parameters:
         -----------
@@ -68,7 +122,22 @@ class Server(metaclass=abc.ABCMeta):
         dtype: (DataType.U16, DataType.I16, DataType.U32, DataType.I32 
 
         """
-        pass
+        if dtype is _U16 or dtype is _I16:                          # one register, skip the bytes round trip
+            value = registers[0]
+            if cls.byte_order is not _BIG: value = (value & 0xFF) << 8 | value >> 8
+            return value - 0x10000 if dtype is _I16 and value & 0x8000 else value
+        data = struct.pack(f"{cls.byte_order.value}{len(registers)}H", *registers)
+        return dtype.decode(data, word_order=cls.word_order)
+
+    def compile_layout(self, block) -> BlockLayout | None:
+        """ Compile the batch decoder for a planned block read (read_planner.ReadBlock).
+            Returns None if the server implements its own _decoded, which is then used per register.
+        """
+        if type(self)._decoded.__func__ is not Server._decoded.__func__: return None
+
+        table = self.table
+        fields = [(name, offset, count, table.dtypes[table.index[name]]) for name, offset, count in block.members]
+        return BlockLayout(fields, block.count, self.byte_order, self.word_order)
 
     @classmethod
     @abc.abstractmethod
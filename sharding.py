@@ -0,0 +1,354 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import hot_log
+from dataclasses import dataclass, field
+from typing import Callable
+from circuit_breaker import CircuitBreaker
+from enums import BreakerState
+from loader import ModbusTCPOptions, ModbusRTUOptions, ServerOptions
+from modbus_mqtt import MqttClient
+from write_worker import WriteWorker
+logger = logging.getLogger(__name__)
+
+"""
+    Multi-process sharding:
+    The supervisor (this process) owns the MQTT connection. Clients and their servers are split
+    into shards, each polled by the async engine in a worker process that owns its Modbus
+    connections. Workers stream decoded readings back over a pipe; the supervisor publishes them
+    and forwards MQTT writes to the worker that owns the server. Crashed workers are restarted
+    with exponential backoff.
+
+    Clients sharing a gateway (TCP host:port) or a serial port always end up in the same shard.
+
+    There is deliberately no Options field for the number of workers. benchmark.py shards has only
+    been run on a single-core machine, where 1, 2 and 4 workers published the same ~90k readings/s.
+    That shows the supervisor keeps up, not that throughput grows with workers. Expose it once the
+    benchmark shows scaling on multi-core hardware.
+
+    Pipe messages are tuples, worker -> supervisor:
+        ("ready", server index, manufacturer, model, registers, write_parameters, register names)
+        ("available", server index, available)
+        ("values", server index, register positions, values)    positions index the register names
+        ("written", request id, read-back values or None, error message or None)
+        ("metrics", per-client metrics snapshot)
+    supervisor -> worker:
+        ("write", request id, server index, values)
+"""
+
+WORKER_POLL_INTERVAL = 1                                            # seconds between liveness checks of workers
+
+
+def build_server(sr_options: ServerOptions, clients: list):
+    """ Default server factory: the implementation registered in implemented_servers.ServerTypes """
+    from implemented_servers import ServerTypes
+    return ServerTypes[sr_options.server_type].value(sr_options, clients)
+
+
+def _endpoint(cl_options: ModbusTCPOptions | ModbusRTUOptions):
+    if isinstance(cl_options, ModbusTCPOptions): return (cl_options.host, cl_options.port)
+    return cl_options.port
+
+
+def shard_clients(client_options: list, server_options: list, n_shards: int) -> list[tuple[list, list]]:
+    """ Split clients and their servers into n_shards shards of about equal server count.
+
+        Returns a list of (client options, server options) per shard, empty shards are dropped.
+    """
+    groups: dict = {}                                               # endpoint -> (client options, server options)
+    for cl_options in client_options:
+        clients, servers = groups.setdefault(_endpoint(cl_options), ([], []))
+        clients.append(cl_options)
+        servers += [sr for sr in server_options if sr.connected_client == cl_options.ha_display_name]
+
+    shards: list[tuple[list, list]] = [([], []) for _ in range(n_shards)]
+    for clients, servers in sorted(groups.values(), key=lambda g: len(g[1]), reverse=True):
+        clients_, servers_ = min(shards, key=lambda s: len(s[1]))   # least loaded shard first
+        clients_ += clients
+        servers_ += servers
+    return [shard for shard in shards if shard[0]]
+
+
+@dataclass
+class WorkerSettings:
+    """ Everything a worker process needs besides its shard. Must be picklable. """
+    poll_interval: float = 5
+    metrics_interval: float = 60
+    model_cache_path: str = ""                                      # suffixed with the shard index per worker
+    server_factory: Callable = build_server                         # (ServerOptions, clients) -> Server, top-level function
+    log_level: int = logging.INFO
+    log_rate_limits: dict[str, float] = field(default_factory=dict) # see hot_log.configure
+    log_sampling: dict[str, int] = field(default_factory=dict)
+
+
+def _shard_path(path: str, shard_index: int) -> str:
+    if not path: return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard_index}{ext}"
+
+
+def worker_main(shard_index: int, client_options: list, server_options: list, conn, settings: WorkerSettings):
+    """ Entry point of a worker process """
+    logging.basicConfig(level=settings.log_level, format=f"[shard {shard_index}] %(levelname)s %(name)s: %(message)s")
+    hot_log.configure(settings.log_rate_limits, settings.log_sampling)
+    try:
+        asyncio.run(_run_worker(shard_index, client_options, server_options, conn, settings))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _run_worker(shard_index: int, client_options: list, server_options: list, conn, settings: WorkerSettings):
+    from async_client import AsyncClient
+    from async_engine import connect_client
+    from bus_scheduler import BusScheduler
+    from metrics import METRICS
+    from model_cache import ModelCache
+
+    loop = asyncio.get_running_loop()
+    clients = [AsyncClient(cl_options) for cl_options in client_options]
+    servers = [settings.server_factory(sr_options, clients) for sr_options in server_options]
+    index = {server: i for i, server in enumerate(servers)}
+
+    def on_ready(server):
+        conn.send(("ready", index[server], server.manufacturer, server.model, server.registers,
+                   server.write_parameters, server.table.names))
+
+    def on_availability(available, server):
+        conn.send(("available", index[server], available))
+
+    model_cache = ModelCache(_shard_path(settings.model_cache_path, shard_index))
+    schedulers = {client: BusScheduler(client, [s for s in servers if s.connected_client is client], settings.poll_interval,
+                                       on_ready=on_ready, on_availability=on_availability, model_cache=model_cache)
+                  for client in clients}
+
+    def on_write_done(request_id, future):
+        if future.cancelled(): conn.send(("written", request_id, None, "cancelled"))
+        elif future.exception() is not None: conn.send(("written", request_id, None, str(future.exception())))
+        else: conn.send(("written", request_id, future.result(), None))
+
+    def on_message():
+        try:
+            while conn.poll():
+                _, request_id, server_index, values = conn.recv()
+                server = servers[server_index]
+                future = schedulers[server.connected_client].submit_writes(server, values)
+                future.add_done_callback(lambda f, request_id=request_id: on_write_done(request_id, f))
+        except EOFError:
+            logger.error("Supervisor closed the pipe, stopping")
+            for task in tasks: task.cancel()
+    loop.add_reader(conn.fileno(), on_message)
+
+    async def send_values(publish_q):
+        while True:
+            server, values = await publish_q.get()
+            position = server.table.index
+            conn.send(("values", index[server], tuple(position[name] for name in values), tuple(values.values())))
+
+    async def send_metrics():
+        while True:
+            await asyncio.sleep(settings.metrics_interval)
+            conn.send(("metrics", METRICS.snapshot()["clients"]))
+
+    async def client_task(scheduler, publish_q):
+        await connect_client(scheduler.client)
+        await scheduler.run(publish_q)
+
+    publish_q: asyncio.Queue = asyncio.Queue()
+    tasks = [asyncio.create_task(client_task(s, publish_q), name=f"poll {c}") for c, s in schedulers.items()]
+    tasks.append(asyncio.create_task(send_values(publish_q), name="send values"))
+    if settings.metrics_interval > 0: tasks.append(asyncio.create_task(send_metrics(), name="send metrics"))
+
+    try:
+        await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        loop.remove_reader(conn.fileno())
+        for client in clients: client.close()
+
+
+@dataclass(eq=False)
+class RemoteServer:
+    """ Supervisor-side stand-in of a Server polled by a worker, with the attributes MqttClient
+        and WriteWorker use. Filled in by the worker's "ready" message.
+    """
+    index: int                                                      # position in the worker's server list
+    name: str
+    nickname: str
+    serialnum: str
+    connected_client: "WorkerHandle" = field(repr=False)
+    manufacturer: str | None = None
+    model: str | None = None
+    registers: dict = field(default_factory=dict, repr=False)
+    write_parameters: dict = field(default_factory=dict, repr=False)
+    names: tuple = field(default=(), repr=False)                    # register names by position, as in the worker
+    aggregate_windows: dict = field(default_factory=dict, repr=False)
+    aggregate_energy: bool = False
+
+    def __str__(self):
+        return f"{self.nickname}"
+
+
+class WorkerHandle:
+    """ A worker process and its pipe. Stands in for the BusScheduler of its servers in WriteWorker. """
+    def __init__(self, shard_index: int, client_options: list, server_options: list, settings: WorkerSettings):
+        self.shard_index = shard_index
+        self.client_options = client_options
+        self.settings = settings
+        self.nickname = f"shard{shard_index}"
+        self.servers = [RemoteServer(i, sr.name, sr.ha_display_name, sr.serialnum, self,
+                                     aggregate_windows=sr.aggregate_windows, aggregate_energy=sr.aggregate_energy)
+                        for i, sr in enumerate(server_options)]
+        self._server_options = server_options
+        self.breaker = CircuitBreaker(f"worker {shard_index}", base_delay=1, max_delay=60, failure_threshold=1)
+        self.metrics: dict = {}                                     # last per-client metrics snapshot of the worker
+
+        self.process: multiprocessing.Process | None = None
+        self.conn = None
+        self.started = 0.0                                          # loop time of the last start
+        self._writes: dict[int, asyncio.Future] = {}                # request id -> future of the read-back values
+        self._next_request = 0
+
+    def start(self, context, on_message: Callable):
+        parent_conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_main, name=f"modbus shard {self.shard_index}", daemon=True,
+                                       args=(self.shard_index, self.client_options, self._server_options, child_conn, self.settings))
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.conn.fileno(), on_message, self)
+        self.started = loop.time()
+        logger.info(f"Started worker {self.shard_index} (pid {self.process.pid}) for clients "
+                    f"{[c.ha_display_name for c in self.client_options]}")
+
+    def stop(self):
+        if self.conn is not None:
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+            self.conn.close()
+            self.conn = None
+        if self.process is not None and self.process.is_alive():
+            self.process.terminate()
+            self.process.join(5)
+        for future in self._writes.values():
+            if not future.done(): future.set_exception(ConnectionError(f"Worker {self.shard_index} stopped"))
+        self._writes.clear()
+
+    def submit_writes(self, server: RemoteServer, values: dict[str, float]) -> asyncio.Future:
+        """ Forward writes to the worker, see BusScheduler.submit_writes """
+        future = asyncio.get_running_loop().create_future()
+        if self.conn is None:
+            future.set_exception(ConnectionError(f"Worker {self.shard_index} not running"))
+            return future
+        self._next_request += 1
+        self._writes[self._next_request] = future
+        self.conn.send(("write", self._next_request, server.index, values))
+        return future
+
+    def resolve_write(self, request_id: int, result: dict | None, error: str | None):
+        future = self._writes.pop(request_id, None)
+        if future is None or future.done(): return
+        if error is not None: future.set_exception(Exception(error))
+        else: future.set_result(result)
+
+
+class ShardSupervisor:
+    """ Runs the shards in worker processes and publishes their readings through mqtt_client.
+
+        Parameters:
+        -----------
+            - n_workers: int: number of worker processes, at most one per client endpoint is used
+            - write_debounce: float: seconds MQTT /set messages are collected, see WriteWorker
+    """
+    def __init__(self, mqtt_client: MqttClient, client_options: list, server_options: list, n_workers: int,
+                 settings: WorkerSettings, write_debounce: float = 0.5):
+        self.mqtt_client = mqtt_client
+        self.settings = settings
+        self.write_debounce = write_debounce
+        self.workers = [WorkerHandle(i, clients, servers, settings)
+                        for i, (clients, servers) in enumerate(shard_clients(client_options, server_options, n_workers))]
+        self.servers = [server for worker in self.workers for server in worker.servers]
+        self._context = multiprocessing.get_context("spawn")       # never fork the paho network thread
+        self._stopping = False
+
+    def _on_message(self, worker: WorkerHandle):
+        try:
+            while worker.conn is not None and worker.conn.poll():
+                self._handle(worker, worker.conn.recv())
+        except (EOFError, OSError):
+            logger.error(f"Lost pipe to worker {worker.shard_index}")
+            if worker.conn is None: return
+            asyncio.get_running_loop().remove_reader(worker.conn.fileno())
+            worker.conn.close()
+            worker.conn = None
+
+    def _handle(self, worker: WorkerHandle, message: tuple):
+        kind = message[0]
+        if kind == "values":
+            _, server_index, positions, values = message
+            server = worker.servers[server_index]
+            names = server.names
+            self.mqtt_client.publish_values(server, {names[p]: v for p, v in zip(positions, values)})
+        elif kind == "ready":
+            _, server_index, manufacturer, model, registers, write_parameters, names = message
+            server = worker.servers[server_index]
+            server.manufacturer, server.model, server.names = manufacturer, model, names
+            server.registers, server.write_parameters = registers, write_parameters
+            self.mqtt_client.publish_discovery_topics(server)
+        elif kind == "available":
+            _, server_index, available = message
+            self.mqtt_client.publish_availability(available, worker.servers[server_index])
+        elif kind == "written":
+            worker.resolve_write(*message[1:])
+        elif kind == "metrics":
+            worker.metrics = message[1]
+
+    async def _watch(self):
+        """ Restart workers that exited, with exponential backoff per worker """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(WORKER_POLL_INTERVAL)
+            for worker in self.workers:
+                if worker.process.is_alive():
+                    if worker.breaker.state is not BreakerState.CLOSED and loop.time() - worker.started > worker.breaker.max_delay:
+                        worker.breaker.record_success()             # ran long enough, reset the backoff
+                    continue
+
+                if worker.conn is not None: self._on_message(worker)    # drain what it sent before exiting
+                if not worker.breaker.allow(): continue
+                logger.error(f"Worker {worker.shard_index} exited with code {worker.process.exitcode}, restarting")
+                for server in worker.servers:
+                    if server.model is not None: self.mqtt_client.publish_availability(False, server)
+                worker.breaker.record_failure()
+                worker.stop()
+                worker.start(self._context, self._on_message)
+
+    async def _publish_metrics(self):
+        while True:
+            await asyncio.sleep(self.settings.metrics_interval)
+            clients = {}
+            for worker in self.workers: clients.update(worker.metrics)
+            self.mqtt_client.publish_metrics(clients)
+
+    async def run(self):
+        """ Start all workers and supervise them until cancelled """
+        self.mqtt_client.event_loop = asyncio.get_running_loop()
+        self.mqtt_client.remove_stale_discovery_topics(self.servers)
+        WriteWorker(self.mqtt_client, {worker: worker for worker in self.workers}, self.write_debounce).attach(self.servers)
+
+        for worker in self.workers: worker.start(self._context, self._on_message)
+
+        from async_engine import drain_worker, window_worker
+        tasks = [asyncio.create_task(self._watch(), name="watch workers"),
+                 asyncio.create_task(window_worker(self.mqtt_client), name="aggregation windows")]
+        if self.mqtt_client.buffer is not None:
+            tasks.append(asyncio.create_task(drain_worker(self.mqtt_client), name="mqtt drain"))
+        if self.settings.metrics_interval > 0:
+            tasks.append(asyncio.create_task(self._publish_metrics(), name="metrics"))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks: task.cancel()
+            for worker in self.workers: worker.stop()
+            self.mqtt_client.event_loop = None
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import os
+import select
+import socket
+import threading
+import tty
+from pymodbus.datastore import ModbusSequentialDataBlock, ModbusServerContext, ModbusSlaveContext
+from pymodbus.server import ModbusSerialServer, ModbusTcpServer
+from enums import DataType, RegisterTypes
+from server import Server
+logger = logging.getLogger(__name__)
+
+"""
+    Local Modbus simulator for benchmarks and offline testing:
+    A pymodbus TCP or RTU server with any number of slaves, each filled with a synthetic register
+    map, and an optional fixed response latency. For RTU the server and the client are connected
+    through a pair of pseudo terminals bridged in a background thread (a virtual null modem).
+"""
+
+SIM_DTYPES = (DataType.U16, DataType.I16, DataType.U32, DataType.I32, DataType.F32, DataType.U64)
+DEVICE_TYPE_CODE = 1
+
+
+def synthetic_register_map(n_registers: int, gap_every: int = 10) -> dict:
+    """ Register definitions in the format of Server.registers: mixed dtypes, holding registers,
+        a small gap after every gap_every registers. Address 1 holds the "Device type code".
+    """
+    registers = {"Device type code": {"addr": 1, "count": 1, "dtype": DataType.U16, "multiplier": 1,
+                                      "unit": "", "device_class": None, "register_type": RegisterTypes.HOLDING_REGISTER}}
+    address = 2
+    for i in range(n_registers - 1):
+        dtype = SIM_DTYPES[i % len(SIM_DTYPES)]
+        count = dtype.size // 2
+        registers[f"Sim register {i}"] = {"addr": address, "count": count, "dtype": dtype,
+                                          "multiplier": 0.1 if dtype is DataType.I16 else 1, "unit": "W",
+                                          "device_class": "power", "state_class": "measurement",
+                                          "register_type": RegisterTypes.HOLDING_REGISTER}
+        address += count + (2 if i % gap_every == gap_every - 1 else 0)
+    return registers
+
+
+def register_values(registers: dict) -> list[int]:
+    """ Raw 16-bit values (index = 1-indexed address) so every register decodes to a plausible value """
+    size = max(info["addr"] + info["count"] for info in registers.values())
+    values = [0] * (size + 1)
+    for i, info in enumerate(registers.values()):
+        value = DEVICE_TYPE_CODE if info["addr"] == 1 else (i * 7) % 1000
+        if info["dtype"] is DataType.F32: value += 0.5
+        values[info["addr"]:info["addr"] + info["count"]] = info["dtype"].encode_registers(value)
+    return values
+
+
+class SimServer(Server):
+    """ Server implementation for the synthetic register map of the simulator """
+    manufacturer = "Simulator"
+    supported_models = ("Sim",)
+    device_info = {DEVICE_TYPE_CODE: {"model": "Sim"}}
+
+    def __init__(self, sr_options, clients, n_registers: int = 100):
+        super().__init__(sr_options, clients)
+        self.registers = synthetic_register_map(n_registers)
+        self.write_parameters = {}
+
+    @classmethod
+    def _encoded(cls, content):
+        return DataType.U16.encode_registers(int(content))
+
+    def _validate_write_val(self, register_name, value):
+        pass
+
+    def setup_valid_registers_for_model(self):
+        pass
+
+
+def sim_server_factory(sr_options, clients) -> SimServer:
+    """ Server factory for sharding.WorkerSettings """
+    return SimServer(sr_options, clients)
+
+
+class _SlowSlaveContext(ModbusSlaveContext):
+    def __init__(self, latency: float, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+
+    async def async_getValues(self, fc_as_hex, address, count=1):
+        if self.latency: await asyncio.sleep(self.latency)
+        return self.getValues(fc_as_hex, address, count)
+
+
+class VirtualSerialPair:
+    """ Two pseudo terminals whose traffic is forwarded to each other, like a null modem cable """
+    def __init__(self):
+        self._masters = []
+        self.ports = []
+        for _ in range(2):
+            master, slave = os.openpty()
+            tty.setraw(slave)
+            self._masters.append(master)
+            self.ports.append(os.ttyname(slave))
+        self._running = True
+        self._thread = threading.Thread(target=self._forward, daemon=True, name="virtual serial pair")
+        self._thread.start()
+
+    def _forward(self):
+        a, b = self._masters
+        while self._running:
+            readable, _, _ = select.select([a, b], [], [], 0.1)
+            for fd in readable:
+                try:
+                    data = os.read(fd, 4096)
+                except OSError:
+                    continue
+                os.write(b if fd == a else a, data)
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        for fd in self._masters: os.close(fd)
+
+
+class ModbusSimulator:
+    """ pymodbus server with n_slaves slaves (ids 1..n) serving the synthetic register map.
+
+        transport: "tcp" or "rtu". After start(), client_options() gives the matching
+        ModbusTCPOptions/ ModbusRTUOptions keyword arguments.
+    """
+    def __init__(self, n_slaves: int, n_registers: int = 100, latency: float = 0, transport: str = "tcp",
+                 baudrate: int = 115200):
+        self.transport = transport
+        self.baudrate = baudrate
+        values = register_values(synthetic_register_map(n_registers))
+        # zero_mode=False shifts request addresses by one, so values index == 1-indexed address
+        slaves = {slave_id: _SlowSlaveContext(latency, hr=ModbusSequentialDataBlock(0, values),
+                                              ir=ModbusSequentialDataBlock(0, values))
+                  for slave_id in range(1, n_slaves + 1)}
+        self.context = ModbusServerContext(slaves=slaves, single=False)
+        self.port = None
+        self._server = None
+        self._task = None
+        self._serial_pair = None
+
+    async def start(self):
+        if self.transport == "tcp":
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                self.port = s.getsockname()[1]
+            self._server = ModbusTcpServer(self.context, address=("127.0.0.1", self.port))
+        else:
+            self._serial_pair = VirtualSerialPair()
+            self.port = self._serial_pair.ports[1]
+            self._server = ModbusSerialServer(self.context, port=self._serial_pair.ports[0], baudrate=self.baudrate)
+
+        self._task = asyncio.create_task(self._server.serve_forever())
+        await asyncio.sleep(0.1)                                    # let the server start listening
+
+    async def stop(self):
+        await self._server.shutdown()
+        self._task.cancel()
+        if self._serial_pair is not None: self._serial_pair.close()
+
+    def client_options(self) -> dict:
+        if self.transport == "tcp":
+            return {"type": "TCP", "host": "127.0.0.1", "port": self.port}
+        return {"type": "RTU", "port": self.port, "baudrate": self.baudrate, "bytesize": 8, "parity": False, "stopbits": 1}
@@ -0,0 +1,154 @@
+import mmap
+import os
+import struct
+import logging
+from time import time
+logger = logging.getLogger(__name__)
+
+"""
+    Store-and-forward:
+    While the MQTT broker is unreachable, state messages are appended to a fixed-size ring buffer
+    in a memory-mapped file, so memory use stays constant however long the outage lasts. When the
+    buffer is full the oldest messages are dropped. After reconnecting, the buffer is drained at a
+    limited rate on top of the live messages queued behind it, see async_engine.drain_worker. A
+    message is only removed once it was handed to the broker connection. Head and tail are kept in
+    the file header, so buffered messages also survive a restart.
+
+    File layout: HEADER, then `capacity` bytes of records. A record is a 4 byte length followed by
+    RECORD, the topic and the payload. A length of WRAP (or no room for a length) means the next
+    record starts at the beginning of the data region.
+"""
+
+HEADER = struct.Struct(">4sQQQQ")           # magic, capacity, head, tail, count
+MAGIC = b"MQSF"
+LENGTH = struct.Struct(">I")
+RECORD = struct.Struct(">dH")               # timestamp, topic length
+WRAP = 0xFFFFFFFF
+
+
+class RingBuffer:
+    """ Bounded FIFO of (timestamp, topic, payload) in a memory-mapped file.
+
+        Parameters:
+        -----------
+            - path: str: file backing the buffer, created if missing
+            - capacity: int: size of the data region in bytes
+    """
+    def __init__(self, path: str, capacity: int = 8*2**20):
+        self.path = path
+        self.capacity = capacity
+        self.buffered = 0                                           # messages pushed since start
+        self.dropped = 0                                            # messages lost because the buffer was full
+        self.drained = 0                                            # messages popped since start
+
+        size = HEADER.size + capacity
+        exists = os.path.exists(path) and os.path.getsize(path) == size
+        self._file = open(path, "r+b" if exists else "w+b")
+        if not exists: self._file.truncate(size)
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+
+        magic, stored_capacity, head, tail, count = HEADER.unpack_from(self._mmap, 0)
+        if magic == MAGIC and stored_capacity == capacity:
+            self.head, self.tail, self.count = head, tail, count
+            if count: logger.info(f"Resuming {count} buffered MQTT messages from {path}")
+        else:
+            self.head = self.tail = self.count = 0
+            self._save_header()
+
+    def __len__(self):
+        return self.count
+
+    def _save_header(self):
+        HEADER.pack_into(self._mmap, 0, MAGIC, self.capacity, self.head, self.tail, self.count)
+
+    def _write_position(self, size: int) -> int | None:
+        """ Offset in the data region where a record of size bytes fits, None if it does not """
+        if self.count == 0:
+            self.head = self.tail = 0
+            return 0 if size <= self.capacity else None
+        if self.head > self.tail:
+            if self.head + size <= self.capacity: return self.head
+            if size <= self.tail: return 0
+            return None
+        return self.head if self.head + size <= self.tail else None
+
+    def push(self, topic: str, payload: bytes, timestamp: float | None = None):
+        """ Append a message, dropping the oldest messages if the buffer is full """
+        topic_bytes = topic.encode()
+        size = LENGTH.size + RECORD.size + len(topic_bytes) + len(payload)
+        if size > self.capacity:
+            self.dropped += 1
+            return
+
+        pos = self._write_position(size)
+        while pos is None:
+            self._pop()
+            self.dropped += 1
+            pos = self._write_position(size)
+
+        if pos == 0 and self.head > 0 and self.head + LENGTH.size <= self.capacity:
+            LENGTH.pack_into(self._mmap, HEADER.size + self.head, WRAP)
+
+        offset = HEADER.size + pos
+        LENGTH.pack_into(self._mmap, offset, size - LENGTH.size)
+        RECORD.pack_into(self._mmap, offset + LENGTH.size, time() if timestamp is None else timestamp, len(topic_bytes))
+        start = offset + LENGTH.size + RECORD.size
+        self._mmap[start:start + len(topic_bytes)] = topic_bytes
+        self._mmap[start + len(topic_bytes):offset + size] = payload
+
+        self.head = pos + size
+        self.count += 1
+        self.buffered += 1
+        self._save_header()
+
+    def _oldest_offset(self) -> int:
+        """ Offset of the oldest record in the data region, following a wrap """
+        if self.tail + LENGTH.size > self.capacity or LENGTH.unpack_from(self._mmap, HEADER.size + self.tail)[0] == WRAP:
+            return 0
+        return self.tail
+
+    def _read(self, position: int) -> tuple[tuple[float, str, bytes], int]:
+        """ The message at position and its record size """
+        offset = HEADER.size + position
+        (length,) = LENGTH.unpack_from(self._mmap, offset)
+        timestamp, topic_length = RECORD.unpack_from(self._mmap, offset + LENGTH.size)
+        start = offset + LENGTH.size + RECORD.size
+        topic = self._mmap[start:start + topic_length].decode()
+        payload = self._mmap[start + topic_length:offset + LENGTH.size + length]
+        return (timestamp, topic, payload), LENGTH.size + length
+
+    def _pop(self) -> tuple[float, str, bytes]:
+        self.tail = self._oldest_offset()
+        message, size = self._read(self.tail)
+        self.tail += size
+        self.count -= 1
+        if self.count == 0: self.head = self.tail = 0
+        return message
+
+    def peek(self) -> tuple[float, str, bytes] | None:
+        """ The oldest message as (timestamp, topic, payload) without removing it, None if empty """
+        if self.count == 0: return None
+        return self._read(self._oldest_offset())[0]
+
+    def pop(self) -> tuple[float, str, bytes] | None:
+        """ Remove and return the oldest message as (timestamp, topic, payload), None if empty """
+        if self.count == 0: return None
+        message = self._pop()
+        self.drained += 1
+        self._save_header()
+        return message
+
+    def oldest(self) -> float | None:
+        """ Timestamp of the oldest buffered message """
+        if self.count == 0: return None
+        return RECORD.unpack_from(self._mmap, HEADER.size + self._oldest_offset() + LENGTH.size)[0]
+
+    def stats(self) -> dict:
+        oldest = self.oldest()
+        return {"queued": self.count, "buffered": self.buffered, "dropped": self.dropped, "drained": self.drained,
+                "oldest_age_s": time() - oldest if oldest is not None else None}
+
+    def close(self):
+        self._mmap.flush()
+        self._mmap.close()
+        self._file.close()
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import struct
+from pymodbus.exceptions import ModbusIOException
+from pymodbus.pdu import ExceptionResponse
+from pymodbus.pdu.register_read_message import ReadHoldingRegistersResponse, ReadInputRegistersResponse
+from pymodbus.pdu.register_write_message import WriteMultipleRegistersResponse
+logger = logging.getLogger(__name__)
+
+"""
+    Pipelined Modbus TCP:
+    Many Modbus TCP gateways accept several transactions in flight on one connection but limit
+    the number of connections. A PipelinedTcpConnection keeps up to `depth` requests in flight,
+    each with its own MBAP transaction id, and matches responses back by transaction id.
+    TcpConnectionPool shares one connection per host:port between all clients using that gateway.
+
+    Only the function codes used by the add-on are implemented (3, 4 and 16). Responses are
+    returned as the corresponding pymodbus response objects.
+"""
+
+MBAP_HEADER = struct.Struct(">HHHB")                                # transaction id, protocol id, length, unit id
+READ_REQUEST = struct.Struct(">BHH")                                # function code, address, count
+WRITE_RESPONSE = struct.Struct(">HH")                               # address, count
+
+READ_HOLDING_REGISTERS = 3
+READ_INPUT_REGISTERS = 4
+WRITE_MULTIPLE_REGISTERS = 16
+
+
+class PipelinedTcpConnection:
+    """ Modbus TCP connection with up to `depth` transactions in flight.
+
+        Implements the subset of the pymodbus async client interface used by AsyncClient.
+    """
+    def __init__(self, host: str, port: int, depth: int = 4, timeout: float = 3):
+        self.host = host
+        self.port = port
+        self.depth = depth
+        self.timeout = timeout
+
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._reader_task: asyncio.Task | None = None
+        self._in_flight: asyncio.Semaphore | None = None
+        self._pending: dict[int, asyncio.Future] = {}               # transaction id -> future of the response
+        self._next_tid = 0
+        self._connect_lock: asyncio.Lock | None = None
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self) -> bool:
+        if self._connect_lock is None: self._connect_lock = asyncio.Lock()
+
+        async with self._connect_lock:
+            if self.connected: return True
+            try:
+                self._reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port), self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.error(f"Could not connect to {self.host}:{self.port}: {e}")
+                return False
+
+            self._in_flight = asyncio.Semaphore(self.depth)
+            self._reader_task = asyncio.create_task(self._read_responses(), name=f"modbus tcp {self.host}:{self.port}")
+            logger.info(f"Connected to {self.host}:{self.port}, pipeline depth {self.depth}")
+            return True
+
+    def close(self):
+        if self._reader_task is not None: self._reader_task.cancel()
+        self._disconnect(ModbusIOException(f"Connection to {self.host}:{self.port} closed"))
+
+    def _disconnect(self, exc: Exception):
+        """ Close the socket and fail all requests in flight, the next request reconnects """
+        if self._writer is not None: self._writer.close()
+        self._writer = None
+        self._reader_task = None
+        self._fail_pending(exc)
+
+    async def read_holding_registers(self, address: int, count: int = 1, slave: int = 1):
+        return await self.execute(slave, READ_REQUEST.pack(READ_HOLDING_REGISTERS, address, count))
+
+    async def read_input_registers(self, address: int, count: int = 1, slave: int = 1):
+        return await self.execute(slave, READ_REQUEST.pack(READ_INPUT_REGISTERS, address, count))
+
+    async def write_registers(self, address: int, values: list[int], slave: int = 1):
+        pdu = struct.pack(f">BHHB{len(values)}H", WRITE_MULTIPLE_REGISTERS, address, len(values), 2*len(values), *values)
+        return await self.execute(slave, pdu)
+
+    async def execute(self, slave: int, pdu: bytes):
+        """ Send a request PDU and wait for its response, with at most `depth` requests in flight """
+        if not self.connected and not await self.connect():
+            raise ModbusIOException(f"Not connected to {self.host}:{self.port}")
+
+        async with self._in_flight:
+            tid = self._allocate_tid()
+            future = asyncio.get_running_loop().create_future()
+            self._pending[tid] = future
+
+            self._writer.write(MBAP_HEADER.pack(tid, 0, len(pdu) + 1, slave) + pdu)
+            try:
+                await self._writer.drain()
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                raise ModbusIOException(f"No response from {self.host}:{self.port} for transaction {tid}")
+            except OSError as e:
+                raise ModbusIOException(f"Connection to {self.host}:{self.port} failed: {e}")
+            finally:
+                self._pending.pop(tid, None)
+
+    def _allocate_tid(self) -> int:
+        while True:
+            self._next_tid = (self._next_tid + 1) & 0xFFFF
+            if self._next_tid not in self._pending: return self._next_tid
+
+    async def _read_responses(self):
+        try:
+            while True:
+                header = await self._reader.readexactly(MBAP_HEADER.size)
+                tid, _, length, slave = MBAP_HEADER.unpack(header)
+                pdu = await self._reader.readexactly(length - 1)
+
+                future = self._pending.get(tid)
+                if future is None or future.done():
+                    logger.warning(f"Dropping response for unknown transaction {tid} from {self.host}:{self.port}")
+                    continue
+                future.set_result(self._decode_response(pdu, slave, tid))
+        except (asyncio.IncompleteReadError, OSError) as e:
+            logger.error(f"Connection to {self.host}:{self.port} lost: {e}")
+            self._disconnect(ModbusIOException(f"Connection to {self.host}:{self.port} lost"))
+        except Exception as e:                                      # malformed frame, the stream is out of sync
+            logger.error(f"Invalid response from {self.host}:{self.port}, reconnecting: {e!r}")
+            self._disconnect(ModbusIOException(f"Invalid response from {self.host}:{self.port}: {e!r}"))
+
+    @staticmethod
+    def _decode_response(pdu: bytes, slave: int, tid: int):
+        function_code = pdu[0]
+        if function_code & 0x80:
+            return ExceptionResponse(function_code & 0x7F, pdu[1], slave=slave, transaction=tid)
+
+        if function_code in (READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS):
+            byte_count = pdu[1]
+            values = list(struct.unpack_from(f">{byte_count//2}H", pdu, 2))
+            response_class = ReadHoldingRegistersResponse if function_code == READ_HOLDING_REGISTERS else ReadInputRegistersResponse
+            return response_class(values, slave=slave, transaction=tid)
+
+        if function_code == WRITE_MULTIPLE_REGISTERS:
+            address, count = WRITE_RESPONSE.unpack_from(pdu, 1)
+            return WriteMultipleRegistersResponse(address, count, slave=slave, transaction=tid)
+
+        raise ModbusIOException(f"Unsupported function code {function_code} in response")
+
+    def _fail_pending(self, exc: Exception):
+        for future in self._pending.values():
+            if not future.done(): future.set_exception(exc)
+        self._pending.clear()
+
+
+class TcpConnectionPool:
+    """ One PipelinedTcpConnection per host:port, shared between all clients of that gateway """
+    def __init__(self):
+        self._connections: dict[tuple[str, int], PipelinedTcpConnection] = {}
+        self._users: dict[tuple[str, int], int] = {}
+
+    def acquire(self, host: str, port: int, depth: int = 4, timeout: float = 3) -> PipelinedTcpConnection:
+        key = (host, port)
+        connection = self._connections.get(key)
+        if connection is None:
+            connection = self._connections[key] = PipelinedTcpConnection(host, port, depth, timeout)
+        elif depth > connection.depth:
+            logger.info(f"Clients of {host}:{port} configure different pipeline depths, using {connection.depth}")
+
+        self._users[key] = self._users.get(key, 0) + 1
+        return connection
+
+    def release(self, connection: PipelinedTcpConnection):
+        """ Close the connection once its last client released it """
+        key = (connection.host, connection.port)
+        self._users[key] -= 1
+        if self._users[key] == 0:
+            del self._users[key], self._connections[key]
+            connection.close()
+
+
+TCP_POOL = TcpConnectionPool()
@@ -0,0 +1,127 @@
+import enum
+import os
+import sys
+import types
+from types import SimpleNamespace
+import pytest
+
+# the add-on's modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import implemented_servers                                      # noqa: F401
+except ModuleNotFoundError:
+    # the device implementations are not part of this repository, loader and sharding only need ServerTypes
+    class _SimServerFactory:
+        def __call__(self, sr_options, clients):
+            from simulator import SimServer
+            return SimServer(sr_options, clients)
+
+    class ServerTypes(enum.Enum):
+        SimServer = _SimServerFactory()
+
+    implemented_servers = types.ModuleType("implemented_servers")
+    implemented_servers.ServerTypes = ServerTypes
+    sys.modules["implemented_servers"] = implemented_servers
+
+
+class FakeServer:
+    """ The attributes of a Server that MqttClient, Aggregator and WriteWorker use """
+    def __init__(self, nickname, client="c0"):
+        self.nickname = nickname
+        self.connected_client = client
+        self.registers = {}
+        self.write_parameters = {"Limit": {"addr": 1, "unit": "%"}}
+        self.aggregate_windows = {}
+        self.aggregate_energy = False
+
+    def __str__(self):
+        return self.nickname
+
+
+class FakeBus:
+    """ The AsyncClient of a BusScheduler, records the requests issued. Reads of servers in `failing` raise,
+        the device type code read is `modelcode`.
+    """
+    baudrate = None
+    nickname = "c0"
+
+    def __init__(self, failing=(), base_delay=60, modelcode=1):
+        from circuit_breaker import CircuitBreaker
+        self.breaker = CircuitBreaker("c0", base_delay, failure_threshold=1)
+        self.failing = set(failing)
+        self.modelcode = modelcode
+        self.requests = []
+
+    def __str__(self):
+        return self.nickname
+
+    async def read_server_registers(self, server, register_names):
+        self.requests.append(("read", server.nickname))
+        if server.nickname in self.failing: raise ConnectionError("no response")
+        return {name: 0 for name in register_names}
+
+    async def write_server_registers(self, server, values):
+        self.requests.append(("write", server.nickname))
+        return values
+
+    async def read_model(self, server):
+        self.requests.append(("model", server.nickname))
+        server.set_model(self.modelcode)
+
+    async def read_modelcode(self, server, register_info):
+        self.requests.append(("modelcode", server.nickname))
+        return self.modelcode
+
+    def forget_plans(self, server):
+        pass
+
+
+@pytest.fixture
+def make_server():
+    return FakeServer
+
+
+@pytest.fixture
+def make_bus():
+    return FakeBus
+
+
+@pytest.fixture
+def make_mqtt_client():
+    """ MqttClient factory taking option overrides. publish records the messages paho would accept in client.sent
+        and returns client.rc, set it to e.g. MQTT_ERR_NO_CONN to make publishing fail.
+    """
+    import paho.mqtt.client as mqtt
+    from modbus_mqtt import MqttClient
+
+    def make(**overrides) -> MqttClient:
+        options = SimpleNamespace(mqtt_user="u", mqtt_password="p", mqtt_base_topic="modbus", mwtt_ha_discovery_topic="ha",
+                                  mqtt_deadband=0, mqtt_deadband_rel=0, mqtt_heartbeat_interval=0, discovery_cache_path="",
+                                  mqtt_aggregate_state=False, mqtt_buffer_path="", mqtt_buffer_max_bytes=0, mqtt_drain_rate=0)
+        for name, value in overrides.items(): setattr(options, name, value)
+        client = MqttClient(options)
+        client.sent = []
+        client.rc = mqtt.MQTT_ERR_SUCCESS
+
+        def publish(topic, payload=None, qos=0, retain=False):
+            if client.rc == mqtt.MQTT_ERR_SUCCESS: client.sent.append((topic, payload))
+            return SimpleNamespace(rc=client.rc)
+        client.publish = publish
+        client.subscribe = client.unsubscribe = lambda topic: None
+        return client
+    return make
+
+
+@pytest.fixture
+def make_options():
+    """ Options factory with n simulated servers, each on its own TCP client """
+    from loader import ModbusTCPOptions, Options, ServerOptions
+
+    def make(n=3, **overrides) -> Options:
+        return Options(
+            servers=[ServerOptions(f"s{i}", f"s{i}", f"SN{i}", "Sim", f"c{i}", 1) for i in range(n)],
+            clients=[ModbusTCPOptions(f"c{i}", f"c{i}", "TCP", host="127.0.0.1", port=502 + i) for i in range(n)],
+            mqtt_host="broker", mqtt_port=1883, mqtt_user="u", mqtt_password="p", mwtt_ha_discovery_topic="homeassistant",
+            mqtt_base_topic="modbus", **overrides)
+    return make
@@ -0,0 +1,35 @@
+import json
+import pytest
+from loader import ServerOptions
+from simulator import SimServer
+
+
+@pytest.fixture
+def client(make_mqtt_client):
+    return make_mqtt_client(mqtt_aggregate_state=True, mqtt_heartbeat_interval=300)
+
+
+@pytest.fixture
+def server(make_bus):
+    server = SimServer(ServerOptions("s0", "Inverter 1", "SN0", "Sim", "c0", 1), [make_bus()], n_registers=3)
+    server.set_model(1)
+    return server
+
+
+def test_values_are_merged_into_one_document_per_server(client, server):
+    client.publish_values(server, {"Device type code": 1, "Sim register 0": 10})
+    client.publish_values(server, {"Sim register 0": 10, "Sim register 1": -2.5})
+    client.publish_values(server, {"Sim register 0": 10})           # unchanged, nothing published
+
+    assert [topic for topic, _ in client.sent] == ["modbus/Inverter 1/state"] * 2
+    assert json.loads(client.sent[-1][1]) == {"device_type_code": 1, "sim_register_0": 10, "sim_register_1": -2.5}
+
+
+def test_discovery_points_sensors_into_the_document(client, server):
+    client.publish_discovery_topics(server)
+    configs = {topic: json.loads(payload) for topic, payload in client.sent if topic.endswith("/config")}
+    config = configs["ha/sensor/Inverter 1/sim_register_1/config"]
+    assert config["state_topic"] == "modbus/Inverter 1/state"
+    assert config["value_template"] == "{{ value_json['sim_register_1'] }}"
+    assert {c["value_template"] for c in configs.values()} == \
+           {f"{{{{ value_json['{key}'] }}}}" for key in ("device_type_code", "sim_register_0", "sim_register_1")}
@@ -0,0 +1,67 @@
+import pytest
+from aggregation import Aggregator, WindowRing
+from enums import DataType
+
+
+@pytest.fixture
+def power_server(make_server):
+    def make(dtype=DataType.I32):
+        server = make_server("inv")
+        server.registers = {"Power": {"addr": 1, "count": 2, "dtype": dtype, "multiplier": 1, "unit": "W",
+                                      "device_class": "power"}}
+        server.aggregate_windows, server.aggregate_energy = {"power": 10}, True
+        return server
+    return make
+
+
+def test_window_closes_on_next_sample_or_flush(power_server):
+    aggregator = Aggregator()
+    server = power_server()
+    assert aggregator.add(server, {"Power": 1}, t=1) == {}
+    assert aggregator.add(server, {"Power": 3}, t=9) == {}
+    assert aggregator.flush(t=9.5) == []
+    [(flushed_server, values)] = aggregator.flush(t=10.5)
+    assert flushed_server is server
+    assert values["Power"] == 3 and values["Power min"] == 1 and values["Power max"] == 3 and values["Power mean"] == 2
+    assert aggregator.flush(t=30) == []                             # nothing new to close
+    assert aggregator.add(server, {"Power": 5}, t=21) == {}         # opens the window 20..30
+
+
+def test_close_all_publishes_open_windows(power_server):
+    aggregator = Aggregator()
+    server = power_server()
+    aggregator.add(server, {"Power": 4}, t=1)
+    assert aggregator.close_all(server)["Power mean"] == 4
+    assert aggregator.close_all(server) == {}
+
+
+def test_energy_splits_negative_power():
+    ring = WindowRing(60, integrate=True, reverse=True)
+    for t, power in [(0, 3600), (1, 3600), (2, -3600), (3, -3600)]: ring.add(power, t)
+    assert ring.energy == pytest.approx(1 + 0.5 / 2)                # 1 s at 1 Wh/s, half of the crossing second
+    assert ring.reverse_energy == pytest.approx(1 + 0.5 / 2)
+
+
+def test_energy_of_unsigned_register_is_clamped(power_server):
+    aggregator = Aggregator()
+    derived = aggregator.configure(power_server(DataType.U16))
+    assert "Power energy" in derived and "Power reverse energy" not in derived
+    ring = WindowRing(60, integrate=True)
+    for t, power in [(0, -3600), (1, -3600)]: ring.add(power, t)
+    assert ring.energy == 0 and ring.reverse_energy is None
+
+
+def test_energy_is_not_integrated_across_gaps():
+    ring = WindowRing(10, integrate=True)
+    for t, power in [(0, 3600), (5, 3600), (100, 3600), (105, 3600)]: ring.add(power, t)
+    assert ring.energy == pytest.approx(10)
+
+
+def test_unavailable_server_publishes_its_open_windows(make_mqtt_client, power_server):
+    mqtt_client = make_mqtt_client()
+    sent = mqtt_client.sent
+    server = power_server()
+    mqtt_client.publish_values(server, {"Power": 7}, t=1)
+    assert sent == []
+    mqtt_client.publish_availability(False, server)
+    assert ("modbus/inv/power_mean/state", 7) in sent and sent[-1] == ("modbus_inv/availability", b"offline")
@@ -0,0 +1,98 @@
+import asyncio
+from time import perf_counter
+from types import SimpleNamespace
+from async_client import AsyncClient, inter_frame_silence
+from bus_scheduler import BusScheduler, SetupJob
+from enums import BreakerState
+from loader import ModbusRTUOptions, ServerOptions
+from simulator import SimServer
+
+
+def polling(bus, n_servers, interval=5, on_availability=None):
+    servers = [SimServer(ServerOptions(f"s{i}", f"s{i}", f"SN{i}", "Sim", "c0", 1), [bus], n_registers=4)
+               for i in range(n_servers)]
+    for server in servers: server.model = "Sim"
+    return servers, BusScheduler(bus, servers, interval, on_availability=on_availability)
+
+
+async def run_for(scheduler, seconds):
+    task = asyncio.create_task(scheduler.run(asyncio.Queue()))
+    await asyncio.sleep(seconds)
+    scheduler.stop()
+    await task
+
+
+def rtu_client(**overrides) -> AsyncClient:
+    return AsyncClient(ModbusRTUOptions("c0", "c0", "RTU", port="/dev/null", baudrate=9600, bytesize=8,
+                                        parity=False, stopbits=1, **overrides))
+
+
+def test_block_reads_of_one_group_keep_the_inter_frame_silence():
+    async def scenario():
+        client = rtu_client(read_max_count=10)
+        server = SimServer(ServerOptions("s0", "s0", "SN0", "Sim", "c0", 1), [client], n_registers=30)
+        frames = []
+
+        async def read_holding_registers(address, count, slave):
+            frames.append(perf_counter())
+            return SimpleNamespace(isError=lambda: False, registers=[0] * count)
+
+        client.client.read_holding_registers = read_holding_registers
+        values = await client.read_server_registers(server)
+        return frames, values
+
+    frames, values = asyncio.run(scenario())
+    assert len(frames) > 1 and len(values) == 30
+    assert all(b - a >= inter_frame_silence(9600) for a, b in zip(frames, frames[1:]))
+
+
+def test_revalidation_without_device_type_code_leaves_the_breaker_alone():
+    async def scenario():
+        client = rtu_client()
+        server = SimServer(ServerOptions("s0", "s0", "SN0", "Sim", "c0", 1), [client])
+        model_cache = SimpleNamespace(modelcode_register=lambda server: None)
+        scheduler = BusScheduler(client, [server], 5, model_cache=model_cache)
+        for _ in range(server.breaker.failure_threshold): server.breaker.record_failure()
+        server.breaker.retry_at = 0                                 # backoff expired, the next allow() probes
+        await scheduler._setup(SetupJob(server, revalidate=True), asyncio.get_running_loop())
+        return server
+
+    assert asyncio.run(scenario()).breaker.state is BreakerState.OPEN
+
+
+def test_writes_go_before_due_reads(make_bus):
+    async def scenario():
+        bus = make_bus()
+        servers, scheduler = polling(bus, 2)
+        written = scheduler.submit_writes(servers[1], {"Limit": 1.0})
+        await run_for(scheduler, 0.01)
+        return bus.requests, await written
+
+    requests, written = asyncio.run(scenario())
+    assert requests == [("write", "s1"), ("read", "s0"), ("read", "s1")]
+    assert written == {"Limit": 1.0}
+
+
+def test_reads_repeat_at_their_poll_interval(make_bus):
+    async def scenario():
+        bus = make_bus()
+        servers, scheduler = polling(bus, 1, interval=0.05)
+        await run_for(scheduler, 0.175)
+        return bus.requests
+
+    assert asyncio.run(scenario()) == [("read", "s0")] * 4
+
+
+def test_unreachable_server_is_skipped_until_its_backoff_expires(make_bus):
+    availability = []
+
+    async def scenario():
+        bus = make_bus(failing={"s0"})
+        servers, scheduler = polling(bus, 2, interval=0.02,
+                                     on_availability=lambda available, server: availability.append((available, server.nickname)))
+        await run_for(scheduler, 0.1)
+        return bus.requests
+
+    requests = asyncio.run(scenario())
+    assert requests.count(("read", "s0")) == 1 and requests.count(("read", "s1")) >= 3
+    assert availability == [(False, "s0")]
@@ -0,0 +1,48 @@
+from modbus_mqtt import ChangeFilter
+
+
+def test_first_value_is_published():
+    assert ChangeFilter().should_publish("s", "r", 1)
+
+
+def test_unchanged_value_is_suppressed_until_heartbeat(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("modbus_mqtt.monotonic", lambda: now[0])
+    change_filter = ChangeFilter(heartbeat_interval=60)
+    assert change_filter.should_publish("s", "r", 5)
+    now[0] += 30
+    assert not change_filter.should_publish("s", "r", 5)
+    now[0] += 31
+    assert change_filter.should_publish("s", "r", 5)
+    assert (change_filter.published, change_filter.suppressed) == (2, 1)
+
+
+def test_absolute_and_relative_deadband():
+    change_filter = ChangeFilter(deadband=1, deadband_rel=0.1)
+    assert change_filter.should_publish("s", "r", 100)
+    assert not change_filter.should_publish("s", "r", 105)     # beyond 1, within 10 %
+    assert change_filter.should_publish("s", "r", 111)
+
+
+def test_register_overrides_deadband():
+    change_filter = ChangeFilter(deadband=10)
+    assert change_filter.should_publish("s", "r", 0, {"deadband": 0})
+    assert change_filter.should_publish("s", "r", 1, {"deadband": 0})
+    assert change_filter.should_publish("s", "q", 0)
+    assert not change_filter.should_publish("s", "q", 1)
+
+
+def test_non_numeric_values_compare_by_equality():
+    change_filter = ChangeFilter(deadband=100)
+    assert change_filter.should_publish("s", "r", "A")
+    assert not change_filter.should_publish("s", "r", "A")
+    assert change_filter.should_publish("s", "r", "B")
+
+
+def test_invalidate_server():
+    change_filter = ChangeFilter()
+    change_filter.should_publish("s1", "r", 1)
+    change_filter.should_publish("s2", "r", 1)
+    change_filter.invalidate("s1")
+    assert change_filter.should_publish("s1", "r", 1)
+    assert not change_filter.should_publish("s2", "r", 1)
@@ -0,0 +1,39 @@
+from circuit_breaker import CircuitBreaker
+from client import Client
+from enums import BreakerState
+from loader import ModbusTCPOptions, ServerOptions
+from simulator import SimServer
+
+
+def test_opens_after_failure_threshold_consecutive_failures():
+    breaker = CircuitBreaker("test", base_delay=5, jitter=0)
+    assert not breaker.record_failure() and not breaker.record_failure()
+    assert breaker.state is BreakerState.CLOSED
+    breaker.record_success()                                        # only consecutive failures count
+    assert [breaker.record_failure() for _ in range(3)] == [False, False, True]
+    assert breaker.state is BreakerState.OPEN and breaker.backoff() == 5
+
+
+def test_threshold_is_configured_per_client():
+    client = Client(ModbusTCPOptions("c0", "c0", "TCP", host="127.0.0.1", port=502, failure_threshold=1))
+    server = SimServer(ServerOptions("s0", "s0", "SN0", "Sim", "c0", 1), [client])
+    assert client.breaker.failure_threshold == server.breaker.failure_threshold == 1
+    assert server.breaker.record_failure()
+
+
+def test_retry_delay_is_base_delay_below_threshold_then_backoff():
+    breaker = CircuitBreaker("test", base_delay=5, jitter=0)
+    breaker.record_failure()
+    assert breaker.state is BreakerState.CLOSED and breaker.retry_delay() == 5
+    breaker.record_failure(); breaker.record_failure()
+    assert breaker.state is BreakerState.OPEN and 4.9 < breaker.retry_delay() <= 5
+
+
+def test_connect_waits_base_delay_before_breaker_opens(monkeypatch):
+    client = Client(ModbusTCPOptions("c0", "c0", "TCP", host="127.0.0.1", port=502))
+    delays = []
+    monkeypatch.setattr(client.client, "connect", lambda: False)
+    monkeypatch.setattr("client.sleep", delays.append)
+    try: client.connect(num_retries=2)
+    except ConnectionError: pass
+    assert delays == [client.breaker.base_delay] * 2
@@ -0,0 +1,80 @@
+import struct
+import pytest
+from codec import BlockLayout
+from enums import DataType, Endian
+
+
+def registers_of(*encoded):
+    return [r for dtype, value in encoded for r in dtype.encode_registers(value)]
+
+
+def test_decodes_mixed_types_in_one_block():
+    raw = registers_of((DataType.U16, 7), (DataType.I16, -2), (DataType.U32, 70000), (DataType.F32, 1.5))
+    layout = BlockLayout([("a", 0, 1, DataType.U16), ("b", 1, 1, DataType.I16), ("c", 2, 2, DataType.U32),
+                          ("d", 4, 2, DataType.F32)], len(raw))
+    assert layout.decode(raw) == {"a": 7, "b": -2, "c": 70000, "d": 1.5}
+
+
+def test_skips_gaps_between_fields():
+    raw = [1, 0xFFFF, 0xFFFF, 2]
+    layout = BlockLayout([("a", 0, 1, DataType.U16), ("b", 3, 1, DataType.U16)], 4)
+    assert layout.decode(raw) == {"a": 1, "b": 2}
+
+
+def test_little_endian_word_order():
+    raw = list(reversed(DataType.U32.encode_registers(0x12345678)))
+    layout = BlockLayout([("a", 0, 2, DataType.U32)], 2, word_order=Endian.LITTLE)
+    assert layout.decode(raw) == {"a": 0x12345678}
+
+
+def test_utf8_is_stripped():
+    raw = registers_of((DataType.U16, 1)) + [0x4142, 0x4300, 0x0000]
+    layout = BlockLayout([("n", 0, 1, DataType.U16), ("s", 1, 3, DataType.UTF8)], 4)
+    assert layout.decode(raw) == {"n": 1, "s": "ABC"}
+
+
+def test_overlapping_fields_are_decoded_separately():
+    raw = DataType.U32.encode_registers(0x00010002)
+    layout = BlockLayout([("wide", 0, 2, DataType.U32), ("low", 1, 1, DataType.U16)], 2)
+    assert layout.order == ("wide", "low")
+    assert layout.decode(raw) == {"wide": 0x00010002, "low": 2}
+
+
+def test_matches_per_register_decode():
+    values = [(DataType.I32, -123456), (DataType.U64, 2**40 + 5), (DataType.F64, -0.25)]
+    raw = registers_of(*values)
+    fields, offset = [], 0
+    for i, (dtype, value) in enumerate(values):
+        n = len(dtype.encode_registers(value))
+        fields.append((f"f{i}", offset, n, dtype))
+        offset += n
+    decoded = BlockLayout(fields, len(raw)).decode(raw)
+    for name, offset, n, dtype in fields:
+        assert decoded[name] == dtype.decode_registers(raw[offset:offset+n])
+
+
+@pytest.mark.parametrize("byte_order", [Endian.BIG, Endian.LITTLE])
+@pytest.mark.parametrize("raw", [0, 1, 0x7FFF, 0x8000, 0xFF01, 0xFFFF])
+def test_single_register_fast_path_matches_decode(raw, byte_order):
+    from server import Server
+
+    class Decoder(Server):
+        pass
+    Decoder.byte_order = byte_order
+    for dtype in (DataType.U16, DataType.I16):
+        data = struct.pack(f"{byte_order.value}H", raw)
+        assert Decoder._decoded([raw], dtype) == dtype.decode(data)
+        assert dtype.decode_registers([raw]) == dtype.decode(struct.pack(">H", raw))
+
+
+def test_count_beyond_dtype_width_does_not_shift_later_fields():
+    layout = BlockLayout([("a", 0, 2, DataType.U16), ("b", 2, 1, DataType.U16)], 3)
+    assert layout.decode([1, 2, 3]) == {"a": 1, "b": 3}
+    layout = BlockLayout([("a", 0, 3, DataType.U32), ("b", 3, 1, DataType.U16)], 4, word_order=Endian.LITTLE)
+    assert layout.decode([1, 2, 9, 3]) == {"a": 2 << 16 | 1, "b": 3}
+
+
+def test_count_below_dtype_width_raises_like_per_register_decoding():
+    layout = BlockLayout([("a", 0, 1, DataType.U32), ("b", 1, 1, DataType.U16)], 2)
+    with pytest.raises(ValueError):
+        layout.decode([1, 2])
@@ -0,0 +1,64 @@
+import asyncio
+import json
+import threading
+import paho.mqtt.client as mqtt
+import pytest
+from modbus_mqtt import DiscoveryCache
+
+
+@pytest.fixture
+def client(make_mqtt_client, tmp_path):
+    return make_mqtt_client(discovery_cache_path=str(tmp_path / "discovery.json"))
+
+
+def test_record_keeps_hash_of_unsent_topics():
+    cache = DiscoveryCache("")
+    cache.record("inv", {"a": "1", "b": "2"})
+    cache.record("inv", {"a": "1b"})                                # "b" changed but was not sent
+    changed, removed = cache.diff("inv", {"a": "1b", "b": "2b"})
+    assert changed == {"b": "2b"} and removed == []
+    cache.record("inv", {"a": b"", "b": b""})
+    assert "inv" not in cache.hashes
+
+
+def test_failed_publish_is_not_recorded_and_resent_on_connect(client, tmp_path):
+    client.rc = mqtt.MQTT_ERR_NO_CONN
+    client._send_discovery("inv", {"ha/a/config": "{}"})
+    assert client.sent == [] and "inv" not in client.discovery_cache.hashes
+    assert client.discovery_cache.diff("inv", {"ha/a/config": "{}"})[0] == {"ha/a/config": "{}"}
+
+    client.rc = mqtt.MQTT_ERR_SUCCESS
+    client.resend_discovery()
+    assert client.sent == [("ha/a/config", "{}")]
+    assert client.discovery_cache.diff("inv", {"ha/a/config": "{}"})[0] == {}
+    with open(tmp_path / "discovery.json") as f:
+        assert "ha/a/config" in json.load(f)["inv"]
+    client.resend_discovery()
+    assert len(client.sent) == 1
+
+
+def test_failed_removal_keeps_the_stale_topic(client):
+    client._send_discovery("old", {"ha/x/config": "{}"})
+    client.rc = mqtt.MQTT_ERR_NO_CONN
+    client.remove_stale_discovery_topics([])
+    assert "ha/x/config" in client.discovery_cache.hashes["old"]
+    client.rc = mqtt.MQTT_ERR_SUCCESS
+    client.remove_stale_discovery_topics([])
+    assert client.sent[-1] == ("ha/x/config", b"") and "old" not in client.discovery_cache.hashes
+
+
+def test_on_connect_hands_resend_to_the_event_loop(client):
+    client.rc = mqtt.MQTT_ERR_NO_CONN
+    client._send_discovery("inv", {"ha/a/config": "{}"})
+    client.rc = mqtt.MQTT_ERR_SUCCESS
+
+    async def scenario():
+        client.event_loop = asyncio.get_running_loop()
+        network_thread = threading.Thread(target=client.on_connect, args=(client, None, None, 0, None))
+        network_thread.start(); network_thread.join()
+        sent_on_network_thread = list(client.sent)
+        await asyncio.sleep(0)
+        return sent_on_network_thread
+
+    assert asyncio.run(scenario()) == []
+    assert client.sent == [("ha/a/config", "{}")]
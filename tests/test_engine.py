@@ -0,0 +1,49 @@
+import asyncio
+import dataclasses
+import pytest
+from async_client import AsyncClient
+from async_engine import Engine
+from loader import ModbusTCPOptions, ServerOptions
+from simulator import ModbusSimulator, SimServer
+
+
+def test_failed_reload_changes_nothing(make_options, make_mqtt_client):
+    def server_factory(sr_options, clients):
+        raise KeyError(sr_options.server_type)
+
+    async def scenario():
+        options = make_options(0)
+        engine = Engine([], [], make_mqtt_client(), options=options, server_factory=server_factory)
+        new = dataclasses.replace(options, mqtt_deadband=5,
+                                  clients=[ModbusTCPOptions("c9", "c9", "TCP", host="127.0.0.1", port=1502)],
+                                  servers=[ServerOptions("s9", "s9", "SN9", "Unknown", "c9", 1)])
+        with pytest.raises(KeyError):
+            await engine.reload(new)
+        return engine, options
+
+    engine, options = asyncio.run(scenario())
+    assert engine.options is options
+    assert engine.clients == [] and engine.servers == [] and engine.schedulers == {}
+    assert engine.mqtt_client.change_filter.deadband == 0
+
+
+def test_slow_bus_does_not_stall_the_others(make_mqtt_client):
+    async def scenario():
+        simulators = {"fast": ModbusSimulator(1, n_registers=10), "slow": ModbusSimulator(1, n_registers=10, latency=0.3)}
+        for simulator in simulators.values(): await simulator.start()
+        clients = [AsyncClient(ModbusTCPOptions(name, name, "TCP", host="127.0.0.1", port=simulator.port))
+                   for name, simulator in simulators.items()]
+        servers = [SimServer(ServerOptions(f"{c.name} 1", f"{c.name} 1", f"SN{c.name}", "Sim", c.name, 1), clients, n_registers=10)
+                   for c in clients]
+        mqtt_client = make_mqtt_client()
+        engine = Engine(clients, servers, mqtt_client, poll_interval=0.05)
+        task = asyncio.create_task(engine.run(metrics_interval=0))
+        await asyncio.sleep(1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        for simulator in simulators.values(): await simulator.stop()
+        return mqtt_client.sent
+
+    sent = asyncio.run(scenario())
+    cycles = {name: sum(topic == f"modbus/{name} 1/sim_register_0/state" for topic, _ in sent) for name in ("fast", "slow")}
+    assert cycles["slow"] <= 3 and cycles["fast"] >= 10
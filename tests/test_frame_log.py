@@ -0,0 +1,34 @@
+import frame_log
+from frame_log import READ_HOLDING_REGISTERS, FrameWriter, ReplayClient
+
+
+def write_capture(path, monkeypatch, timestamps):
+    clock = iter(timestamps)
+    monkeypatch.setattr(frame_log, "time", lambda: next(clock))
+    writer = FrameWriter(str(path), max_bytes=4096)
+    for i, _ in enumerate(timestamps): writer.append(READ_HOLDING_REGISTERS, 1, 0, 1, [i])
+    writer.close()
+
+
+def replay_times(client, n, monkeypatch):
+    """ Times at which n requests are answered when each is sent as soon as the previous one is answered """
+    now = [0.0]
+    monkeypatch.setattr(frame_log, "monotonic", lambda: now[0])
+    times = []
+    for _ in range(n):
+        frame, delay = client._next((READ_HOLDING_REGISTERS, 1, 0, 1))
+        now[0] += delay
+        times.append((now[0], frame.registers[0]))
+    return times
+
+
+def test_loop_keeps_the_captured_pace(tmp_path, monkeypatch):
+    write_capture(tmp_path / "capture.bin", monkeypatch, [100.0, 105.0, 110.0])
+    client = ReplayClient(str(tmp_path / "capture.bin"), speed=1)
+    assert replay_times(client, 7, monkeypatch) == [(0, 0), (5, 1), (10, 2), (15, 0), (20, 1), (25, 2), (30, 0)]
+
+
+def test_speed_scales_looped_delays(tmp_path, monkeypatch):
+    write_capture(tmp_path / "capture.bin", monkeypatch, [0.0, 4.0])
+    client = ReplayClient(str(tmp_path / "capture.bin"), speed=2)
+    assert [t for t, _ in replay_times(client, 4, monkeypatch)] == [0, 2, 4, 6]
@@ -0,0 +1,46 @@
+import logging
+import pytest
+import hot_log
+from hot_log import EventLogger, configure
+
+
+@pytest.fixture(autouse=True)
+def policies():
+    configure()
+    yield
+    configure()
+
+
+def test_sampling_keeps_one_record_in_n(caplog):
+    caplog.set_level(logging.DEBUG, logger="test_hot_log")
+    configure(sampling={"register_read": 3})
+    log = EventLogger("test_hot_log")
+    emitted = [log.debug("register_read", "read %d", i) for i in range(7)]
+    assert emitted == [True, False, False, True, False, False, True]
+    assert [r.getMessage() for r in caplog.records] == ["read 0", "read 3", "read 6"]
+    assert [r.fields for r in caplog.records] == [{}, {"suppressed": 2}, {"suppressed": 2}]
+
+
+def test_rate_limit_is_per_key_and_reports_the_suppressed_count(caplog, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(hot_log, "monotonic", lambda: now[0])
+    log = EventLogger("test_hot_log")
+
+    assert log.error("poll_error", "Error polling %s", "s0", key="s0")
+    assert not log.error("poll_error", "Error polling %s", "s0", key="s0")
+    assert not log.error("poll_error", "Error polling %s", "s0", key="s0")
+    assert log.error("poll_error", "Error polling %s", "s1", key="s1")  # other servers have their own limit
+    now[0] += 60
+    assert log.error("poll_error", "Error polling %s", "s0", key="s0")
+
+    assert [r.getMessage() for r in caplog.records] == ["Error polling s0", "Error polling s1",
+                                                        "Error polling s0 (2 similar suppressed)"]
+    assert caplog.records[-1].event == "poll_error" and caplog.records[-1].fields == {"suppressed": 2}
+
+
+def test_disabled_level_does_not_count_towards_the_policy(caplog):
+    caplog.set_level(logging.INFO, logger="test_hot_log")
+    configure(sampling={"register_read": 2})
+    log = EventLogger("test_hot_log")
+    assert not log.debug("register_read", "read")
+    assert hot_log._state == {} and caplog.records == []
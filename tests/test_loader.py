@@ -0,0 +1,72 @@
+import dataclasses
+import pytest
+from loader import ModbusTCPOptions, Options, ServerOptions, diff_options
+
+
+def with_server(options: Options, i: int, **changes) -> Options:
+    servers = list(options.servers)
+    servers[i] = dataclasses.replace(servers[i], **changes)
+    return dataclasses.replace(options, servers=servers)
+
+
+def names(items):
+    return [item.name for item in items]
+
+
+def test_identical_options_have_no_diff(make_options):
+    diff = diff_options(make_options(), make_options())
+    assert not diff
+    assert diff.restart_required == []
+
+
+def test_poll_intervals_are_updated_in_place(make_options):
+    old = make_options()
+    diff = diff_options(old, with_server(old, 1, poll_intervals={"power": 1}, aggregate_energy=True))
+    assert names(diff.servers_updated) == ["s1"]
+    assert diff.servers_changed == []
+
+
+def test_other_server_fields_re_create_the_server(make_options):
+    old = make_options()
+    diff = diff_options(old, with_server(old, 2, modbus_id=5, poll_intervals={"power": 1}))
+    assert names(diff.servers_changed) == ["s2"]
+    assert diff.servers_updated == []
+
+
+def test_added_and_removed_servers(make_options):
+    old = make_options(3)
+    new = dataclasses.replace(old, servers=old.servers[1:] + [ServerOptions("s9", "s9", "SN9", "Sim", "c0", 2)])
+    diff = diff_options(old, new)
+    assert names(diff.servers_added) == ["s9"]
+    assert names(diff.servers_removed) == ["s0"]
+
+
+def test_servers_of_a_changed_client_are_re_created(make_options):
+    old = make_options()
+    clients = list(old.clients)
+    clients[1] = dataclasses.replace(clients[1], port=1502)
+    diff = diff_options(old, dataclasses.replace(old, clients=clients))
+    assert names(diff.clients_changed) == ["c1"]
+    assert names(diff.servers_changed) == ["s1"]
+
+
+def test_servers_of_a_replaced_client_are_re_created(make_options):
+    old = make_options()
+    clients = [c for c in old.clients if c.name != "c0"] + [ModbusTCPOptions("other", "c0", "TCP", host="h", port=1)]
+    diff = diff_options(old, dataclasses.replace(old, clients=clients))
+    assert names(diff.clients_removed) == ["c0"] and names(diff.clients_added) == ["other"]
+    assert names(diff.servers_changed) == ["s0"]
+
+
+@pytest.mark.parametrize("field, value, restart", [
+    ("poll_interval", 1, False),
+    ("mqtt_deadband", 0.5, False),
+    ("log_sampling", {"register_read": 10}, False),
+    ("mqtt_host", "other", True),
+    ("model_cache_path", "", True),
+])
+def test_settings_that_need_a_restart(make_options, field, value, restart):
+    old = make_options()
+    diff = diff_options(old, dataclasses.replace(old, **{field: value}))
+    assert diff.settings == {field: (getattr(old, field), value)}
+    assert diff.restart_required == ([field] if restart else [])
@@ -0,0 +1,64 @@
+import pytest
+from types import SimpleNamespace
+from pymodbus.exceptions import ModbusIOException
+from pymodbus.pdu import ExceptionResponse
+from client import Client
+from loader import ModbusTCPOptions, ServerOptions
+from metrics import METRICS, Histogram
+from simulator import SimServer
+
+
+@pytest.fixture(autouse=True)
+def metrics():
+    METRICS.reset()
+    yield METRICS
+    METRICS.reset()
+
+
+@pytest.fixture
+def client():
+    return Client(ModbusTCPOptions("c0", "c0", "TCP", host="127.0.0.1", port=502))
+
+
+@pytest.fixture
+def server(client):
+    server = SimServer(ServerOptions("s0", "s0", "SN0", "Sim", "c0", 1), [client], n_registers=3)
+    server.set_model(1)
+    return server
+
+
+def test_percentiles_are_bucket_bounds_capped_at_the_max():
+    histogram = Histogram((0.01, 0.1, 1, float("inf")))
+    for seconds in (0.005, 0.005, 0.05, 0.5): histogram.observe(seconds)
+    assert histogram.summary() == {"count": 4, "mean": 0.14, "p50": 0.01, "p95": 0.5, "max": 0.5}
+
+
+def test_reads_are_recorded_per_client_server_and_group(client, server, metrics):
+    client.client.read_holding_registers = lambda address, count, slave: SimpleNamespace(isError=lambda: False,
+                                                                                      registers=[1] * count)
+    client.read_server_registers(server)
+    client.read_registers(server, "Sim register 0")
+
+    entry = metrics.snapshot()["clients"]["c0"]
+    assert entry["requests"] == 2 and entry["timeouts"] == 0 and entry["exceptions"] == {}
+    groups = entry["servers"]["s0"]["groups"]
+    assert len(groups) == 2 and groups["Sim register 0"]["count"] == 1
+    assert entry["servers"]["s0"]["cycle"]["count"] == 1
+
+
+def test_exception_responses_and_timeouts_are_counted(client, server, metrics):
+    responses = iter([ExceptionResponse(3, 2), ExceptionResponse(3, 2), ExceptionResponse(3, 6)])
+
+    def read_holding_registers(address, count, slave):
+        response = next(responses, None)
+        if response is None: raise ModbusIOException("no response")
+        return response
+
+    client.client.read_holding_registers = read_holding_registers
+    for _ in range(4):
+        with pytest.raises(Exception):
+            client.read_registers(server, "Sim register 0")
+
+    entry = metrics.snapshot()["clients"]["c0"]
+    assert entry["exceptions"] == {"2": 2, "6": 1} and entry["timeouts"] == 1
+    assert entry["requests"] == 3                                   # a request without response has no latency
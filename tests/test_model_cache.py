@@ -0,0 +1,68 @@
+import asyncio
+from bus_scheduler import BusScheduler
+from loader import ServerOptions
+from model_cache import ModelCache
+from simulator import SimServer
+
+
+def sim_server(bus, n_registers=10) -> SimServer:
+    return SimServer(ServerOptions("s0", "s0", "SN0", "Sim", "c0", 1), [bus], n_registers=n_registers)
+
+
+def cache_with_pruned_server(path, bus) -> ModelCache:
+    """ A cache written after setting up a server whose model drops its last register """
+    cache = ModelCache(str(path))
+    server = sim_server(bus)
+    fingerprint = cache.fingerprint(server)
+    server.set_model(1)
+    del server.registers["Sim register 8"]
+    cache.store(server, fingerprint)
+    return cache
+
+
+def test_restore_sets_up_the_server_from_the_file(make_bus, tmp_path):
+    bus = make_bus()
+    cache_with_pruned_server(tmp_path / "models.json", bus)
+
+    server = sim_server(bus)
+    assert ModelCache(str(tmp_path / "models.json")).restore(server)
+    assert (server.model, server.modelcode) == ("Sim", 1)
+    assert len(server.registers) == 9 and "Sim register 8" not in server.table
+    assert bus.requests == []
+
+
+def test_changed_register_definitions_invalidate_the_entry(make_bus, tmp_path):
+    bus = make_bus()
+    cache = cache_with_pruned_server(tmp_path / "models.json", bus)
+    server = sim_server(bus, n_registers=11)
+    assert cache.fingerprint(server) != cache.entries["SN0"]["fingerprint"]
+    assert not cache.restore(server) and server.model is None
+
+
+def run_restored(bus, cache):
+    async def scenario():
+        server = sim_server(bus)
+        scheduler = BusScheduler(bus, [server], 5, model_cache=cache)
+        task = asyncio.create_task(scheduler.run(asyncio.Queue()))
+        await asyncio.sleep(0.01)
+        scheduler.stop()
+        await task
+        return server
+    return asyncio.run(scenario())
+
+
+def test_restored_model_is_polled_at_once_and_confirmed_in_the_background(make_bus, tmp_path):
+    bus = make_bus()
+    server = run_restored(bus, cache_with_pruned_server(tmp_path / "models.json", bus))
+    assert bus.requests == [("read", "s0"), ("modelcode", "s0")]
+    assert server.model == "Sim" and len(server.registers) == 9
+
+
+def test_different_device_type_code_sets_the_server_up_again(make_bus, tmp_path):
+    bus = make_bus()
+    cache = cache_with_pruned_server(tmp_path / "models.json", bus)
+    bus.modelcode = 2                                               # another device behind the same serial number
+    server = run_restored(bus, cache)
+    assert bus.requests == [("read", "s0"), ("modelcode", "s0"), ("model", "s0")]
+    assert "SN0" not in cache.entries and "SN0" not in ModelCache(str(tmp_path / "models.json")).entries
+    assert len(server.registers) == 10
@@ -0,0 +1,57 @@
+import asyncio
+import paho.mqtt.client as mqtt
+import pytest
+import async_engine
+
+
+@pytest.fixture
+def make_client(make_mqtt_client, tmp_path):
+    def make(drain_rate=10):
+        return make_mqtt_client(mqtt_buffer_path=str(tmp_path / "rb.bin"), mqtt_buffer_max_bytes=2**20, mqtt_drain_rate=drain_rate)
+    return make
+
+
+def test_buffers_while_offline_and_keeps_order(make_client):
+    client = make_client()
+    client.publish_state("a", 1)
+    client.online = True
+    client.publish_state("b", 2)                                    # queued behind the backlog
+    assert client.sent == [] and len(client.buffer) == 2
+    assert client.drain_buffer(10) == 2
+    assert client.sent == [("a", b"1"), ("b", b"2")]
+    client.publish_state("c", 3)
+    assert client.sent[-1] == ("c", 3)
+
+
+def test_failed_publish_keeps_the_message(make_client):
+    client = make_client()
+    client.publish_state("a", 1)
+    client.online = True
+    client.rc = mqtt.MQTT_ERR_NO_CONN                               # disconnected before on_disconnect ran
+    assert client.drain_buffer(10) == 0
+    assert len(client.buffer) == 1
+    client.publish_state("b", 2)
+    assert len(client.buffer) == 2
+    client.rc = mqtt.MQTT_ERR_SUCCESS
+    assert client.drain_buffer(10) == 2
+    assert client.sent == [("a", b"1"), ("b", b"2")]
+
+
+def test_backlog_shrinks_under_live_load_above_drain_rate(make_client, monkeypatch):
+    monkeypatch.setattr(async_engine, "DRAIN_TICK", 0.01)
+    client = make_client(drain_rate=100)                  # one buffered message per tick on top of live ones
+    for i in range(20): client.publish_state("old", i)
+    client.online = True
+
+    async def scenario():
+        worker = asyncio.create_task(async_engine.drain_worker(client))
+        for tick in range(60):
+            for _ in range(5): client.publish_state("live", tick)   # 500 messages/s, five times drain_rate
+            await asyncio.sleep(0.01)
+            if not client.buffer: break
+        worker.cancel()
+        return tick
+
+    ticks = asyncio.run(scenario())
+    assert not client.buffer, f"backlog of {len(client.buffer)} after {ticks} ticks"
+    assert [payload for topic, payload in client.sent if topic == "old"] == [f"{i}".encode() for i in range(20)]
@@ -0,0 +1,72 @@
+from enums import RegisterTypes
+from read_planner import ReadBlock, plan_reads
+
+HOLDING = RegisterTypes.HOLDING_REGISTER
+INPUT = RegisterTypes.INPUT_REGISTER
+
+
+def registers(*addresses, count=1, register_type=RegisterTypes.HOLDING_REGISTER):
+    return {f"r{a}": {"addr": a, "count": count, "register_type": register_type} for a in addresses}
+
+
+def spans(blocks):
+    return [(b.address, b.count, [m[0] for m in b.members]) for b in blocks]
+
+
+def test_register_on_a_hole_is_read_alone():
+    blocks = plan_reads(registers(99, 100, 101), 1, holes={HOLDING: {100}})
+    assert spans(blocks) == [(99, 1, ["r99"]), (100, 1, ["r100"]), (101, 1, ["r101"])]
+
+
+def test_gap_within_tolerance_is_bridged():
+    blocks = plan_reads(registers(1, 2, 10), 1, gap_tolerance=8)
+    assert spans(blocks) == [(1, 10, ["r1", "r2", "r10"])]
+
+
+def test_gap_beyond_tolerance_splits():
+    blocks = plan_reads(registers(1, 2, 12), 1, gap_tolerance=8)
+    assert spans(blocks) == [(1, 2, ["r1", "r2"]), (12, 1, ["r12"])]
+
+
+def test_hole_in_gap_is_not_bridged():
+    blocks = plan_reads(registers(1, 3), 1, holes={HOLDING: {2}})
+    assert spans(blocks) == [(1, 1, ["r1"]), (3, 1, ["r3"])]
+
+
+def test_max_count_limits_block_size():
+    blocks = plan_reads(registers(*range(1, 21, 2), count=2), 1, gap_tolerance=8, max_count=5)
+    assert [b.count for b in blocks] == [4, 4, 4, 4, 4]
+    assert all(b.count <= 5 for b in blocks)
+
+
+def test_max_count_is_capped_at_protocol_limit():
+    blocks = plan_reads(registers(*range(1, 301)), 1, max_count=1000)
+    assert max(b.count for b in blocks) == 125
+
+
+def test_register_types_are_planned_separately():
+    regs = registers(1, 2) | {"i1": {"addr": 1, "count": 1, "register_type": RegisterTypes.INPUT_REGISTER}}
+    blocks = plan_reads(regs, 7)
+    assert {(b.register_type, b.address, b.count) for b in blocks} == \
+           {(RegisterTypes.HOLDING_REGISTER, 1, 2), (RegisterTypes.INPUT_REGISTER, 1, 1)}
+    assert all(b.slave_id == 7 for b in blocks)
+
+
+def test_gap_addresses():
+    block, = plan_reads(registers(1, 4, count=2), 1)
+    assert block.gap_addresses() == {3}
+
+
+def test_holes_only_split_their_register_type():
+    regs = registers(1, 2, 3) | {f"i{name}": info for name, info in registers(1, 2, 3, register_type=INPUT).items()}
+    blocks = plan_reads(regs, 1, holes={INPUT: {2}})
+    assert sorted((b.register_type.value, b.address, b.count) for b in blocks) == \
+           [(INPUT.value, 1, 1), (INPUT.value, 2, 1), (INPUT.value, 3, 1), (HOLDING.value, 1, 3)]
+
+
+def test_client_learns_holes_per_register_type():
+    from client import Client
+    from loader import ModbusTCPOptions
+    client = Client(ModbusTCPOptions("c0", "c0", "TCP", host="127.0.0.1", port=502))
+    client._learn_holes(ReadBlock(INPUT, 1, 1, 3, [("a", 0, 1), ("b", 2, 1)]), set(), all_ok=True)
+    assert client.holes == {(1, INPUT): {2}}
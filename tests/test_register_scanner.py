@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+import pytest
+from pymodbus.exceptions import ModbusException
+from pymodbus.pdu import ExceptionResponse
+from enums import DataType, RegisterTypes
+from register_scanner import RegisterScanner, draft_register_map, guess_dtype
+
+HOLDING = RegisterTypes.HOLDING_REGISTER
+INPUT = RegisterTypes.INPUT_REGISTER
+
+
+class FakeClient:
+    """ Answers _read like a slave that maps the given addresses, Illegal Data Address elsewhere """
+    def __init__(self, mapped: dict, unsupported=(), silent=()):
+        self.mapped = mapped                                        # (register type, address) -> value
+        self.unsupported = set(unsupported)                         # register types answered with Illegal Function
+        self.silent = set(silent)                                   # addresses that time out
+        self.requests = 0
+
+    def _read(self, address, count, slave_id, register_type):
+        self.requests += 1
+        if register_type in self.unsupported: return ExceptionResponse(3, 1)
+        addresses = range(address, address + count)
+        if any(a in self.silent for a in addresses): raise ModbusException("timeout")
+        if not all((register_type, a) in self.mapped for a in addresses): return ExceptionResponse(3, 2)
+        return SimpleNamespace(registers=[self.mapped[(register_type, a)] for a in addresses], isError=lambda: False)
+
+
+def mapped(register_type, start, end, value=lambda a: a):
+    return {(register_type, a): value(a) for a in range(start, end)}
+
+
+def islands(result):
+    return [(i.register_type, i.address, i.end) for i in result.islands]
+
+
+@pytest.mark.parametrize("start, end", [(1, 300), (37, 38), (250, 251), (120, 131), (125, 127), (3, 500)])
+def test_finds_island_edges(start, end):
+    client = FakeClient(mapped(HOLDING, start, end))
+    result = RegisterScanner(client, 1, stride=1).scan(1, 600, [HOLDING])
+    assert islands(result) == [(HOLDING, start, end)]
+    assert result.islands[0].values == list(range(start, end))
+
+
+def test_stride_probing_finds_several_islands():
+    client = FakeClient(mapped(HOLDING, 10, 30) | mapped(HOLDING, 100, 140) | mapped(HOLDING, 400, 409))
+    result = RegisterScanner(client, 1, stride=8).scan(1, 1000, [HOLDING])
+    assert islands(result) == [(HOLDING, 10, 30), (HOLDING, 100, 140), (HOLDING, 400, 409)]
+    assert result.requests == client.requests
+    assert result.requests < 1000 // 8 + 8 * 20                    # far below one request per address
+
+
+def test_island_starting_at_the_end_of_a_block():
+    client = FakeClient(mapped(HOLDING, 125, 140))
+    result = RegisterScanner(client, 1, stride=8).scan(1, 300, [HOLDING])
+    assert islands(result) == [(HOLDING, 125, 140)]
+
+
+def test_illegal_function_stops_the_register_type():
+    client = FakeClient(mapped(HOLDING, 1, 5), unsupported=[INPUT])
+    result = RegisterScanner(client, 1).scan(1, 65536, [HOLDING, INPUT])
+    assert islands(result) == [(HOLDING, 1, 5)]
+
+
+def test_blocks_without_response_are_reported():
+    client = FakeClient(mapped(HOLDING, 1, 300), silent={10})
+    result = RegisterScanner(client, 1, retries=0).scan(1, 250, [HOLDING])
+    assert result.unreadable == [(HOLDING, 1, 125)]
+    assert islands(result) == [(HOLDING, 126, 251)]
+
+
+def test_guess_dtype():
+    assert guess_dtype([0x4142, 0x4344, 0]) == (DataType.UTF8, 2)
+    assert guess_dtype([0x0001, 0x86A0]) == (DataType.U32, 2)
+    assert guess_dtype(DataType.F32.encode_registers(230.5)) == (DataType.F32, 2)
+    assert guess_dtype([0xFFFE]) == (DataType.I16, 1)
+    assert guess_dtype([12]) == (DataType.U16, 1)
+
+
+def test_draft_register_map():
+    client = FakeClient(mapped(INPUT, 30, 33, value=lambda a: [0x0001, 0x86A0, 5][a - 30]))
+    result = RegisterScanner(client, 1, stride=1).scan(1, 100, [INPUT])
+    registers = draft_register_map(result.islands)
+    assert registers == {
+        "Input 30": {"addr": 30, "count": 2, "dtype": DataType.U32, "multiplier": 1, "unit": "", "device_class": None,
+                     "register_type": INPUT, "sample": 100000},
+        "Input 32": {"addr": 32, "count": 1, "dtype": DataType.U16, "multiplier": 1, "unit": "", "device_class": None,
+                     "register_type": INPUT, "sample": 5},
+    }
@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+import pytest
+from client import Client
+from loader import ModbusTCPOptions, ServerOptions
+from simulator import DEVICE_TYPE_CODE, SimServer, register_values
+
+
+class ShrinkingServer(SimServer):
+    """ Keeps every other register for its model, like real implementations drop unsupported ones """
+    def setup_valid_registers_for_model(self):
+        names = list(self.registers)
+        self.registers = {name: self.registers[name] for name in names[:1] + names[2::2]}
+
+
+def make_server(server_class=ShrinkingServer):
+    client = Client(ModbusTCPOptions("c0", "c0", "TCP", host="127.0.0.1", port=502))
+    values = None
+
+    def read(address, count, slave_id, register_type):
+        return SimpleNamespace(registers=values[address:address + count], isError=lambda: False)
+    client._read = read
+    server = server_class(ServerOptions("s0", "s0", "SN0", "Sim", "c0", 1), [client], n_registers=20)
+    values = register_values(server.registers)
+    return server
+
+
+def test_table_follows_setup():
+    server = make_server()
+    server.read_model()                                             # compiles the table with all registers
+    assert server.model == "Sim" and len(server.table) == 20
+    server.setup_valid_registers_for_model()
+    assert len(server.table) == len(server.registers) == 10
+    values = server.connected_client.read_server_registers(server)
+    assert set(values) == set(server.registers)
+
+
+def test_register_info_argument_is_deprecated():
+    server = make_server()
+    with pytest.deprecated_call():
+        assert server.connected_client.read_registers(server, "probe", server.registers["Device type code"]) == DEVICE_TYPE_CODE
+    assert server.connected_client.read_registers(server, "Device type code") == DEVICE_TYPE_CODE
@@ -0,0 +1,33 @@
+from loader import ModbusRTUOptions, ModbusTCPOptions, ServerOptions
+from sharding import shard_clients
+
+
+def tcp(name, host, port=502):
+    return ModbusTCPOptions(name, name, "TCP", host=host, port=port)
+
+
+def servers_of(client, n):
+    return [ServerOptions(f"{client}s{i}", f"{client}s{i}", f"SN{client}{i}", "Sim", client, i + 1) for i in range(n)]
+
+
+def names(options):
+    return sorted(o.name for o in options)
+
+
+def test_clients_sharing_an_endpoint_stay_in_one_shard():
+    clients = [tcp("a", "gw1"), tcp("b", "gw1"), tcp("c", "gw2"),
+               ModbusRTUOptions("d", "d", "RTU", port="/dev/ttyUSB0", baudrate=9600, bytesize=8, parity=False, stopbits=1),
+               ModbusRTUOptions("e", "e", "RTU", port="/dev/ttyUSB0", baudrate=9600, bytesize=8, parity=False, stopbits=1)]
+    servers = [server for client in "abcde" for server in servers_of(client, 1)]
+    shards = shard_clients(clients, servers, 3)
+    assert sorted(names(clients_) for clients_, _ in shards) == [["a", "b"], ["c"], ["d", "e"]]
+    for clients_, servers_ in shards:
+        assert {s.connected_client for s in servers_} == {c.ha_display_name for c in clients_}
+
+
+def test_shards_are_balanced_by_server_count_and_empty_ones_dropped():
+    clients = [tcp("a", "gw1"), tcp("b", "gw2"), tcp("c", "gw3"), tcp("d", "gw4")]
+    servers = servers_of("a", 4) + servers_of("b", 2) + servers_of("c", 1) + servers_of("d", 1)
+    shards = shard_clients(clients, servers, 2)
+    assert sorted(len(servers_) for _, servers_ in shards) == [4, 4]
+    assert len(shard_clients(clients, servers, 8)) == 4
@@ -0,0 +1,70 @@
+from store_forward import LENGTH, RECORD, RingBuffer
+
+
+def record_size(topic, payload):
+    return LENGTH.size + RECORD.size + len(topic) + len(payload)
+
+
+def test_fifo_order(tmp_path):
+    buffer = RingBuffer(str(tmp_path / "rb.bin"), 4096)
+    for i in range(10): buffer.push("t", f"{i}".encode(), timestamp=i)
+    assert [buffer.pop()[2] for _ in range(10)] == [f"{i}".encode() for i in range(10)]
+    assert buffer.pop() is None
+
+
+def test_wraps_and_drops_oldest_when_full(tmp_path):
+    capacity = 5 * record_size("t", b"xxxx") + 3                   # room for 5 records plus a partial one
+    buffer = RingBuffer(str(tmp_path / "rb.bin"), capacity)
+    for i in range(12): buffer.push("t", f"{i:04d}".encode(), timestamp=i)
+    assert len(buffer) == 5
+    assert buffer.dropped == 7
+    assert [buffer.pop()[2] for _ in range(5)] == [f"{i:04d}".encode() for i in range(7, 12)]
+
+
+def test_wrap_marker_with_records_of_different_sizes(tmp_path):
+    buffer = RingBuffer(str(tmp_path / "rb.bin"), 200)
+    pushed = []
+    for i in range(50):
+        payload = b"x" * (i % 7 * 5)
+        buffer.push(f"topic/{i}", payload, timestamp=i)
+        pushed.append((f"topic/{i}", payload))
+    messages = []
+    while len(buffer): messages.append(buffer.pop()[1:])
+    assert messages == pushed[-len(messages):]
+    assert buffer.buffered == 50 and buffer.dropped + len(messages) == 50
+
+
+def test_survives_reopen(tmp_path):
+    path = str(tmp_path / "rb.bin")
+    buffer = RingBuffer(path, 1024)
+    for i in range(3): buffer.push("a/b", f"{i}".encode(), timestamp=100 + i)
+    buffer.pop()
+    buffer.close()
+
+    reopened = RingBuffer(path, 1024)
+    assert len(reopened) == 2
+    assert reopened.oldest() == 101
+    assert reopened.pop() == (101, "a/b", b"1")
+    assert reopened.pop() == (102, "a/b", b"2")
+
+
+def test_reopen_with_other_capacity_starts_empty(tmp_path):
+    path = str(tmp_path / "rb.bin")
+    buffer = RingBuffer(path, 1024)
+    buffer.push("t", b"1")
+    buffer.close()
+    assert len(RingBuffer(path, 2048)) == 0
+
+
+def test_oversized_message_is_dropped(tmp_path):
+    buffer = RingBuffer(str(tmp_path / "rb.bin"), 64)
+    buffer.push("t", b"x" * 64)
+    assert len(buffer) == 0 and buffer.dropped == 1
+
+
+def test_peek_does_not_remove(tmp_path):
+    buffer = RingBuffer(str(tmp_path / "rb.bin"), 1024)
+    assert buffer.peek() is None
+    buffer.push("t", b"1", timestamp=5)
+    assert buffer.peek() == (5, "t", b"1")
+    assert len(buffer) == 1 and buffer.drained == 0
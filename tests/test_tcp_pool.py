@@ -0,0 +1,53 @@
+import asyncio
+import struct
+import pytest
+from pymodbus.exceptions import ModbusIOException
+from tcp_pool import MBAP_HEADER, PipelinedTcpConnection
+
+
+async def gateway(replies: list):
+    """ Answers each request with the next reply PDU, the transaction id of the request and 1 as value """
+    connections = []
+
+    async def handle(reader, writer):
+        connections.append(writer)
+        try:
+            while True:
+                tid, _, length, slave = MBAP_HEADER.unpack(await reader.readexactly(MBAP_HEADER.size))
+                await reader.readexactly(length - 1)
+                pdu = replies.pop(0) if replies else bytes([3, 2, 0, 1])
+                writer.write(MBAP_HEADER.pack(tid, 0, len(pdu) + 1, slave) + pdu)
+        except asyncio.IncompleteReadError:
+            pass
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1], connections
+
+
+def test_read_registers():
+    async def scenario():
+        server, port, _ = await gateway([])
+        connection = PipelinedTcpConnection("127.0.0.1", port, timeout=1)
+        result = await connection.read_holding_registers(0, 1, slave=1)
+        connection.close()
+        server.close()
+        return result
+    assert asyncio.run(scenario()).registers == [1]
+
+
+@pytest.mark.parametrize("bad_pdu", [bytes([0x2B, 0]), bytes([3, 4, 0])], ids=["unsupported function", "truncated"])
+def test_invalid_response_fails_pending_and_reconnects(bad_pdu):
+    async def scenario():
+        server, port, connections = await gateway([bad_pdu])
+        connection = PipelinedTcpConnection("127.0.0.1", port, timeout=5)
+        start = asyncio.get_running_loop().time()
+        with pytest.raises(ModbusIOException, match="Invalid response"):
+            await connection.read_holding_registers(0, 1, slave=1)
+        assert asyncio.get_running_loop().time() - start < 1       # failed at once, not by timeout
+        assert not connection.connected
+        result = await connection.read_holding_registers(0, 1, slave=1)
+        connection.close()
+        server.close()
+        return result, len(connections)
+    result, n_connections = asyncio.run(scenario())
+    assert result.registers == [1] and n_connections == 2
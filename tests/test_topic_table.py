@@ -0,0 +1,39 @@
+import pytest
+
+
+@pytest.fixture
+def server(make_server):
+    server = make_server("Inverter 1")
+    server.registers = {"PV Power (W)": {"unit": "W"}}
+    return server
+
+
+def test_compiled_topics(make_mqtt_client, server):
+    client = make_mqtt_client()
+    table = client.compile_topics(server)
+
+    assert client.topics["Inverter 1"] is table
+    assert table.availability == "modbus_Inverter 1/availability"
+    assert table.state == {"PV Power (W)": "modbus/Inverter 1/pv_power_w/state", "Limit": "modbus/Inverter 1/limit/state"}
+    assert table.server_state == "modbus/Inverter 1/state"
+    assert table.state_key == {"PV Power (W)": "pv_power_w"}
+    assert table.command == {"Limit": "modbus/Inverter 1/limit/set"}
+    assert table.unique_id == {"PV Power (W)": "Inverter 1_pv_power_w", "Limit": "Inverter 1_limit"}
+    assert table.sensor_config == {"PV Power (W)": "ha/sensor/Inverter 1/pv_power_w/config"}
+    assert table.number_config == {"Limit": "ha/number/Inverter 1/limit/config"}
+
+
+def test_publish_recompiles_for_registers_added_since(make_mqtt_client, server):
+    client = make_mqtt_client()
+    client.compile_topics(server)
+    server.registers = server.registers | {"Grid Frequency": {"unit": "Hz"}}
+    client.publish_to_ha("Grid Frequency", 50.0, server)
+    assert client.sent == [("modbus/Inverter 1/grid_frequency/state", 50.0)]
+    assert "Grid Frequency" in client.topics["Inverter 1"].state
+
+
+def test_forget_server_drops_its_table(make_mqtt_client, server):
+    client = make_mqtt_client()
+    client.compile_topics(server)
+    client.forget_server(server)
+    assert client.topics == {}
@@ -0,0 +1,64 @@
+import asyncio
+import pytest
+from write_worker import WriteWorker
+
+
+class FakeScheduler:
+    def __init__(self):
+        self.writes = []
+
+    def submit_writes(self, server, values):
+        self.writes.append((server, values))
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(values)
+        return future
+
+
+@pytest.fixture
+def make_worker(make_mqtt_client):
+    def make(servers, schedulers):
+        mqtt_client = make_mqtt_client()
+        mqtt_client.published = []
+        mqtt_client.publish_to_ha = lambda name, value, server, force=False: mqtt_client.published.append((server, name, value))
+        worker = WriteWorker(mqtt_client, schedulers, debounce=0)
+        worker.attach(servers)
+        return worker
+    return make
+
+
+def test_command_targets_follow_compiled_topics(make_worker, make_server):
+    async def scenario():
+        server = make_server("inv")
+        scheduler = FakeScheduler()
+        worker = make_worker([server], {"c0": scheduler})
+        worker._on_command("modbus/inv/limit/set", b"50")
+        assert worker._pending == {}                                # no topics compiled yet
+        worker.mqtt_client.compile_topics(server)
+        worker._on_command("modbus/inv/limit/set", b"50")
+        await asyncio.sleep(0.01)
+        worker.mqtt_client.forget_server(server)
+        worker._on_command("modbus/inv/limit/set", b"60")
+        await asyncio.sleep(0.01)
+        return scheduler.writes, worker.mqtt_client.published
+
+    writes, published = asyncio.run(scenario())
+    assert [(str(server), values) for server, values in writes] == [("inv", {"Limit": 50.0})]
+    assert [(str(server), name, value) for server, name, value in published] == [("inv", "Limit", 50.0)]
+
+
+def test_reload_drops_writes_of_removed_servers(make_worker, make_server):
+    async def scenario():
+        kept, removed, recreated = make_server("a"), make_server("b"), make_server("c", client="c1")
+        scheduler = FakeScheduler()
+        schedulers = {"c0": scheduler, "c1": FakeScheduler()}
+        worker = make_worker([kept, removed, recreated], schedulers)
+        for server in (kept, removed, recreated): worker.mqtt_client.compile_topics(server)
+        worker.debounce = 60
+        for nickname in "abc": worker._on_command(f"modbus/{nickname}/limit/set", b"1")
+        worker.attach([kept, make_server("c", client="c1")])
+        del schedulers["c1"]                                        # client of the re-created server stopped
+        worker._pending["modbus/c/limit/set"] = (recreated, "Limit", b"1")
+        worker._flush()
+        return scheduler.writes
+
+    assert [(str(server), values) for server, values in asyncio.run(scenario())] == [("a", {"Limit": 1.0})]
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+from bus_scheduler import BusScheduler
+from modbus_mqtt import MqttClient
+from server import Server
+logger = logging.getLogger(__name__)
+
+"""
+    MQTT write pipeline:
+    /set messages are handed from paho's network thread to the event loop without blocking it.
+    Messages are collected for `debounce` seconds, keeping only the last value per topic, e.g.
+    while a number slider is dragged in HA. The collected writes are then submitted per server to
+    the server's BusScheduler, which batches adjacent registers into one request, checks the
+    responses and reads the registers back. Read-back values are published as the new state.
+"""
+
+
+class WriteWorker:
+    def __init__(self, mqtt_client: MqttClient, schedulers: dict, debounce: float = 0.5):
+        self.mqtt_client = mqtt_client
+        self.schedulers: dict = schedulers                          # client -> BusScheduler
+        self.debounce = debounce
+
+        self._servers: dict[str, Server] = {}                       # nickname -> server
+        self._targets: dict[str, tuple[Server, str]] = {}           # command topic -> (server, write parameter)
+        self._pending: dict[str, tuple[Server, str, bytes]] = {}    # command topic -> (server, write parameter, payload)
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def attach(self, servers: list[Server]):
+        """ Route MQTT command messages to this worker. Must be called from the event loop.
+            Called again with the new servers after a reload, pending writes to servers no longer in servers are dropped.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._servers = {server.nickname: server for server in servers}
+        for topic, (server, register_name, payload) in list(self._pending.items()):
+            if self._servers.get(server.nickname) is not server:
+                logger.warning(f"Dropping write of {register_name} to server {server}, which was removed or re-created")
+                del self._pending[topic]
+        self._update_targets()
+        self.mqtt_client.on_topics_changed = self._update_targets
+        self.mqtt_client.command_handler = \
+            lambda message: self._loop.call_soon_threadsafe(self._on_command, message.topic, message.payload)
+
+    def _update_targets(self):
+        """ Rebuild the command topic lookup, called by the MqttClient whenever topics are compiled or dropped """
+        self._targets = {topic: (self._servers[nickname], name)
+                         for nickname, topics in self.mqtt_client.topics.items() if nickname in self._servers
+                         for name, topic in topics.command.items()}
+
+    def _on_command(self, topic: str, payload: bytes):
+        target = self._targets.get(topic)
+        if target is None:
+            logger.warning(f"Received command on unknown topic {topic}")
+            return
+
+        self._pending[topic] = (*target, payload)                   # last value wins
+        if self._flush_handle is None:
+            self._flush_handle = self._loop.call_later(self.debounce, self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        pending, self._pending = self._pending, {}
+
+        by_server: dict[Server, dict[str, float]] = {}
+        for server, register_name, payload in pending.values():
+            try:
+                value = float(payload.decode())
+            except (UnicodeDecodeError, ValueError):
+                logger.error(f"Invalid payload {payload!r} for {register_name} of server {server}")
+                continue
+            by_server.setdefault(server, {})[register_name] = value
+
+        for server, values in by_server.items():
+            scheduler: BusScheduler | None = self.schedulers.get(server.connected_client)
+            if scheduler is None:
+                logger.warning(f"Skipping writes {values} to server {server}, its client {server.connected_client} is not running")
+                continue
+            logger.info(f"Submitting writes {values} to server {server}")
+            future = scheduler.submit_writes(server, values)
+            future.add_done_callback(lambda f, server=server: self._publish_readback(server, f))
+
+    def _publish_readback(self, server: Server, future: asyncio.Future):
+        if future.cancelled() or future.exception() is not None: return
+        for register_name, value in future.result().items():
+            self.mqtt_client.publish_to_ha(register_name, value, server, force=True)